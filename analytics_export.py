@@ -0,0 +1,499 @@
+#!venv/bin/python
+
+import datetime
+import json
+import os
+import sqlite3
+import time
+import urllib.parse
+from typing import Dict, Any, List, Optional, Tuple
+
+import click
+
+from audio_compression import get_compressed_path
+from utils import (
+    print_log,
+    get_recording_files,
+    get_date_from_audio_id,
+    iter_run_folders,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+EXPORT_STATE_FILE_NAME = ".export_state.db"
+# Recordings are grouped by device within each file, so that the row group statistics let device filters skip
+# most of a file.
+ROW_GROUP_SIZE = 8192
+GROUP_BY_COLUMNS = ["username", "month", "device", "recorded_on"]
+# Every run folder holds the recordings of the earlier runs too, so a recording is exported once per run that it
+# is in. These columns find the copy from the latest run.
+DEDUPLICATION_COLUMNS = ["username", "audio_id", "div_id", "run_date", "trial"]
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    files TEXT NOT NULL
+);
+"""
+
+
+def require_pyarrow() -> None:
+    """
+    Raises ImportError with how to install pyarrow, which the export needs but the rest of the scripts do not.
+
+    :return: None.
+    """
+    if pa is None:
+        raise ImportError("The columnar export needs pyarrow. Install it with `pip install pyarrow`.")
+
+
+def get_export_schema() -> "pa.Schema":
+    """
+    :return: The columns of the exported files. The username and the month (YYYY-MM) of each recording are not
+        stored in the files, but in the folder names of the partitions: username=<username>/month=<month>.
+    """
+    return pa.schema(
+        [
+            ("run_date", pa.string()),
+            ("trial", pa.int32()),
+            ("div_id", pa.string()),
+            ("audio_id", pa.string()),
+            ("message", pa.string()),
+            ("date", pa.string()),
+            ("time", pa.string()),
+            ("device", pa.string()),
+            ("recorded_on", pa.date32()),
+            ("wav_path", pa.string()),
+            ("file_size", pa.int64()),
+            ("compressed", pa.bool_()),
+            ("duration", pa.float64()),
+            ("sample_rate", pa.int32()),
+            ("rms_db", pa.float64()),
+            ("silence_ratio", pa.float64()),
+        ]
+    )
+
+
+def get_partitioning() -> "ds.Partitioning":
+    """
+    :return: The partitioning of the export folder (explicit, so that numeric usernames stay strings).
+    """
+    return ds.partitioning(pa.schema([("username", pa.string()), ("month", pa.string())]), flavor="hive")
+
+
+def get_partition_folder(export_dir: str, username: str, month: str) -> str:
+    """
+    :param export_dir: The folder of the export.
+    :param username: The username of the user.
+    :param month: The month as YYYY-MM.
+
+    :return: The folder of the user's partition of that month.
+    """
+    return os.path.join(export_dir, f"username={urllib.parse.quote(username, safe='')}", f"month={month}")
+
+
+def open_export_state(export_dir: str) -> sqlite3.Connection:
+    """
+    :param export_dir: The folder of the export.
+
+    :return: A connection to the runs that have been exported, and the files that each one was written to.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(export_dir, EXPORT_STATE_FILE_NAME))
+    connection.executescript(STATE_SCHEMA)
+    return connection
+
+
+def get_export_rows(run_date: str, run_path: str, metadata: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    :param run_date: The date folder name of the run (year-month-day).
+    :param run_path: The run folder path.
+    :param metadata: The metadata of the run.
+
+    :return: A row per recording, with the columns of get_export_schema and the "month" of the recording.
+    """
+    trial = int(os.path.basename(run_path))
+    recording_files = get_recording_files(metadata, run_path)
+    rows = []
+    for recording in metadata:
+        audio_id = recording.get("audio_id")
+        recorded_on = get_date_from_audio_id(audio_id) or run_date
+        wav_path = recording_files.get(audio_id)
+        file_size = None
+        compressed = False
+        if wav_path is not None:
+            if os.path.isfile(wav_path):
+                file_size = os.path.getsize(wav_path)
+            elif os.path.isfile(get_compressed_path(wav_path)):
+                file_size = os.path.getsize(get_compressed_path(wav_path))
+                compressed = True
+        rows.append(
+            {
+                "month": recorded_on[:7],
+                "run_date": run_date,
+                "trial": trial,
+                "div_id": recording.get("div_id"),
+                "audio_id": audio_id,
+                "message": recording.get("message"),
+                "date": recording.get("date"),
+                "time": recording.get("time"),
+                "device": recording.get("device"),
+                "recorded_on": datetime.date.fromisoformat(recorded_on),
+                "wav_path": wav_path,
+                "file_size": file_size,
+                "compressed": compressed,
+                "duration": recording.get("duration"),
+                "sample_rate": recording.get("sample_rate"),
+                "rms_db": recording.get("rms_db"),
+                "silence_ratio": recording.get("silence_ratio"),
+            }
+        )
+    return rows
+
+
+def write_partition_file(file_path: str, rows: List[Dict[str, Any]]) -> None:
+    """
+    Writes the rows of one partition to a parquet file, sorted by device and day. The file is written next to
+    its target under a name that the readers skip, and then moved into place.
+
+    :param file_path: Path of the parquet file.
+    :param rows: The rows (see get_export_rows).
+
+    :return: None.
+    """
+    schema = get_export_schema()
+    rows = sorted(rows, key=lambda row: (row["device"] or "", row["recorded_on"]))
+    table = pa.Table.from_pylist([{name: row[name] for name in schema.names} for row in rows], schema=schema)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temporary_path = os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}.tmp")
+    pq.write_table(table, temporary_path, row_group_size=ROW_GROUP_SIZE, compression="zstd")
+    os.replace(temporary_path, file_path)
+
+
+def export_run_folder(
+    connection: sqlite3.Connection,
+    export_dir: str,
+    username: str,
+    run_date: str,
+    run_path: str,
+    info_file: str = "recordinginfo.json",
+    force: bool = False,
+) -> int:
+    """
+    Adds the metadata of one run to the export, as one parquet file per month in the user's partitions. A run
+    whose metadata file has not changed since it was last exported is skipped, and a run that has changed
+    replaces the files it was exported to before.
+
+    :param connection: A connection to the export state (see open_export_state).
+    :param export_dir: The folder of the export.
+    :param username: The username of the user of the run.
+    :param run_date: The date folder name of the run (year-month-day).
+    :param run_path: The run folder path.
+    :param info_file: The filename of the metadata file in the run folder.
+    :param force: Whether the run should be exported again even if it has not changed.
+
+    :return: The number of recordings that were exported from this run.
+    """
+    require_pyarrow()
+    metadata_path = os.path.join(run_path, info_file)
+    try:
+        stat = os.stat(metadata_path)
+    except FileNotFoundError:
+        return 0
+
+    run_path = os.path.abspath(run_path)
+    exported_run = connection.execute("SELECT mtime, size, files FROM runs WHERE path = ?", (run_path,)).fetchone()
+    if not force and exported_run is not None and exported_run[:2] == (stat.st_mtime, stat.st_size):
+        return 0
+
+    with open(metadata_path, "r") as f:
+        try:
+            metadata = json.load(f)
+        except json.JSONDecodeError:
+            print_log(f"WARNING: {metadata_path} is not valid json. Skipping this run.")
+            return 0
+
+    rows_by_month: Dict[str, List[Dict[str, Any]]] = {}
+    for row in get_export_rows(run_date, run_path, metadata):
+        rows_by_month.setdefault(row["month"], []).append(row)
+
+    file_name = f"{run_date}_{os.path.basename(run_path)}.parquet"
+    files = []
+    for month, rows in sorted(rows_by_month.items()):
+        file_path = os.path.join(get_partition_folder(export_dir, username, month), file_name)
+        write_partition_file(file_path, rows)
+        files.append(os.path.relpath(file_path, export_dir))
+    # The recordings of a run can move to other months when its metadata changes.
+    for old_file in json.loads(exported_run[2]) if exported_run is not None else []:
+        if old_file not in files and os.path.exists(os.path.join(export_dir, old_file)):
+            os.remove(os.path.join(export_dir, old_file))
+
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO runs (path, mtime, size, files) VALUES (?, ?, ?, ?)",
+            (run_path, stat.st_mtime, stat.st_size, json.dumps(files)),
+        )
+    return len(metadata)
+
+
+def build_export(
+    export_dir: str, output_folder: str, info_file: str = "recordinginfo.json", force: bool = False
+) -> None:
+    """
+    Exports every run in the recordings tree that is new or has changed since the last export.
+
+    :param export_dir: The folder of the export.
+    :param output_folder: The folder where all of the recordings are saved.
+    :param info_file: The filename of the metadata file in each run folder.
+    :param force: Whether every run should be exported again.
+
+    :return: None.
+    """
+    require_pyarrow()
+    started = time.time()
+    connection = open_export_state(export_dir)
+    num_runs = 0
+    num_recordings = 0
+    for username, run_date, run_path in iter_run_folders(output_folder):
+        exported = export_run_folder(connection, export_dir, username, run_date, run_path, info_file, force)
+        if exported > 0:
+            num_runs += 1
+            num_recordings += exported
+    connection.close()
+    print_log(
+        f"Exported {num_recordings} recordings from {num_runs} new or changed runs "
+        f"in {time.time() - started:.1f} seconds."
+    )
+
+
+def get_export_filter(
+    username: Optional[str] = None,
+    device: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> Optional["ds.Expression"]:
+    """
+    Builds the filter of a query. The username and the months of the date range select the partitions (so the
+    other folders are never opened), and the device and the days are checked against the statistics of each
+    row group before it is read.
+
+    :param username: Only keep recordings of this user.
+    :param device: Only keep recordings from this device (exact match).
+    :param since: Only keep recordings made on or after this date (YYYY-MM-DD).
+    :param until: Only keep recordings made on or before this date (YYYY-MM-DD).
+
+    :return: The filter, or None if there is nothing to filter on.
+    """
+    conditions = []
+    if username:
+        conditions.append(ds.field("username") == username)
+    if since:
+        conditions.append(ds.field("month") >= since[:7])
+        conditions.append(ds.field("recorded_on") >= pa.scalar(datetime.date.fromisoformat(since), pa.date32()))
+    if until:
+        conditions.append(ds.field("month") <= until[:7])
+        conditions.append(ds.field("recorded_on") <= pa.scalar(datetime.date.fromisoformat(until), pa.date32()))
+    if device:
+        conditions.append(ds.field("device") == device)
+    if len(conditions) == 0:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+
+def query_export(
+    export_dir: str,
+    username: Optional[str] = None,
+    device: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    columns: Optional[List[str]] = None,
+) -> "pa.Table":
+    """
+    Reads the exported recordings that match all of the given filters (see get_export_filter), once each (see
+    get_latest_recordings).
+
+    :param export_dir: The folder of the export.
+    :param username: Only return recordings of this user.
+    :param device: Only return recordings from this device (exact match).
+    :param since: Only return recordings made on or after this date (YYYY-MM-DD).
+    :param until: Only return recordings made on or before this date (YYYY-MM-DD).
+    :param columns: The columns to read. If None, then every column.
+
+    :return: The matching recordings, as a pyarrow Table.
+    """
+    require_pyarrow()
+    partitioning = get_partitioning()
+    schema = pa.unify_schemas([get_export_schema(), partitioning.schema])
+    dataset = ds.dataset(export_dir, schema=schema, format="parquet", partitioning=partitioning)
+    read_columns = None
+    if columns is not None:
+        read_columns = list(columns) + [column for column in DEDUPLICATION_COLUMNS if column not in columns]
+    table = dataset.to_table(columns=read_columns, filter=get_export_filter(username, device, since, until))
+    table = get_latest_recordings(table)
+    return table.select(columns) if columns is not None else table
+
+
+def get_latest_recordings(table: "pa.Table") -> "pa.Table":
+    """
+    Keeps one row per recording: the one from the latest run of the user. Recordings are told apart by their
+    audio ID, or by their div_id if they have none. Rows that have neither are all kept.
+
+    :param table: Exported rows, with at least the DEDUPLICATION_COLUMNS.
+
+    :return: The rows of the table, without the copies of a recording from earlier runs.
+    """
+    row_numbers = pa.array(range(table.num_rows), pa.int64())
+    recording_key = pc.coalesce(table["audio_id"], table["div_id"], pc.cast(row_numbers, pa.string()))
+    rows = pa.table(
+        {
+            "username": table["username"],
+            "recording_key": recording_key,
+            "run_date": table["run_date"],
+            "trial": table["trial"],
+            "row_number": row_numbers,
+        }
+    )
+    rows = rows.sort_by([("run_date", "descending"), ("trial", "descending")])
+    rows = rows.append_column("order", pa.array(range(rows.num_rows), pa.int64()))
+    latest = rows.group_by(["username", "recording_key"]).aggregate([("order", "min")])
+    latest_row_numbers = pc.take(rows["row_number"], latest["order_min"])
+    return table.take(pc.take(latest_row_numbers, pc.sort_indices(latest_row_numbers)))
+
+
+def count_recordings(
+    export_dir: str,
+    group_by: List[str],
+    username: Optional[str] = None,
+    device: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Counts the exported recordings (and adds up their file sizes) per group, reading only the columns that are
+    needed.
+
+    :param export_dir: The folder of the export.
+    :param group_by: The columns to group by (from GROUP_BY_COLUMNS).
+    :param username: Only count recordings of this user.
+    :param device: Only count recordings from this device (exact match).
+    :param since: Only count recordings made on or after this date (YYYY-MM-DD).
+    :param until: Only count recordings made on or before this date (YYYY-MM-DD).
+
+    :return: A dictionary per group, with the group_by columns, the "recordings" and the "bytes", sorted by
+        the group_by columns.
+    """
+    table = query_export(export_dir, username, device, since, until, columns=list(group_by) + ["trial", "file_size"])
+    counts = table.group_by(group_by).aggregate([("trial", "count"), ("file_size", "sum")])
+    names = {"trial_count": "recordings", "file_size_sum": "bytes"}
+    counts = counts.rename_columns([names.get(name, name) for name in counts.column_names])
+    return counts.sort_by([(column, "ascending") for column in group_by]).to_pylist()
+
+
+@click.group()
+def cli() -> None:
+    """
+    Exports the recording metadata of every run to parquet files partitioned by user and month, and counts
+    recordings from them.
+    """
+
+
+@cli.command()
+@click.option(
+    "--export",
+    type=str,
+    help="specify the directory of the export",
+    required=False,
+    default="recordings_export",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify the directory where the recordings are saved",
+    required=False,
+    default="recordings",
+)
+@click.option(
+    "-i",
+    "--info",
+    type=str,
+    help="specify the filename of the recording info",
+    required=False,
+    default="recordinginfo.json",
+)
+@click.option("--force", is_flag=True, help="export every run again, even unchanged ones.")
+def build(export: str, output: str, info: str, force: bool) -> None:
+    """
+    Exports every run that is new or has changed since the last export.
+    """
+    try:
+        build_export(export, output, info.split("/")[-1], force)
+    except ImportError as e:
+        print_log(f"ERROR: {e}")
+
+
+@cli.command()
+@click.option(
+    "--export",
+    type=str,
+    help="specify the directory of the export",
+    required=False,
+    default="recordings_export",
+)
+@click.option(
+    "--by",
+    type=click.Choice(GROUP_BY_COLUMNS),
+    multiple=True,
+    help="count per user, month, device or day (can be given more than once). Default: per device.",
+)
+@click.option("--user", type=str, help="only count recordings of this user.")
+@click.option("--device", type=str, help="only count recordings from this device.")
+@click.option("--since", type=str, help="only count recordings made on or after this date (YYYY-MM-DD).")
+@click.option("--until", type=str, help="only count recordings made on or before this date (YYYY-MM-DD).")
+@click.option("--json", "as_json", is_flag=True, help="print every group as a json line.")
+def count(
+    export: str,
+    by: Tuple[str, ...],
+    user: Optional[str],
+    device: Optional[str],
+    since: Optional[str],
+    until: Optional[str],
+    as_json: bool,
+) -> None:
+    """
+    Prints the number of recordings (and their size) per group.
+    """
+    if not os.path.isdir(export):
+        print_log(f"ERROR: The export {export} does not exist. Run \"./analytics_export.py build\" first.")
+        return
+    try:
+        started = time.time()
+        counts = count_recordings(export, list(by) or ["device"], user, device, since, until)
+    except ImportError as e:
+        print_log(f"ERROR: {e}")
+        return
+    elapsed = time.time() - started
+
+    for group in counts:
+        if as_json:
+            print(json.dumps(group, default=str))
+        else:
+            keys = " | ".join(str(group[column]) for column in (list(by) or ["device"]))
+            print(f"{keys} | {group['recordings']} recordings | {(group['bytes'] or 0) / 1024 / 1024:.1f} MB")
+    if not as_json:
+        print_log(f"{len(counts)} groups counted in {elapsed * 1000:.1f} ms.")
+
+
+if __name__ == "__main__":
+    cli()
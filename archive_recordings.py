@@ -0,0 +1,309 @@
+#!venv/bin/python
+
+import hashlib
+import json
+import mmap
+import os
+import sys
+import time
+from typing import Dict, Any, List, Optional
+
+import click
+
+from audio_compression import get_compressed_path
+from mirror_recordings import journal_run_files
+from run_manifest import (
+    load_manifest,
+    split_run_path,
+    run_key,
+    set_run_status,
+    get_run_history,
+    get_run_statuses,
+    RUN_ARCHIVED,
+    RUN_COMPLETE,
+    RUN_PARTIAL,
+    ERROR_FILE_NAME,
+)
+from utils import print_log, get_old_metadata, get_recording_files, iter_run_folders
+
+PACK_FILE_NAME = "recordings.pack"
+PACK_MAGIC = b"ALXPACK1"
+FOOTER_SIZE = 8 + 8 + len(PACK_MAGIC)
+COPY_CHUNK_SIZE = 1 << 20
+
+
+class PackReader:
+    """
+    Reads single files out of a run's pack file without unpacking it. The pack is memory-mapped, so only
+    the pages of the files that are read are loaded.
+
+    A pack is laid out as: PACK_MAGIC, the contents of every file one after the other, a json index of
+    {"files": {name: {"offset", "size", "sha256"}}, "audio_ids": {audio_id: name}}, and a footer with the
+    offset and length of the index followed by PACK_MAGIC again.
+    """
+
+    def __init__(self, pack_path: str) -> None:
+        self.pack_path = pack_path
+        self._file = open(pack_path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        footer = self._map[-FOOTER_SIZE:]
+        is_pack = (
+            len(self._map) >= len(PACK_MAGIC) + FOOTER_SIZE
+            and self._map[:len(PACK_MAGIC)] == PACK_MAGIC
+            and footer[16:] == PACK_MAGIC
+        )
+        if not is_pack:
+            self.close()
+            raise ValueError(f"{pack_path} is not a recordings pack.")
+        index_offset = int.from_bytes(footer[0:8], "little")
+        index_size = int.from_bytes(footer[8:16], "little")
+        self.index = json.loads(self._map[index_offset:index_offset + index_size])
+
+    def names(self) -> List[str]:
+        """
+        :return: The names of all files in the pack.
+        """
+        return list(self.index["files"].keys())
+
+    def read(self, name: str) -> memoryview:
+        """
+        :param name: Name of the file in the pack, such as "0.wav".
+
+        :return: The contents of the file, as a view into the memory-mapped pack.
+        """
+        entry = self.index["files"][name]
+        return memoryview(self._map)[entry["offset"]:entry["offset"] + entry["size"]]
+
+    def read_audio(self, audio_id: str) -> memoryview:
+        """
+        :param audio_id: The audio ID of the recording.
+
+        :return: The contents of the recording's wav file (or of its compressed copy, if it was compressed).
+        """
+        return self.read(self.index["audio_ids"][audio_id])
+
+    def close(self) -> None:
+        """
+        Closes the memory map and the pack file.
+        """
+        if getattr(self, "_map", None) is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self) -> "PackReader":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def is_complete_run(run_path: str, info_file: str, run_statuses: Optional[Dict[str, str]] = None) -> bool:
+    """
+    :param run_path: The run folder path.
+    :param info_file: The filename of the metadata file in the run folder.
+    :param run_statuses: The statuses of the runs of the user (see get_run_statuses), so that the run log does
+        not have to be read again for every run. If None, then the run log is read.
+
+    :return: Whether the run finished without errors and is not still being written to. A run in the run log
+        has to have completed; the folder is only checked for the runs that were saved before the run log
+        existed.
+    """
+    if not os.path.isfile(os.path.join(run_path, info_file)):
+        return False
+    user_folder, date_folder_name, trial = split_run_path(run_path)
+    key = run_key(date_folder_name, trial)
+    if run_statuses is None:
+        run_statuses = get_run_statuses(user_folder)
+    status = run_statuses.get(key)
+    if status is not None:
+        return status in (RUN_COMPLETE, RUN_PARTIAL)
+    if os.path.exists(os.path.join(run_path, ERROR_FILE_NAME)):
+        return False
+    manifest = load_manifest(user_folder)
+    return key != manifest["latest_run"] or key == manifest["latest_complete_run"]
+
+
+def pack_run(run_path: str, info_file: str) -> Optional[str]:
+    """
+    Packs every file of a run into one pack file and then deletes the packed wav files. The metadata and the
+    other small json files are kept next to the pack (and are in the pack as well), so the run can still be
+    found, deduplicated against and indexed.
+
+    :param run_path: The run folder path.
+    :param info_file: The filename of the metadata file in the run folder.
+
+    :return: The path of the pack, or None if the run was already packed or has no files.
+    """
+    pack_path = os.path.join(run_path, PACK_FILE_NAME)
+    if os.path.exists(pack_path):
+        return None
+    names = sorted(
+        entry.name for entry in os.scandir(run_path) if entry.is_file() and not entry.name.startswith(".")
+    )
+    if len(names) == 0:
+        return None
+
+    metadata = get_old_metadata(os.path.join(run_path, info_file))
+    audio_ids = {}
+    for audio_id, file_path in get_recording_files(metadata, run_path).items():
+        for name in [os.path.basename(file_path), os.path.basename(get_compressed_path(file_path))]:
+            if name in names:
+                audio_ids[audio_id] = name
+                break
+
+    temporary_path = f"{pack_path}.{os.getpid()}.tmp"
+    files: Dict[str, Dict[str, Any]] = {}
+    with open(temporary_path, "wb") as pack:
+        pack.write(PACK_MAGIC)
+        for name in names:
+            checksum = hashlib.sha256()
+            offset = pack.tell()
+            with open(os.path.join(run_path, name), "rb") as f:
+                for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+                    checksum.update(chunk)
+                    pack.write(chunk)
+            files[name] = {"offset": offset, "size": pack.tell() - offset, "sha256": checksum.hexdigest()}
+
+        index = json.dumps({"files": files, "audio_ids": audio_ids}).encode("utf-8")
+        index_offset = pack.tell()
+        pack.write(index)
+        pack.write(index_offset.to_bytes(8, "little") + len(index).to_bytes(8, "little") + PACK_MAGIC)
+        pack.flush()
+        os.fsync(pack.fileno())
+
+    # Check that every file can be read back from the pack before deleting anything.
+    with PackReader(temporary_path) as reader:
+        for name, entry in files.items():
+            if hashlib.sha256(reader.read(name)).hexdigest() != entry["sha256"]:
+                os.remove(temporary_path)
+                raise IOError(f"{name} does not match its copy in the pack for {run_path}.")
+    os.replace(temporary_path, pack_path)
+    journal_run_files(run_path, [PACK_FILE_NAME])
+
+    for name in names:
+        if not name.endswith(".json"):
+            os.remove(os.path.join(run_path, name))
+    set_run_status(run_path, RUN_ARCHIVED)
+    return pack_path
+
+
+def get_status_before_archiving(run_path: str) -> str:
+    """
+    :param run_path: The run folder path.
+
+    :return: The status that the run had before it was packed. Runs that were saved before the run log existed
+        were complete (see is_complete_run).
+    """
+    user_folder, date_folder_name, trial = split_run_path(run_path)
+    statuses = get_run_history(user_folder).get(run_key(date_folder_name, trial), [])
+    earlier_statuses = [status for status in statuses if status != RUN_ARCHIVED]
+    return earlier_statuses[-1] if len(earlier_statuses) > 0 else RUN_COMPLETE
+
+
+def unpack_run(run_path: str) -> None:
+    """
+    Restores the normal folder layout of a packed run, deletes the pack and gives the run back the status it had
+    before it was packed.
+
+    :param run_path: The run folder path.
+
+    :return: None.
+    """
+    pack_path = os.path.join(run_path, PACK_FILE_NAME)
+    with PackReader(pack_path) as reader:
+        for name in reader.names():
+            file_path = os.path.join(run_path, name)
+            if os.path.exists(file_path):
+                continue
+            with open(file_path, "wb") as f:
+                f.write(reader.read(name))
+    os.remove(pack_path)
+    set_run_status(run_path, get_status_before_archiving(run_path))
+    print_log(f"Unpacked {run_path}.")
+
+
+@click.group()
+def cli() -> None:
+    """
+    Packs completed runs into single indexed pack files, reads recordings out of packs, and unpacks them.
+    """
+
+
+@cli.command()
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify the directory where the recordings are saved",
+    required=False,
+    default="recordings",
+)
+@click.option(
+    "-i",
+    "--info",
+    type=str,
+    help="specify the filename of the recording info",
+    required=False,
+    default="recordinginfo.json",
+)
+@click.option(
+    "--older-than",
+    type=int,
+    default=0,
+    help="only pack runs whose date is at least this many days ago.",
+)
+def pack(output: str, info: str, older_than: int) -> None:
+    """
+    Packs every completed run that is not packed yet.
+    """
+    started = time.time()
+    info_file = info.split("/")[-1]
+    cutoff = time.strftime("%Y-%m-%d", time.localtime(time.time() - older_than * 24 * 60 * 60))
+    num_packed = 0
+    # The runs of a user come one after the other, so the user's run log is only read once, not once per run.
+    user_folder = None
+    run_statuses: Dict[str, str] = {}
+    for _, run_date, run_path in iter_run_folders(output):
+        if run_date > cutoff:
+            continue
+        if split_run_path(run_path)[0] != user_folder:
+            user_folder = split_run_path(run_path)[0]
+            run_statuses = get_run_statuses(user_folder)
+        if not is_complete_run(run_path, info_file, run_statuses):
+            continue
+        if pack_run(run_path, info_file) is not None:
+            num_packed += 1
+    print_log(f"Packed {num_packed} runs in {time.time() - started:.1f} seconds.")
+
+
+@cli.command()
+@click.argument("run_path", type=str)
+def unpack(run_path: str) -> None:
+    """
+    Restores the normal folder layout of the packed run at RUN_PATH.
+    """
+    unpack_run(run_path)
+
+
+@cli.command()
+@click.argument("run_path", type=str)
+@click.argument("audio_id", type=str)
+@click.option("--out", type=str, help="file to write the recording to (default: standard output).")
+def read(run_path: str, audio_id: str, out: Optional[str]) -> None:
+    """
+    Writes the recording with AUDIO_ID from the packed run at RUN_PATH.
+    """
+    with PackReader(os.path.join(run_path, PACK_FILE_NAME)) as reader:
+        data = reader.read_audio(audio_id)
+        if out is None:
+            sys.stdout.buffer.write(data)
+        else:
+            with open(out, "wb") as f:
+                f.write(data)
+        data.release()
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,351 @@
+#!venv/bin/python
+
+import hashlib
+import lzma
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Optional
+
+import click
+import numpy as np
+
+from mirror_recordings import journal_run_files
+from utils import (
+    print_log,
+    parse_wav_header,
+    get_old_metadata,
+    get_recording_files,
+    iter_run_folders,
+    write_json_atomically,
+)
+
+COMPRESSED_EXTENSION = ".wavz"
+WAVZ_MAGIC = b"ALXWAVZ1"
+CODEC_LZMA = 0
+# Codecs 1 and 2 store the first or second differences of 16-bit PCM samples.
+CODEC_DELTA_PCM16 = 1
+CODEC_DELTA2_PCM16 = 2
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6}]
+
+
+def get_compressed_path(wav_path: str) -> str:
+    """
+    :param wav_path: Path of the wav file.
+
+    :return: Path of the compressed copy of the wav file ("0.wav" -> "0.wavz").
+    """
+    return os.path.splitext(wav_path)[0] + COMPRESSED_EXTENSION
+
+
+def encode_delta_pcm16(payload: bytes, channels: int, order: int) -> bytes:
+    """
+    Replaces the 16-bit samples of every channel by their order-th differences (wrapping around, so that the
+    transform is exactly reversible) and stores the low bytes before the high bytes. Speech changes slowly
+    from sample to sample, so the differences are small and compress much better than the samples.
+
+    :param payload: The sample data of the wav file.
+    :param channels: Number of interleaved channels.
+    :param order: How many times the differences are taken (1 or 2).
+
+    :return: The transformed sample data.
+    """
+    residuals = np.frombuffer(payload, dtype="<i2").reshape(-1, channels).astype(np.int16)
+    for _ in range(order):
+        differences = np.empty_like(residuals)
+        differences[0] = residuals[0]
+        np.subtract(residuals[1:], residuals[:-1], out=differences[1:])
+        residuals = differences
+    return residuals.reshape(-1).view(np.uint8).reshape(-1, 2).T.tobytes()
+
+
+def decode_delta_pcm16(encoded: bytes, channels: int, order: int) -> bytes:
+    """
+    Reverses encode_delta_pcm16.
+
+    :param encoded: The transformed sample data.
+    :param channels: Number of interleaved channels.
+    :param order: How many times the differences were taken.
+
+    :return: The original sample data.
+    """
+    planes = np.frombuffer(encoded, dtype=np.uint8).reshape(2, -1)
+    samples = np.ascontiguousarray(planes.T).view("<i2").reshape(-1, channels)
+    for _ in range(order):
+        samples = np.cumsum(samples, axis=0, dtype=np.int16)
+    return samples.astype("<i2").tobytes()
+
+
+def choose_delta_order(payload: bytes, channels: int) -> int:
+    """
+    :param payload: The sample data of the wav file.
+    :param channels: Number of interleaved channels.
+
+    :return: The difference order (1 or 2) that leaves the smallest residuals for this recording.
+    """
+    samples = np.frombuffer(payload, dtype="<i2").reshape(-1, channels).astype(np.int32)
+    first = np.diff(samples, axis=0)
+    second = np.diff(first, axis=0)
+    return 2 if np.abs(second).mean() < np.abs(first).mean() else 1
+
+
+def compress_wav_bytes(data: bytes) -> bytes:
+    """
+    Compresses a wav file losslessly. The bytes before and after the sample data are stored as they are, so
+    decompress_wav_bytes gives back the exact same file.
+
+    The compressed layout is: WAVZ_MAGIC, the codec (1 byte), the channel count (2 bytes), the sha256 of the
+    original file (32 bytes), the lengths of the prefix, the compressed samples and the suffix (8 bytes each),
+    and then the prefix, the compressed samples and the suffix.
+
+    :param data: The contents of the wav file.
+
+    :return: The compressed file.
+    """
+    header = parse_wav_header(data)
+    if header is None:
+        prefix, payload, suffix = b"", data, b""
+        codec, channels = CODEC_LZMA, 1
+    else:
+        data_end = header["data_offset"] + header["data_size"]
+        prefix = data[:header["data_offset"]]
+        payload = data[header["data_offset"]:data_end]
+        suffix = data[data_end:]
+        is_pcm16 = (
+            header["audio_format"] == 1
+            and header["bits_per_sample"] == 16
+            and header["block_align"] == 2 * header["channels"]
+            and len(payload) % header["block_align"] == 0
+            and len(payload) >= 3 * header["block_align"]
+        )
+        channels = header["channels"] if is_pcm16 else 1
+        if is_pcm16:
+            codec = CODEC_DELTA2_PCM16 if choose_delta_order(payload, channels) == 2 else CODEC_DELTA_PCM16
+        else:
+            codec = CODEC_LZMA
+
+    if codec in (CODEC_DELTA_PCM16, CODEC_DELTA2_PCM16):
+        payload = encode_delta_pcm16(payload, channels, order=codec)
+    compressed = lzma.compress(payload, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+
+    return b"".join(
+        [
+            WAVZ_MAGIC,
+            codec.to_bytes(1, "little"),
+            channels.to_bytes(2, "little"),
+            hashlib.sha256(data).digest(),
+            len(prefix).to_bytes(8, "little"),
+            len(compressed).to_bytes(8, "little"),
+            len(suffix).to_bytes(8, "little"),
+            prefix,
+            compressed,
+            suffix,
+        ]
+    )
+
+
+def decompress_wav_bytes(compressed: bytes) -> bytes:
+    """
+    Reverses compress_wav_bytes and checks the result against the checksum of the original file.
+
+    :param compressed: The compressed file.
+
+    :return: The original wav file, bit for bit.
+    """
+    if compressed[:len(WAVZ_MAGIC)] != WAVZ_MAGIC:
+        raise ValueError("This is not a compressed recording.")
+    position = len(WAVZ_MAGIC)
+    codec = compressed[position]
+    channels = int.from_bytes(compressed[position + 1:position + 3], "little")
+    checksum = compressed[position + 3:position + 35]
+    position += 35
+    prefix_size, compressed_size, suffix_size = (
+        int.from_bytes(compressed[position + 8 * i:position + 8 * (i + 1)], "little") for i in range(3)
+    )
+    position += 24
+
+    prefix = compressed[position:position + prefix_size]
+    position += prefix_size
+    payload = lzma.decompress(
+        compressed[position:position + compressed_size], format=lzma.FORMAT_RAW, filters=LZMA_FILTERS
+    )
+    position += compressed_size
+    suffix = compressed[position:position + suffix_size]
+
+    if codec in (CODEC_DELTA_PCM16, CODEC_DELTA2_PCM16):
+        payload = decode_delta_pcm16(payload, channels, order=codec)
+    data = prefix + payload + suffix
+    if hashlib.sha256(data).digest() != checksum:
+        raise ValueError("The decompressed recording does not match the checksum of the original.")
+    return data
+
+
+def compress_file(wav_path: str, remove_original: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Writes a compressed copy of a wav file next to it, after checking that the copy decompresses back into
+    the original.
+
+    :param wav_path: Path of the wav file.
+    :param remove_original: Whether the wav file should be deleted once the compressed copy is written.
+
+    :return: The "original_size", "compressed_size" and "sha256" (of the original) of the recording, or None if
+        the file does not exist.
+    """
+    if not os.path.isfile(wav_path):
+        return None
+    with open(wav_path, "rb") as f:
+        data = f.read()
+    compressed = compress_wav_bytes(data)
+    if decompress_wav_bytes(compressed) != data:
+        raise ValueError(f"{wav_path} does not survive compression.")
+
+    compressed_path = get_compressed_path(wav_path)
+    temporary_path = f"{compressed_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(compressed)
+    os.replace(temporary_path, compressed_path)
+    if remove_original:
+        os.remove(wav_path)
+
+    return {
+        "original_size": len(data),
+        "compressed_size": len(compressed),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+
+def restore_file(compressed_path: str, wav_path: Optional[str] = None) -> str:
+    """
+    Writes the original wav file of a compressed recording.
+
+    :param compressed_path: Path of the compressed recording.
+    :param wav_path: Path to write the wav file to. Defaults to the compressed path with a .wav extension.
+
+    :return: The path of the restored wav file.
+    """
+    wav_path = os.path.splitext(compressed_path)[0] + ".wav" if wav_path is None else wav_path
+    with open(compressed_path, "rb") as f:
+        data = decompress_wav_bytes(f.read())
+    with open(wav_path, "wb") as f:
+        f.write(data)
+    return wav_path
+
+
+def remove_compressed_originals(metadata: List[Dict[str, Any]], recording_path: str) -> None:
+    """
+    Deletes the wav files whose compressed copies are recorded in the metadata.
+
+    :param metadata: The metadata information for all of the recordings of one run.
+    :param recording_path: Directory path where the recordings of that run are saved.
+
+    :return: None.
+    """
+    for audio_id, wav_path in get_recording_files(metadata, recording_path).items():
+        if os.path.isfile(get_compressed_path(wav_path)) and os.path.isfile(wav_path):
+            os.remove(wav_path)
+
+
+def compress_run(run_path: str, info_file: str, executor: ProcessPoolExecutor) -> int:
+    """
+    Compresses every wav file of a run that is not compressed yet, records the sizes and checksums in its
+    metadata and deletes the originals.
+
+    :param run_path: The run folder path.
+    :param info_file: The filename of the metadata file in the run folder.
+    :param executor: The process pool to compress the recordings in.
+
+    :return: The number of recordings that were compressed.
+    """
+    metadata_path = os.path.join(run_path, info_file)
+    metadata = get_old_metadata(metadata_path)
+    recording_files = {
+        audio_id: wav_path
+        for audio_id, wav_path in get_recording_files(metadata, run_path).items()
+        if os.path.isfile(wav_path)
+    }
+    if len(recording_files) == 0:
+        return 0
+
+    results = dict(zip(recording_files.keys(), executor.map(compress_file, recording_files.values())))
+    for recording in metadata:
+        result = results.get(recording.get("audio_id"))
+        if result is not None:
+            recording.update(result)
+    write_json_atomically(metadata_path, metadata)
+    journal_run_files(
+        run_path,
+        [info_file] + [
+            os.path.basename(get_compressed_path(recording_files[audio_id]))
+            for audio_id, result in results.items()
+            if result is not None
+        ],
+    )
+    remove_compressed_originals(metadata, run_path)
+    return len(results)
+
+
+@click.group()
+def cli() -> None:
+    """
+    Compresses downloaded recordings losslessly, and restores the original wav files.
+    """
+
+
+@cli.command()
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify the directory where the recordings are saved",
+    required=False,
+    default="recordings",
+)
+@click.option(
+    "-i",
+    "--info",
+    type=str,
+    help="specify the filename of the recording info",
+    required=False,
+    default="recordinginfo.json",
+)
+@click.option(
+    "--workers",
+    type=int,
+    help="number of worker processes",
+    required=False,
+    default=os.cpu_count() or 1,
+)
+def compress(output: str, info: str, workers: int) -> None:
+    """
+    Compresses every recording in the recordings tree that is not compressed yet.
+    """
+    started = time.time()
+    info_file = info.split("/")[-1]
+    num_compressed = 0
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        for _, _, run_path in iter_run_folders(output):
+            if os.path.isfile(os.path.join(run_path, info_file)):
+                num_compressed += compress_run(run_path, info_file, executor)
+    print_log(f"Compressed {num_compressed} recordings in {time.time() - started:.1f} seconds.")
+
+
+@cli.command()
+@click.argument("path", type=str)
+def restore(path: str) -> None:
+    """
+    Restores the original wav files of the compressed recording at PATH, or of every compressed recording in
+    the run folder at PATH.
+    """
+    if os.path.isdir(path):
+        compressed_paths = [
+            os.path.join(path, name) for name in os.listdir(path) if name.endswith(COMPRESSED_EXTENSION)
+        ]
+    else:
+        compressed_paths = [path]
+    for compressed_path in compressed_paths:
+        restore_file(compressed_path)
+    print_log(f"Restored {len(compressed_paths)} recordings.")
+
+
+if __name__ == "__main__":
+    cli()
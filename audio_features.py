@@ -0,0 +1,253 @@
+#!venv/bin/python
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Optional
+
+import click
+import numpy as np
+
+from mirror_recordings import journal_run_files
+from utils import (
+    print_log,
+    parse_wav_header,
+    get_old_metadata,
+    get_recording_files,
+    iter_run_folders,
+    write_json_atomically,
+)
+
+HEADER_READ_SIZE = 1 << 16
+WINDOW_SECONDS = 0.02
+SILENCE_THRESHOLD_DB = -40.0
+
+
+def to_decibels(rms: np.ndarray) -> np.ndarray:
+    """
+    :param rms: RMS values of samples scaled to [-1, 1].
+
+    :return: The RMS values in dBFS. Digital silence is clipped to -120 dBFS.
+    """
+    return 20 * np.log10(np.maximum(rms, 1e-6))
+
+
+def load_samples(file_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Memory-maps the sample data of a wav file and scales it to floats in [-1, 1], mixed down to one channel.
+
+    :param file_path: Path of the wav file.
+
+    :return: None if the file is not a wav file with a supported sample format. Else, a dict with the
+        "samples" and the "sample_rate".
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        header = parse_wav_header(f.read(HEADER_READ_SIZE), file_size)
+    if header is None:
+        return None
+
+    channels = header["channels"]
+    bytes_per_sample = header["bits_per_sample"] // 8
+    num_frames = header["data_size"] // header["block_align"]
+    if num_frames == 0:
+        return {"samples": np.zeros(0, dtype=np.float32), "sample_rate": header["sample_rate"]}
+    if header["block_align"] != channels * bytes_per_sample:
+        return None
+
+    is_float = header["audio_format"] == 3
+    dtypes = {1: np.uint8, 2: np.int16, 4: np.float32 if is_float else np.int32}
+    if bytes_per_sample == 3:
+        raw = np.memmap(
+            file_path, dtype=np.uint8, mode="r", offset=header["data_offset"], shape=(num_frames * channels, 3)
+        )
+        # Sign-extend the little-endian 24-bit samples into 32-bit integers.
+        integers = (
+            raw[:, 0].astype(np.int32)
+            | (raw[:, 1].astype(np.int32) << 8)
+            | (raw[:, 2].astype(np.int8).astype(np.int32) << 16)
+        )
+        samples = integers.astype(np.float32) / float(1 << 23)
+    elif bytes_per_sample in dtypes:
+        raw = np.memmap(
+            file_path,
+            dtype=np.dtype(dtypes[bytes_per_sample]).newbyteorder("<"),
+            mode="r",
+            offset=header["data_offset"],
+            shape=(num_frames * channels,),
+        )
+        if bytes_per_sample == 1:
+            samples = (raw.astype(np.float32) - 128.0) / 128.0
+        elif is_float:
+            samples = np.asarray(raw, dtype=np.float32)
+        else:
+            samples = raw.astype(np.float32) / float(1 << (header["bits_per_sample"] - 1))
+    else:
+        return None
+
+    if channels > 1:
+        samples = samples.reshape(num_frames, channels).mean(axis=1)
+    return {"samples": samples, "sample_rate": header["sample_rate"]}
+
+
+def compute_features(file_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Computes the duration, sample rate, RMS loudness and silence ratio of a wav file. The silence ratio is the
+    share of 20 ms windows whose loudness is below SILENCE_THRESHOLD_DB.
+
+    :param file_path: Path of the wav file.
+
+    :return: The features of the recording, or None if the file is missing or is not a supported wav file.
+    """
+    try:
+        loaded = load_samples(file_path)
+    except (OSError, ValueError):
+        return None
+    if loaded is None:
+        return None
+
+    samples = loaded["samples"]
+    sample_rate = loaded["sample_rate"]
+    if len(samples) == 0:
+        return {"duration": 0.0, "sample_rate": sample_rate, "rms_db": None, "silence_ratio": 1.0}
+
+    window = max(1, int(sample_rate * WINDOW_SECONDS))
+    num_windows = max(1, len(samples) // window)
+    if len(samples) >= window:
+        windows = samples[: num_windows * window].reshape(num_windows, window)
+    else:
+        windows = samples.reshape(1, -1)
+    window_rms = np.sqrt(np.mean(np.square(windows, dtype=np.float64), axis=1))
+    overall_rms = np.sqrt(np.mean(np.square(samples, dtype=np.float64)))
+
+    return {
+        "duration": round(len(samples) / sample_rate, 3),
+        "sample_rate": sample_rate,
+        "rms_db": round(float(to_decibels(np.array([overall_rms]))[0]), 2),
+        "silence_ratio": round(float(np.mean(to_decibels(window_rms) < SILENCE_THRESHOLD_DB)), 4),
+    }
+
+
+def compute_features_batch(file_paths: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Computes the features of a batch of wav files in one worker, so that the cost of sending work to the
+    worker processes is shared by many small recordings.
+
+    :param file_paths: Paths of the wav files.
+
+    :return: The features of every file, in the same order.
+    """
+    return [compute_features(file_path) for file_path in file_paths]
+
+
+def analyze_recordings(
+    metadata: List[Dict[str, Any]],
+    recording_path: str,
+    executor: ProcessPoolExecutor,
+    batch_size: int = 256,
+) -> int:
+    """
+    Adds the "duration", "sample_rate", "rms_db" and "silence_ratio" of every downloaded recording to its
+    metadata.
+
+    :param metadata: The metadata information for all of the recordings of one run.
+    :param recording_path: Directory path where the recordings of that run are saved.
+    :param executor: The process pool to compute the features in.
+    :param batch_size: Number of recordings that each worker analyzes at a time.
+
+    :return: The number of recordings that were analyzed.
+    """
+    recording_files = get_recording_files(metadata, recording_path)
+    audio_ids = list(recording_files.keys())
+    file_paths = list(recording_files.values())
+    batches = [file_paths[i:i + batch_size] for i in range(0, len(file_paths), batch_size)]
+
+    features_by_audio_id = {}
+    for batch_start, batch_features in zip(
+        range(0, len(file_paths), batch_size), executor.map(compute_features_batch, batches)
+    ):
+        for offset, features in enumerate(batch_features):
+            if features is not None:
+                features_by_audio_id[audio_ids[batch_start + offset]] = features
+
+    for recording in metadata:
+        features = features_by_audio_id.get(recording.get("audio_id"))
+        if features is not None:
+            recording.update(features)
+    return len(features_by_audio_id)
+
+
+def analyze_run(recording_path: str, info_file: str, workers: int, batch_size: int = 256) -> None:
+    """
+    Analyzes the recordings of one run and writes the features into its metadata file.
+
+    :param recording_path: Directory path where the recordings of the run are saved.
+    :param info_file: The filename of the metadata file in the run folder.
+    :param workers: Number of worker processes.
+    :param batch_size: Number of recordings that each worker analyzes at a time.
+
+    :return: None.
+    """
+    metadata_path = os.path.join(recording_path, info_file)
+    metadata = get_old_metadata(metadata_path)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        num_analyzed = analyze_recordings(metadata, recording_path, executor, batch_size)
+    write_json_atomically(metadata_path, metadata)
+    journal_run_files(recording_path, [info_file])
+    print_log(f"Analyzed {num_analyzed} recordings in {recording_path}.")
+
+
+@click.command()
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify the directory where the recordings are saved",
+    required=False,
+    default="recordings",
+)
+@click.option(
+    "-i",
+    "--info",
+    type=str,
+    help="specify the filename of the recording info",
+    required=False,
+    default="recordinginfo.json",
+)
+@click.option(
+    "--workers",
+    type=int,
+    help="number of worker processes",
+    required=False,
+    default=os.cpu_count() or 1,
+)
+@click.option("--batch-size", type=int, default=256, help="number of recordings analyzed per batch.")
+@click.option("--force", is_flag=True, help="analyze runs again even if they already have audio features.")
+def main(output: str, info: str, workers: int, batch_size: int, force: bool) -> None:
+    """
+    This script adds the duration, sample rate, RMS loudness (dBFS) and silence ratio of every recording to the
+    recording info of runs that were downloaded without "--analyze".
+    """
+    started = time.time()
+    info_file = info.split("/")[-1]
+    num_runs = 0
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        for _, _, run_path in iter_run_folders(output):
+            metadata_path = os.path.join(run_path, info_file)
+            if not os.path.isfile(metadata_path):
+                continue
+            metadata = get_old_metadata(metadata_path)
+            already_analyzed = all(
+                "duration" in recording for recording in metadata if recording.get("audio_id") is not None
+            )
+            if already_analyzed and not force:
+                continue
+            analyze_recordings(metadata, run_path, executor, batch_size)
+            write_json_atomically(metadata_path, metadata)
+            journal_run_files(run_path, [info_file])
+            num_runs += 1
+    print_log(f"Analyzed {num_runs} runs in {time.time() - started:.1f} seconds.")
+
+
+if __name__ == "__main__":
+    main()
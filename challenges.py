@@ -0,0 +1,238 @@
+#!venv/bin/python
+
+import json
+import os
+import time
+from typing import Dict, Any, List, Optional
+
+import click
+
+from utils import print_log, write_json_atomically
+from work_queue import get_account_key
+
+PENDING_FOLDER = "pending"
+ANSWERS_FOLDER = "answers"
+
+CAPTCHA_CHALLENGE = "captcha"
+TWO_STEP_CHALLENGE = "two_step"
+EMAIL_CHALLENGE = "email"
+# The login steps that can stop to ask the operator, in the order in which amazon.com asks for them.
+CHALLENGE_STEPS = [CAPTCHA_CHALLENGE, TWO_STEP_CHALLENGE, EMAIL_CHALLENGE]
+
+DEFAULT_CHALLENGE_TIMEOUT_SECONDS = 4 * 60 * 60
+CHALLENGE_POLL_SECONDS = 10
+
+
+class Challenge:
+    """
+    A login step of one account that needs the operator: a captcha to read, a two-step verification code to
+    enter, or a sign-in email to approve.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        username: str,
+        kind: str,
+        prompt: str,
+        url: str,
+        created: float,
+        image_path: Optional[str] = None,
+    ) -> None:
+        self.key = key
+        self.username = username
+        self.kind = kind
+        self.prompt = prompt
+        self.url = url
+        self.created = created
+        self.image_path = image_path
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "key": self.key,
+            "username": self.username,
+            "kind": self.kind,
+            "prompt": self.prompt,
+            "url": self.url,
+            "created": self.created,
+            "image_path": self.image_path,
+        }
+
+
+class ChallengePending(Exception):
+    """
+    Raised by a login step instead of waiting for the operator, so that the account can be parked (with its
+    driver kept on the challenge page) while the other accounts keep running.
+    """
+
+    def __init__(self, challenge: Challenge) -> None:
+        super().__init__(f"{challenge.username} is waiting on a {challenge.kind} challenge ({challenge.key}).")
+        self.challenge = challenge
+
+
+class ChallengeQueue:
+    """
+    The challenges that are waiting on the operator, kept in a directory: one json file per challenge in
+    "pending" (next to the captcha image, if there is one), and one text file per answer in "answers". The
+    operator answers with `python challenges.py answer`, or by writing the answer into answers/<key>.txt.
+    """
+
+    def __init__(self, challenges_dir: str) -> None:
+        self.challenges_dir = challenges_dir
+        for folder in [PENDING_FOLDER, ANSWERS_FOLDER]:
+            os.makedirs(os.path.join(challenges_dir, folder), exist_ok=True)
+
+    def _path(self, folder: str, key: str, extension: str) -> str:
+        return os.path.join(self.challenges_dir, folder, key + extension)
+
+    def post(
+        self, username: str, kind: str, prompt: str, url: str, image: Optional[bytes] = None
+    ) -> Challenge:
+        """
+        Adds a challenge for the operator to answer.
+
+        :param username: The username of the account.
+        :param kind: The kind of challenge (one of CHALLENGE_STEPS).
+        :param prompt: What the operator needs to do.
+        :param url: The url of the page that the driver is waiting on.
+        :param image: The captcha image, if there is one.
+
+        :return: The challenge.
+        """
+        created = time.time()
+        key = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(created))}-{kind}-{get_account_key(username)[:8]}"
+        image_path = None
+        if image is not None:
+            image_path = self._path(PENDING_FOLDER, key, ".jpg")
+            with open(image_path, "wb") as f:
+                f.write(image)
+        challenge = Challenge(key, username, kind, prompt, url, created, image_path)
+        write_json_atomically(self._path(PENDING_FOLDER, key, ".json"), challenge.to_dict())
+        return challenge
+
+    def pending(self) -> List[Challenge]:
+        """
+        :return: The challenges that have not been answered yet, oldest first.
+        """
+        challenges = []
+        pending_dir = os.path.join(self.challenges_dir, PENDING_FOLDER)
+        for file_name in sorted(os.listdir(pending_dir)):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(pending_dir, file_name), "r") as f:
+                    challenge = Challenge(**json.load(f))
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            if self.get_answer(challenge) is None:
+                challenges.append(challenge)
+        return challenges
+
+    def get_answer(self, challenge: Challenge) -> Optional[str]:
+        """
+        :param challenge: The challenge.
+
+        :return: The operator's answer, or None if the challenge has not been answered.
+        """
+        try:
+            with open(self._path(ANSWERS_FOLDER, challenge.key, ".txt"), "r") as f:
+                answer = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return answer if len(answer) > 0 else None
+
+    def answer(self, key: str, answer: str) -> None:
+        """
+        Answers a challenge.
+
+        :param key: The key of the challenge.
+        :param answer: The captcha guess, the verification code, or anything (such as "done") for an email
+            challenge that was approved.
+
+        :return: None.
+        """
+        answer_path = self._path(ANSWERS_FOLDER, key, ".txt")
+        temporary_path = answer_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            f.write(answer.strip() + "\n")
+        os.replace(temporary_path, answer_path)
+
+    def resolve(self, challenge: Challenge) -> None:
+        """
+        Removes a challenge (and its answer and image) once its account has used the answer.
+
+        :param challenge: The challenge.
+
+        :return: None.
+        """
+        for path in [
+            self._path(PENDING_FOLDER, challenge.key, ".json"),
+            self._path(ANSWERS_FOLDER, challenge.key, ".txt"),
+            challenge.image_path,
+        ]:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+
+@click.group()
+def cli() -> None:
+    """
+    Lists and answers the login challenges that parked accounts are waiting on.
+    """
+
+
+@cli.command(name="list")
+@click.option(
+    "--challenges-dir",
+    type=str,
+    help="specify the folder of the challenge queue",
+    required=False,
+    default="challenges",
+)
+def list_challenges(challenges_dir: str) -> None:
+    """
+    Lists the challenges that are waiting on an answer.
+    """
+    challenges = ChallengeQueue(challenges_dir).pending()
+    if len(challenges) == 0:
+        print_log("No challenges are waiting.")
+    for challenge in challenges:
+        waiting_minutes = (time.time() - challenge.created) / 60
+        image = f" (image: {challenge.image_path})" if challenge.image_path is not None else ""
+        print_log(f"{challenge.key} [{waiting_minutes:.0f} min]: {challenge.prompt}{image}")
+
+
+@cli.command()
+@click.argument("key", type=str, required=False)
+@click.argument("text", type=str, required=False)
+@click.option(
+    "--challenges-dir",
+    type=str,
+    help="specify the folder of the challenge queue",
+    required=False,
+    default="challenges",
+)
+def answer(key: Optional[str], text: Optional[str], challenges_dir: str) -> None:
+    """
+    Answers the challenge KEY with TEXT. Without arguments, prompts for the answer of every waiting challenge
+    (leave an answer empty to skip the challenge).
+    """
+    queue = ChallengeQueue(challenges_dir)
+    if key is not None:
+        queue.answer(key, text if text is not None else print_log(f"Answer for {key}: ", input_flag=True))
+        return
+
+    challenges = queue.pending()
+    if len(challenges) == 0:
+        print_log("No challenges are waiting.")
+    for challenge in challenges:
+        print_log(f"{challenge.key}: {challenge.prompt}")
+        if challenge.image_path is not None:
+            print_log(f"The captcha image is {challenge.image_path}.")
+        text = print_log("Answer (leave empty to skip): ", input_flag=True)
+        if text.strip():
+            queue.answer(challenge.key, text)
+
+
+if __name__ == "__main__":
+    cli()
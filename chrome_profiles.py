@@ -0,0 +1,240 @@
+#!venv/bin/python
+
+import fcntl
+import os
+import re
+import shutil
+import time
+from typing import Dict, Any, List, Optional
+
+import click
+
+from utils import print_log
+
+PROFILE_LOCK_FILE_NAME = ".profile.lock"
+# Files that Chrome leaves behind when it crashes; Chrome refuses to open a profile while they exist.
+CHROME_SINGLETON_FILES = ["SingletonLock", "SingletonSocket", "SingletonCookie"]
+# Folders that only hold caches, which are deleted first when a profile grows over its size cap.
+CACHE_FOLDERS = [
+    os.path.join("Default", "Cache"),
+    os.path.join("Default", "Code Cache"),
+    os.path.join("Default", "GPUCache"),
+    os.path.join("Default", "Service Worker", "CacheStorage"),
+    os.path.join("Default", "Service Worker", "ScriptCache"),
+    "GrShaderCache",
+    "ShaderCache",
+]
+DEFAULT_MAX_PROFILE_MEGABYTES = 500
+
+
+def get_profile_path(profiles_dir: str, username: str) -> str:
+    """
+    :param profiles_dir: The folder where the Chrome profiles of all users are kept.
+    :param username: The username of the user.
+
+    :return: The path of the user's Chrome profile (user data directory).
+    """
+    return os.path.join(os.path.abspath(profiles_dir), re.sub(r"[^A-Za-z0-9._-]", "_", username))
+
+
+def get_directory_size(path: str) -> int:
+    """
+    :param path: Path of a directory.
+
+    :return: The total size of the files in the directory, in bytes.
+    """
+    total = 0
+    for root, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.lstat(os.path.join(root, file_name)).st_size
+            except FileNotFoundError:
+                continue
+    return total
+
+
+class ChromeProfile:
+    """
+    A user's persistent Chrome profile, locked for the lifetime of one driver. Chrome can only run one
+    browser per user data directory, so a profile that is in use by another process (for example another
+    worker of the work queue) cannot be opened until that process releases it.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock_file = None
+
+    def acquire(self) -> bool:
+        """
+        Locks the profile, without waiting. The Chrome lock files that a crashed driver left behind are
+        removed, since no other driver can be using the profile once the lock is held.
+
+        :return: Whether the profile was locked.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = open(os.path.join(self.path, PROFILE_LOCK_FILE_NAME), "a+")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        # The lock file's modification time records when the profile was last used.
+        os.utime(lock_file.name)
+        for file_name in CHROME_SINGLETON_FILES:
+            singleton_path = os.path.join(self.path, file_name)
+            if os.path.lexists(singleton_path):
+                os.remove(singleton_path)
+        return True
+
+    def release(self) -> None:
+        """
+        Unlocks the profile.
+        """
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def open_profile(profiles_dir: str, username: str) -> Optional[ChromeProfile]:
+    """
+    :param profiles_dir: The folder where the Chrome profiles of all users are kept.
+    :param username: The username of the user.
+
+    :return: The user's locked Chrome profile, or None if another process is using it.
+    """
+    profile = ChromeProfile(get_profile_path(profiles_dir, username))
+    if not profile.acquire():
+        print_log(f"WARNING: The Chrome profile of {username} is in use. Using a temporary profile instead.")
+        return None
+    return profile
+
+
+def trim_profile(profile_path: str, max_bytes: int) -> int:
+    """
+    Keeps a profile under its size cap. The caches are deleted first; if the profile is still too large, then
+    everything but the lock file is deleted (and the user has to log in again next time). The profile must
+    not be in use.
+
+    :param profile_path: The path of the profile.
+    :param max_bytes: The size cap of the profile, in bytes.
+
+    :return: The size of the profile afterwards, in bytes.
+    """
+    size = get_directory_size(profile_path)
+    if size <= max_bytes:
+        return size
+    for cache_folder in CACHE_FOLDERS:
+        shutil.rmtree(os.path.join(profile_path, cache_folder), ignore_errors=True)
+    size = get_directory_size(profile_path)
+    if size <= max_bytes:
+        return size
+
+    print_log(f"The Chrome profile {profile_path} is over its size cap even without its caches. Resetting it.")
+    for entry in os.scandir(profile_path):
+        if entry.name == PROFILE_LOCK_FILE_NAME:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
+    return get_directory_size(profile_path)
+
+
+def close_profile(profile: Optional[ChromeProfile], max_bytes: int) -> None:
+    """
+    Trims a profile down to its size cap (after its driver has quit) and releases it.
+
+    :param profile: The profile returned by open_profile.
+    :param max_bytes: The size cap of the profile, in bytes.
+
+    :return: None.
+    """
+    if profile is None:
+        return
+    try:
+        trim_profile(profile.path, max_bytes)
+    finally:
+        profile.release()
+
+
+def cleanup_profiles(profiles_dir: str, max_bytes: int, max_age_days: Optional[float]) -> List[Dict[str, Any]]:
+    """
+    Trims every profile that is not in use down to its size cap, and deletes the profiles that have not been
+    used for max_age_days.
+
+    :param profiles_dir: The folder where the Chrome profiles of all users are kept.
+    :param max_bytes: The size cap of each profile, in bytes.
+    :param max_age_days: Number of days after which an unused profile is deleted. If None, then no profile
+        is deleted.
+
+    :return: The "profile", "size" and "action" of every profile.
+    """
+    if not os.path.isdir(profiles_dir):
+        return []
+    report = []
+    for entry in sorted(os.scandir(profiles_dir), key=lambda e: e.name):
+        if not entry.is_dir():
+            continue
+        profile = ChromeProfile(entry.path)
+        if not profile.acquire():
+            report.append({"profile": entry.name, "size": get_directory_size(entry.path), "action": "in use"})
+            continue
+        try:
+            lock_path = os.path.join(entry.path, PROFILE_LOCK_FILE_NAME)
+            # acquire() marks the profile as used, so its age has to be read from the newest other file.
+            last_used = max(
+                [os.path.getmtime(entry.path)]
+                + [
+                    os.path.getmtime(os.path.join(entry.path, name))
+                    for name in os.listdir(entry.path)
+                    if name != PROFILE_LOCK_FILE_NAME
+                ]
+            )
+            if max_age_days is not None and time.time() - last_used > max_age_days * 24 * 60 * 60:
+                os.remove(lock_path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+                report.append({"profile": entry.name, "size": 0, "action": "deleted"})
+                continue
+            size_before = get_directory_size(entry.path)
+            size = trim_profile(entry.path, max_bytes)
+            report.append({"profile": entry.name, "size": size, "action": "trimmed" if size < size_before else "kept"})
+        finally:
+            profile.release()
+    return report
+
+
+@click.group()
+def cli() -> None:
+    """
+    Manages the persistent Chrome profiles that keep the caches and sessions of every user.
+    """
+
+
+@cli.command()
+@click.option(
+    "--profiles-dir",
+    type=str,
+    help="specify the folder where the Chrome profiles are kept",
+    required=False,
+    default="chrome_profiles",
+)
+@click.option(
+    "--max-size",
+    type=int,
+    help="size cap of each profile, in megabytes",
+    required=False,
+    default=DEFAULT_MAX_PROFILE_MEGABYTES,
+)
+@click.option("--max-age", type=float, help="delete profiles that have not been used for this many days.")
+def cleanup(profiles_dir: str, max_size: int, max_age: Optional[float]) -> None:
+    """
+    Trims every profile that is over its size cap and deletes the old ones. Profiles in use are skipped.
+    """
+    for item in cleanup_profiles(profiles_dir, max_size * 1024 * 1024, max_age):
+        print_log(f"{item['profile']}: {item['action']} ({item['size'] / (1024 * 1024):.1f} MB).")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,529 @@
+#!venv/bin/python
+
+import datetime
+import json
+import os
+import random
+import time
+from typing import Dict, Any, List, Optional
+
+import click
+from selenium.webdriver.chrome.webdriver import WebDriver
+
+from chrome_profiles import ChromeProfile, open_profile, close_profile, DEFAULT_MAX_PROFILE_MEGABYTES
+from download_recordings import (
+    create_driver,
+    is_logged_in,
+    log_in,
+    search_for_recordings,
+    reveal_all_recordings,
+    extract_recording_metadata,
+    extract_uid_from_recordings,
+    index_old_metadata,
+    merge_migrated_recordings,
+    get_recording_path,
+    save_metadata,
+    download_wav_files,
+    AudioSession,
+)
+from run_manifest import (
+    find_latest_recording_folder,
+    find_partial_recording_folders,
+    set_run_status,
+    RUN_PARTIAL,
+)
+from utils import (
+    print_log,
+    ensure_file_existence,
+    create_user_agent,
+    load_credentials,
+    get_today_date_mm_dd_yyyy,
+    get_full_stack,
+    get_old_metadata,
+    get_audio_ids,
+    write_json_atomically,
+    verify_input_date,
+)
+
+SEARCH_DATE_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+
+class UserSession:
+    """
+    The resident state for one account: its (already logged in) WebDriver, the recordings that have already
+    been synced, and the bookkeeping that gets written to the status file.
+    """
+
+    def __init__(self, username: str, password: str, since: str) -> None:
+        self.username = username
+        self.password = password
+        self.since = since
+        self.driver: Optional[WebDriver] = None
+        self.profile: Optional[ChromeProfile] = None
+        # The recordings that have already been synced, by div_id (see index_old_metadata).
+        self.known_metadata: Dict[str, Dict[str, Any]] = {}
+        self.next_poll = 0.0
+        self.last_sync: Optional[str] = None
+        self.last_poll_seconds: Optional[float] = None
+        self.backlog = 0
+        self.last_error: Optional[str] = None
+
+    def close_driver(self, max_profile_bytes: int) -> None:
+        """
+        Quits the account's driver, if it has one, and releases its Chrome profile.
+
+        :param max_profile_bytes: The size cap of the Chrome profile, in bytes.
+
+        :return: None.
+        """
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
+        close_profile(self.profile, max_profile_bytes)
+        self.profile = None
+
+    def status(self) -> Dict[str, Any]:
+        """
+        :return: The status of this account, as written to the status file.
+        """
+        return {
+            "last_sync": self.last_sync,
+            "since": self.since,
+            "backlog": self.backlog,
+            "known_recordings": len(self.known_metadata),
+            "last_poll_seconds": self.last_poll_seconds,
+            "next_poll": datetime.datetime.fromtimestamp(self.next_poll).isoformat(timespec="seconds"),
+            "session_alive": self.driver is not None,
+            "last_error": self.last_error,
+        }
+
+
+def load_status(status_file: str) -> Dict[str, Any]:
+    """
+    Loads the status file written by a previous daemon, so that a restarted daemon only searches for
+    recordings from the last successful sync onwards.
+
+    :param status_file: Path of the status file.
+
+    :return: The status for each user, keyed by username.
+    """
+    if not os.path.isfile(status_file):
+        return {}
+    with open(status_file, "r") as f:
+        return json.load(f).get("users", {})
+
+
+def write_status(status_file: str, sessions: List[UserSession]) -> None:
+    """
+    Writes the last sync time and backlog of every account to the status file.
+
+    :param status_file: Path of the status file.
+    :param sessions: All of the resident user sessions.
+
+    :return: None.
+    """
+    write_json_atomically(
+        status_file,
+        {
+            "updated": datetime.datetime.now().isoformat(timespec="seconds"),
+            "pid": os.getpid(),
+            "users": {session.username: session.status() for session in sessions},
+        },
+    )
+
+
+def next_poll_time(interval: float, jitter: float) -> float:
+    """
+    :param interval: Number of seconds between polls of the same account.
+    :param jitter: Maximum number of seconds that the poll is randomly moved earlier or later.
+
+    :return: The unix time at which the account should be polled next.
+    """
+    return time.time() + max(0.0, interval + random.uniform(-jitter, jitter))
+
+
+def ensure_session(
+    session: UserSession,
+    user_agent: str,
+    show_driver: bool,
+    system: str,
+    driver_location: str,
+    cookies_file: str,
+    lean_driver: bool = False,
+    profiles_dir: Optional[str] = None,
+) -> WebDriver:
+    """
+    Returns a logged in driver for the account. Chrome is only launched (and the user only logs in) when
+    there is no resident driver yet or when amazon.com has ended the session.
+
+    :param session: The account's session.
+    :param user_agent: The user agent of the driver.
+    :param show_driver: Whether to show the driver or run it in the background.
+    :param system: The OS where the script is running.
+    :param driver_location: Location of the WebDriver.
+    :param cookies_file: The file location where the session's cookies will be saved.
+    :param lean_driver: Whether the driver should block the resources that are not needed (see create_driver).
+    :param profiles_dir: The folder to keep a persistent Chrome profile per user in. If None, then the driver
+        starts with a temporary profile.
+
+    :return: The logged in WebDriver.
+    """
+    if session.driver is None:
+        session.profile = open_profile(profiles_dir, session.username) if profiles_dir is not None else None
+        session.driver = create_driver(
+            user_agent=user_agent,
+            show=show_driver,
+            system=system,
+            driver_location=driver_location,
+            lean=lean_driver,
+            profile_path=session.profile.path if session.profile is not None else None,
+        )
+        log_in(
+            session.driver,
+            session.username,
+            session.password,
+            cookies_file,
+            reuse_session=session.profile is not None,
+        )
+    elif not is_logged_in(session.driver):
+        print_log(f"The session for {session.username} has expired. Logging in again.")
+        log_in(session.driver, session.username, session.password, cookies_file)
+    return session.driver
+
+
+def poll_user(
+    session: UserSession,
+    output_dir: str,
+    info_file: str,
+    user_agent: str,
+    system: str,
+    cookies_file: str,
+) -> None:
+    """
+    Syncs the recordings of one account that have not been synced yet. Only the new recordings are saved
+    (in a new partial run folder, see RUN_PARTIAL), and nothing is written when there are no new recordings.
+
+    :param session: The account's session, with a logged in driver.
+    :param output_dir: The folder / directory where the recording wav files will be saved.
+    :param info_file: The file where the recording metadata will be saved.
+    :param user_agent: The user agent of the driver.
+    :param system: The OS where the script is running.
+    :param cookies_file: The file location where the session's cookies will be saved if the user has to log in
+        again during the downloads.
+
+    :return: None; updates the session's bookkeeping.
+    """
+    driver = session.driver
+    poll_started = datetime.datetime.now()
+
+    search_for_recordings(driver, session.since, system=system)
+    reveal_all_recordings(driver)
+    # Drop any network events from before this poll so that only the uid events of this poll are matched.
+    driver.get_log("performance")
+
+    recording_boxes = driver.find_elements_by_class_name("apd-content-box")
+    recording_metadata, indices_to_download = extract_recording_metadata(
+        recording_boxes, driver, session.known_metadata, False
+    )
+    extract_uid_from_recordings(driver, sorted(indices_to_download), recording_metadata)
+    indices_to_download = merge_migrated_recordings(recording_metadata, indices_to_download, session.known_metadata)
+
+    new_metadata = [recording_metadata[i] for i in sorted(indices_to_download)]
+    downloadable_metadata = [m for m in new_metadata if m.get("audio_id") is not None]
+    session.backlog = len(new_metadata) - len(downloadable_metadata)
+
+    if len(downloadable_metadata) > 0:
+        recording_path = get_recording_path(
+            date=get_today_date_mm_dd_yyyy(),
+            output_folder=output_dir,
+            username=session.username,
+        )
+        save_metadata(
+            metadata=downloadable_metadata,
+            recording_path=recording_path,
+            metadata_file_name=info_file.split("/")[-1],
+        )
+        audio_session = AudioSession(
+            driver,
+            user_agent,
+            log_in_again=lambda: log_in(driver, session.username, session.password, cookies_file),
+        )
+        download_wav_files(
+            audio_ids=get_audio_ids(downloadable_metadata),
+            session=audio_session,
+            recording_path=recording_path,
+        )
+        set_run_status(recording_path, RUN_PARTIAL)
+        session.known_metadata.update(index_old_metadata(downloadable_metadata))
+
+    print_log(
+        f"Synced {len(downloadable_metadata)} new recordings for {session.username} "
+        f"({session.backlog} still waiting for an audio ID)."
+    )
+    # Search from the day before the poll so that recordings which showed up late are not missed.
+    session.since = (poll_started - datetime.timedelta(days=1)).strftime(SEARCH_DATE_FORMAT)
+    session.last_sync = poll_started.isoformat(timespec="seconds")
+    session.last_poll_seconds = round(time.time() - poll_started.timestamp(), 1)
+    session.last_error = None
+
+
+def run_daemon(
+    driver_location: str,
+    show_driver: bool,
+    start_date: str,
+    cookies_file: str,
+    config_file: str,
+    info_file: str,
+    output_dir: str,
+    user_agent: str,
+    user: Optional[str],
+    interval: float,
+    jitter: float,
+    status_file: str,
+    system: str = "linux",
+    lean_driver: bool = False,
+    profiles_dir: Optional[str] = None,
+    max_profile_bytes: int = DEFAULT_MAX_PROFILE_MEGABYTES * 1024 * 1024,
+) -> None:
+    """
+    Keeps one logged in driver per account and polls every account on its own schedule until the process
+    is stopped. The last sync time and backlog of every account are written to the status file after each
+    poll.
+
+    :param driver_location: Location of the WebDriver.
+    :param show_driver: Whether to show the driver or run it in the background.
+    :param start_date: The earliest date to search for recordings from, for accounts that have never synced.
+    :param cookies_file: The file location where the session cookies will be saved.
+    :param config_file: The credentials file which stores the usernames and passwords for users.
+    :param info_file: The file where the recording metadata will be saved.
+    :param output_dir: The folder / directory where the recording wav files will be saved.
+    :param user_agent: The user agent of the driver.
+    :param user: A specific user to run the daemon for.
+    :param interval: Number of seconds between polls of the same account.
+    :param jitter: Maximum number of seconds that each poll is randomly moved earlier or later.
+    :param status_file: Path of the status file.
+    :param system: The OS where the script is running.
+    :param lean_driver: Whether the drivers should block the resources that are not needed (see create_driver).
+    :param profiles_dir: The folder to keep a persistent Chrome profile per user in. If None, then every driver
+        starts with a temporary profile.
+    :param max_profile_bytes: The size cap of each Chrome profile, in bytes.
+
+    :return: None.
+    """
+    credentials = load_credentials(credentials_file=config_file, user=user)
+    if len(credentials) == 0:
+        print_log("ERROR: Please modify the credentials.json file and add an account to use.")
+        return
+
+    output_dir_name = output_dir.split("/")[-1]
+    metadata_file_name = info_file.split("/")[-1]
+    previous_status = load_status(status_file)
+
+    sessions = []
+    for i, credentials_for_one_user in enumerate(credentials):
+        username = credentials_for_one_user["username"]
+        session = UserSession(
+            username=username,
+            password=credentials_for_one_user["password"],
+            since=previous_status.get(username, {}).get("since") or start_date,
+        )
+        session.last_sync = previous_status.get(username, {}).get("last_sync")
+
+        # The latest complete run holds every recording up to it, and the partial runs after it the rest.
+        latest_folder = find_latest_recording_folder(output_dir_name, username)
+        synced_folders = [latest_folder] if latest_folder is not None else []
+        for folder in synced_folders + find_partial_recording_folders(output_dir_name, username):
+            session.known_metadata.update(
+                index_old_metadata(get_old_metadata(os.path.join(folder, metadata_file_name)))
+            )
+
+        # Spread the first polls over the interval so that all accounts don't log in at once.
+        session.next_poll = time.time() + i * interval / len(credentials)
+        sessions.append(session)
+
+    print_log(f"Daemon started for {len(sessions)} users. Writing status to {status_file}.")
+    try:
+        while True:
+            write_status(status_file, sessions)
+            session = min(sessions, key=lambda s: s.next_poll)
+            wait = session.next_poll - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            print_log(f"Polling user {session.username}.")
+            try:
+                ensure_session(
+                    session,
+                    user_agent,
+                    show_driver,
+                    system,
+                    driver_location,
+                    cookies_file,
+                    lean_driver,
+                    profiles_dir,
+                )
+                poll_user(session, output_dir_name, info_file, user_agent, system, cookies_file)
+            except Exception as e:
+                print_log(
+                    f"ERROR: The poll for user {session.username} has errored out. The driver will be "
+                    "restarted on the next poll."
+                )
+                session.last_error = f"{e}\n{get_full_stack()}"
+                session.close_driver(max_profile_bytes)
+            session.next_poll = next_poll_time(interval, jitter)
+    finally:
+        for session in sessions:
+            session.close_driver(max_profile_bytes)
+        write_status(status_file, sessions)
+
+
+@click.command()
+@click.option(
+    "-c",
+    "--config",
+    type=str,
+    help="specify a file for credential information",
+    required=False,
+    default="credentials.json",
+)
+@click.option(
+    "-i",
+    "--info",
+    type=str,
+    help="specify a file for the recording info",
+    required=False,
+    default="recordinginfo.json",
+)
+@click.option(
+    "-C",
+    "--cookies",
+    type=str,
+    help="specify a file for the stored cookies",
+    required=False,
+    default="cookies.json",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify a directory to output files",
+    required=False,
+    default="recordings",
+)
+@click.option(
+    "-d",
+    "--date",
+    type=str,
+    help="specify the first date to sync from in the format 'YYYY/MM/DD HH:MM:SS'",
+    required=True,
+)
+@click.option(
+    "--system",
+    type=click.Choice(["linux", "mac"], case_sensitive=False),
+    required=False,
+    default="linux",
+    help="Specify the OS you are working on (linux or mac)",
+)
+@click.option(
+    "--show", is_flag=True, help="show the chrome windows as they search for recordings."
+)
+@click.option("--driver", type=str, help="Specify file location of driver.")
+@click.option(
+    "--user",
+    type=str,
+    help="Specify a single user to be run from the config file.",
+    required=False,
+)
+@click.option(
+    "--interval",
+    type=float,
+    help="minutes between two polls of the same user.",
+    required=False,
+    default=60.0,
+)
+@click.option(
+    "--jitter",
+    type=float,
+    help="maximum number of minutes that a poll is randomly moved earlier or later.",
+    required=False,
+    default=5.0,
+)
+@click.option(
+    "--status-file",
+    type=str,
+    help="specify a file where the last sync time and backlog of each user are written",
+    required=False,
+    default="daemon_status.json",
+)
+@click.option(
+    "--lean",
+    is_flag=True,
+    help="block images, fonts and third-party trackers in chrome, for faster page loads.",
+)
+@click.option(
+    "--profiles-dir",
+    type=str,
+    help="keep a persistent chrome profile per user in this folder, to reuse its cache and login.",
+    required=False,
+)
+@click.option(
+    "--max-profile-size",
+    type=int,
+    help="size cap of each chrome profile, in megabytes.",
+    required=False,
+    default=DEFAULT_MAX_PROFILE_MEGABYTES,
+)
+def main(
+    config: str,
+    info: str,
+    cookies: str,
+    output: str,
+    date: str,
+    system: str,
+    show: bool,
+    driver: str,
+    user: str,
+    interval: float,
+    jitter: float,
+    status_file: str,
+    lean: bool,
+    profiles_dir: Optional[str],
+    max_profile_size: int,
+) -> None:
+    """
+    This script stays resident and keeps a logged in Chrome session for every user in the credentials file.
+    Each user is polled on a schedule, and only recordings that have not been synced before are downloaded.
+
+    The last sync time and the backlog of every user are written to the status file.
+    """
+    if not verify_input_date(date=date):
+        print_log(
+            "ERROR: The input date is not correctly formatted. Please format the date as such: "
+            "\"YYYY/MM/DD HH:MM:SS\" and run \"./daemon.py --help\" for more information. "
+        )
+        return
+
+    ensure_file_existence(config)
+
+    run_daemon(
+        driver_location=driver,
+        show_driver=False if show is None else show,
+        start_date=date,
+        cookies_file=cookies,
+        config_file=config,
+        info_file=info,
+        output_dir=output,
+        user_agent=create_user_agent(),
+        user=user,
+        interval=interval * 60,
+        jitter=jitter * 60,
+        status_file=status_file,
+        system=system,
+        lean_driver=False if lean is None else lean,
+        profiles_dir=profiles_dir,
+        max_profile_bytes=max_profile_size * 1024 * 1024,
+    )
+
+
+if __name__ == "__main__":
+    main()
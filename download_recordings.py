@@ -1,11 +1,14 @@
 #!venv/bin/python
 
+import contextlib
+import datetime
 import json
 import os
+import threading
 import time
 from http.client import RemoteDisconnected
-from pathlib import Path
-from typing import Dict, Any, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED, ALL_COMPLETED
+from typing import Dict, Any, Iterator, List, Optional, Set, Tuple, Callable, Union
 
 import click
 import requests
@@ -34,14 +37,105 @@ from utils import (
     get_uid_from_event,
     get_old_metadata,
     get_audio_ids,
+    get_recording_files,
     format_cookies_for_request,
-    find_last_recording_folder,
     create_user_agent,
     load_credentials,
     get_today_date_mm_dd_yyyy,
     get_full_stack,
+    parse_input_date,
+    is_valid_wav_file,
+    recording_matches_filters,
     verify_input_date
 )
+from driver_watchdog import (
+    DriverWatchdog,
+    DEFAULT_WATCHDOG_WINDOW_SIZE,
+    DEFAULT_PHASE_BUDGETS,
+    load_progress,
+    save_progress,
+    clear_progress,
+    restore_cookies,
+    stop_driver,
+)
+from uid_resolver import UidResolver, get_endpoint_from_url
+from download_scheduler import (
+    DownloadScheduler,
+    DOWNLOAD_PRIORITIES,
+    NEWEST_FIRST,
+    UNKNOWN_FIRST,
+    get_catalog_audio_ids,
+)
+from challenges import (
+    Challenge,
+    ChallengePending,
+    ChallengeQueue,
+    CHALLENGE_STEPS,
+    CAPTCHA_CHALLENGE,
+    TWO_STEP_CHALLENGE,
+    EMAIL_CHALLENGE,
+    CHALLENGE_POLL_SECONDS,
+    DEFAULT_CHALLENGE_TIMEOUT_SECONDS,
+)
+from chrome_profiles import open_profile, close_profile, DEFAULT_MAX_PROFILE_MEGABYTES
+from audio_compression import compress_file, remove_compressed_originals, get_compressed_path
+from mirror_recordings import journal_run_files, mirror_output_folder
+from audio_features import analyze_run
+from recording_index import open_index, index_run_folder
+from analytics_export import open_export_state, export_run_folder, require_pyarrow
+from run_planner import RunPlanner, UserPlan
+from work_queue import WorkQueue, Lease, DEFAULT_MAX_STALL_SECONDS
+from run_manifest import (
+    allocate_run,
+    get_latest_run,
+    set_run_status,
+    find_last_recording_folder,
+    RUN_COMPLETE,
+    RUN_PARTIAL,
+    RUN_FAILED,
+)
+
+ACTIVITY_HISTORY_URL = "https://www.amazon.com/hz/mycd/myx#/home/alexaPrivacy/activityHistory"
+AUDIO_URL_BASE = "https://www.amazon.com/alexa-privacy/apd/rvh/audio?uid="
+AUDIO_REQUEST_TIMEOUT_SECONDS = 120
+# Seconds to wait before retrying a request that failed on the network (doubled after every attempt).
+AUDIO_RETRY_BACKOFF_SECONDS = 2
+
+# Requests that the lean driver blocks: images, fonts and media (the captcha image is downloaded with requests
+# from its src, so it still works), and the third-party trackers and ads on the amazon.com pages. Scripts,
+# stylesheets and the XHRs of amazon.com (such as the uidArray[] requests) are never blocked.
+LEAN_BLOCKED_URLS = [
+    "*.png*",
+    "*.jpg*",
+    "*.jpeg*",
+    "*.gif*",
+    "*.webp*",
+    "*.svg*",
+    "*.ico*",
+    "*.woff*",
+    "*.ttf*",
+    "*.otf*",
+    "*.eot*",
+    "*.mp4*",
+    "*.webm*",
+    "*amazon-adsystem.com*",
+    "*doubleclick.net*",
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*googlesyndication.com*",
+    "*fls-na.amazon.com*",
+    "*unagi.amazon.com*",
+]
+LEAN_CHROME_ARGUMENTS = [
+    "--blink-settings=imagesEnabled=false",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--mute-audio",
+    "--no-first-run",
+]
 
 
 def create_driver(
@@ -49,6 +143,8 @@ def create_driver(
     show: bool = False,
     system: str = "linux",
     driver_location: str = "/usr/local/bin/chromedriver",
+    lean: bool = False,
+    profile_path: Optional[str] = None,
 ) -> WebDriver:
     """
     Creates the driver based on whether the display should be shown and based on the operating
@@ -62,14 +158,33 @@ def create_driver(
         linux-based system.
     :param driver_location: Location of the driver, if the user wishes to supply one. If not, then the
         driver will use the default Chromedriver, which varies per OS.
+    :param lean: Whether the driver should skip the images, fonts, media and third-party trackers of every
+        page (see LEAN_BLOCKED_URLS) and only log the network events of the performance log. This makes page
+        loads faster and uses less bandwidth and memory. Default is False.
+    :param profile_path: The Chrome user data directory to keep the cache, cookies and logins in (see
+        chrome_profiles.py). If None, then Chrome starts with a new temporary profile.
 
     :return: A WebDriver with the correct settings.
     """
     print_log("Setting up the driver.")
     chrome_options = webdriver.ChromeOptions()
     chrome_options.add_argument("user-agent=" + user_agent)
+    if profile_path is not None:
+        chrome_options.add_argument("--user-data-dir=" + profile_path)
+    if lean:
+        for argument in LEAN_CHROME_ARGUMENTS:
+            chrome_options.add_argument(argument)
+        chrome_options.add_experimental_option(
+            "prefs",
+            {
+                "profile.managed_default_content_settings.images": 2,
+                "profile.default_content_setting_values.notifications": 2,
+            },
+        )
+        # Only the Network.responseReceived events are read from the performance log.
+        chrome_options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": True, "enablePage": False})
 
-    caps = DesiredCapabilities.CHROME
+    caps = DesiredCapabilities.CHROME.copy()
     caps["loggingPrefs"] = {"performance": "ALL"}
     caps["goog:loggingPrefs"] = {"performance": "ALL"}
     if system.lower() == "mac":
@@ -89,16 +204,22 @@ def create_driver(
         driver = webdriver.Chrome(
             driver_location, desired_capabilities=caps, options=chrome_options
         )
+    if lean:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": LEAN_BLOCKED_URLS})
     print_log("Finished setting up the driver.")
     return driver
 
 
-def two_step(driver: WebDriver) -> None:
+def two_step(driver: WebDriver, username: str = "", challenges: Optional[ChallengeQueue] = None) -> None:
     """
     Performs the two-step verification, if the website asks for it. If no two step prompt is detected, then
     the script will go on to the next login step.
 
     :param driver: The WebDriver.
+    :param username: Username for the amazon.com login.
+    :param challenges: If given, the verification code is asked for through this queue instead of the console,
+        and ChallengePending is raised instead of waiting for it (see submit_challenge_answer).
 
     :return: None; modifies the website given by the WebDriver.
     """
@@ -116,6 +237,15 @@ def two_step(driver: WebDriver) -> None:
             )
         )
         # need user input
+        if challenges is not None:
+            raise ChallengePending(
+                challenges.post(
+                    username,
+                    TWO_STEP_CHALLENGE,
+                    f"Enter the 6 digit 2 Step Verification Code that was sent to {username}.",
+                    driver.current_url,
+                )
+            )
         code = input("Enter your 6 digit 2 Step Verification Code: ")
 
         verification.send_keys(code)
@@ -127,13 +257,17 @@ def two_step(driver: WebDriver) -> None:
         print_log("No 2 Step Verification Required!")
 
 
-def captcha(driver: WebDriver, username: str, password: str) -> None:
+def captcha(
+    driver: WebDriver, username: str, password: str, challenges: Optional[ChallengeQueue] = None
+) -> None:
     """
     Provides an interface for the user of the script to perform captcha verification, if the website requires it.
 
     :param driver: The WebDriver.
     :param username: Username for the amazon.com login.
     :param password: Password for the amazon.com login.
+    :param challenges: If given, the captcha is posted to this queue (with its image) instead of being asked for
+        on the console, and ChallengePending is raised instead of waiting for the guess.
 
     :return: None; modifies the website given by the WebDriver.
     """
@@ -146,6 +280,19 @@ def captcha(driver: WebDriver, username: str, password: str) -> None:
     print_log("Captcha detected.")
     src = image.get_attribute("src")
 
+    if challenges is not None:
+        image_content = requests.get(src).content
+        enter_username_and_password(driver, username, password, slow=True, submit=False)
+        raise ChallengePending(
+            challenges.post(
+                username,
+                CAPTCHA_CHALLENGE,
+                f"Enter the characters of the captcha for {username}.",
+                driver.current_url,
+                image=image_content,
+            )
+        )
+
     with open("captcha.jpg", "wb") as f:
         f.write(requests.get(src).content)
         f.close()
@@ -166,12 +313,21 @@ def captcha(driver: WebDriver, username: str, password: str) -> None:
     driver.implicitly_wait(5)
 
 
-def email_verification(driver: WebDriver) -> None:
+def email_verification(
+    driver: WebDriver,
+    timeout: float = 10 * 60,
+    username: str = "",
+    challenges: Optional[ChallengeQueue] = None,
+) -> None:
     """
     If amazon requests email verification, this function will halt the login process until the user has
     granted login access to the script via email.
 
     :param driver: The WebDriver.
+    :param timeout: Number of seconds to wait for the email verification before giving up. Default is 10 minutes.
+    :param username: Username for the amazon.com login.
+    :param challenges: If given, the email verification is posted to this queue and ChallengePending is raised
+        instead of waiting for it. The account continues once the page moves on (or the challenge is answered).
 
     :return: None; modifies the website given by the WebDriver.
     """
@@ -182,8 +338,17 @@ def email_verification(driver: WebDriver) -> None:
     if len(email_verification_element) == 0:
         print_log("No email verification!")
         return
+    if challenges is not None:
+        raise ChallengePending(
+            challenges.post(
+                username, EMAIL_CHALLENGE, f"Approve the sign-in email that was sent to {username}.", url
+            )
+        )
     print_log("ACTION NEEDED: Waiting for email verification. Please check your email.")
+    waiting_since = time.time()
     while driver.current_url == url:
+        if time.time() - waiting_since > timeout:
+            raise TimeoutException(f"The email verification was not granted within {timeout:.0f} seconds.")
         time.sleep(2)
     print_log("Email approved.")
 
@@ -238,22 +403,127 @@ def enter_username_and_password(
     driver.implicitly_wait(2)
 
 
+def is_logged_in(driver: WebDriver) -> bool:
+    """
+    Checks whether the driver's session is still authenticated by loading the activity history page and
+    seeing whether amazon.com redirects it to the sign-in page.
+
+    :param driver: The WebDriver.
+
+    :return: True if the session is still logged in; False if the user needs to log in again.
+    """
+    driver.get(ACTIVITY_HISTORY_URL)
+    driver.implicitly_wait(2)
+    return "/ap/signin" not in driver.current_url and len(driver.find_elements_by_id("ap_email")) == 0
+
+
+def log_in(
+    driver: WebDriver,
+    username: str,
+    password: str,
+    cookies_file: str,
+    reuse_session: bool = False,
+    challenges: Optional[ChallengeQueue] = None,
+    resume_from: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Logs the user in (handling captcha, two-step and email verification if amazon.com asks for them) and dumps
+    the cookies of the new session.
+
+    :param driver: The WebDriver.
+    :param username: Username of the user.
+    :param password: Password of the user.
+    :param cookies_file: The file location where the session's cookies will be saved.
+    :param reuse_session: Whether to first check if the driver is still logged in (for example, because it
+        uses the user's persistent Chrome profile), and to skip the login if it is.
+    :param challenges: If given, the steps that need the operator are posted to this queue and raise
+        ChallengePending instead of waiting (see challenges.py).
+    :param resume_from: The challenge step (one of CHALLENGE_STEPS) that a parked login was waiting on and that
+        has been answered. The login continues on the current page from that step, which checks whether the
+        page still asks for it (for example, after a wrong captcha guess).
+
+    :return: The cookies of the logged in session.
+    """
+    if resume_from is None and reuse_session and is_logged_in(driver):
+        print_log(f"{username} is still logged in from the last session.")
+    else:
+        if resume_from is None:
+            enter_username_and_password(driver, username, password, slow=True, remember_me=True)
+        steps = {
+            CAPTCHA_CHALLENGE: lambda: captcha(driver, username, password, challenges),
+            TWO_STEP_CHALLENGE: lambda: two_step(driver, username, challenges),
+            EMAIL_CHALLENGE: lambda: email_verification(driver, username=username, challenges=challenges),
+        }
+        first_step = CHALLENGE_STEPS.index(resume_from) if resume_from is not None else 0
+        for step in CHALLENGE_STEPS[first_step:]:
+            steps[step]()
+
+    print_log("Loading old cookies.")
+
+    cookies = driver.get_cookies()
+    dump_cookies(cookies_file, cookies)
+    return cookies
+
+
+def submit_challenge_answer(driver: WebDriver, challenge: Challenge, answer: Optional[str]) -> None:
+    """
+    Enters the operator's answer to a challenge on the page that the parked driver was left on.
+
+    :param driver: The WebDriver, still on the challenge page.
+    :param challenge: The challenge.
+    :param answer: The operator's answer. Email challenges do not need one.
+
+    :return: None; modifies the website given by the WebDriver.
+    """
+    if challenge.kind == CAPTCHA_CHALLENGE:
+        driver.find_element_by_id("auth-captcha-guess").send_keys(answer)
+        driver.find_element_by_id("signInSubmit").click()
+        print_log("Submitting captcha.")
+        driver.implicitly_wait(5)
+    elif challenge.kind == TWO_STEP_CHALLENGE:
+        driver.find_element_by_xpath("//input[@type='text' and @name='code']").send_keys(answer)
+        driver.find_element_by_xpath("//input[@type='submit']").click()
+        driver.implicitly_wait(5)
+
+
+def is_challenge_answered(driver: WebDriver, challenges: ChallengeQueue, challenge: Challenge) -> bool:
+    """
+    :param driver: The parked WebDriver.
+    :param challenges: The challenge queue.
+    :param challenge: The challenge that the driver is waiting on.
+
+    :return: Whether the operator has answered the challenge (or, for an email challenge, whether the page has
+        moved on because the email was approved).
+    """
+    if challenges.get_answer(challenge) is not None:
+        return True
+    return challenge.kind == EMAIL_CHALLENGE and driver.current_url != challenge.url
+
+
 def search_for_recordings(
-    driver: WebDriver, start_date: str, system: str = "linux"
+    driver: WebDriver,
+    start_date: str,
+    system: str = "linux",
+    end_date: Optional[str] = None,
+    devices: Optional[List[str]] = None,
 ) -> None:
     """
     After logging in, this function traverses the recordings page to search for the required recordings.
-    It enters the correct date to search by so that only relevant recordings are shown.
+    It enters the correct date range (and devices) to search by so that only relevant recordings are shown.
 
     :param driver: The WebDriver.
     :param start_date: The date at which the recordings want to be shown from. The date range of recordings
-        goes from start_date to the date at which the script is run on.
+        goes from start_date to end_date.
     :param system: The operating system by which the script is running on.
+    :param end_date: The date at which the recordings want to be shown until. If None, then the date range
+        goes until the date at which the script is run on.
+    :param devices: The names of the devices whose recordings want to be shown. If None, then the recordings
+        of every device are shown.
 
     :return: None; modifies the website given by the WebDriver.
     """
     print_log("Searching for recordings.")
-    driver.get("https://www.amazon.com/hz/mycd/myx#/home/alexaPrivacy/activityHistory")
+    driver.get(ACTIVITY_HISTORY_URL)
 
     display_button = WebDriverWait(driver, 10).until(
         lambda d: d.find_element_by_id("filters-selected-bar")
@@ -284,6 +554,55 @@ def search_for_recordings(
     starting_date.send_keys(start_date)
     driver.implicitly_wait(5)
 
+    if end_date is not None:
+        ending_date = WebDriverWait(driver, 10).until(
+            lambda d: d.find_element_by_id("date-end")
+        )
+        if system == "mac":
+            ending_date.send_keys(Keys.COMMAND + "A")
+        else:
+            ending_date.clear()
+        ending_date.send_keys(end_date)
+        driver.implicitly_wait(5)
+
+    if devices:
+        select_devices(driver, devices)
+
+
+def select_devices(driver: WebDriver, devices: List[str]) -> None:
+    """
+    Selects the given devices in the device filter of the recordings page, so that only their recordings are
+    shown. If the filter or a device cannot be found, then the recordings of those devices are only filtered
+    out after they are extracted (see recording_matches_filters).
+
+    :param driver: The WebDriver.
+    :param devices: The names of the devices to select (case-insensitive).
+
+    :return: None; modifies the website given by the WebDriver.
+    """
+    device_menus = driver.find_elements_by_class_name("filter-by-device-menu")
+    if len(device_menus) == 0:
+        print_log("WARNING: Cannot find the device filter. The recordings will be filtered by device afterwards.")
+        return
+    device_menus[0].click()
+    driver.implicitly_wait(2)
+
+    wanted_devices = [device.lower() for device in devices]
+    selected_devices = set()
+    for option in device_menus[0].find_elements_by_xpath(".//label"):
+        device_name = option.text.strip().lower()
+        checkbox = option.find_elements_by_xpath(".//input[@type='checkbox']")
+        is_checked = len(checkbox) > 0 and checkbox[0].is_selected()
+        if (device_name in wanted_devices) != is_checked:
+            option.click()
+            driver.implicitly_wait(1)
+        if device_name in wanted_devices:
+            selected_devices.add(device_name)
+
+    for device in set(wanted_devices) - selected_devices:
+        print_log(f"WARNING: Cannot find the device \"{device}\" in the device filter.")
+    driver.implicitly_wait(5)
+
 
 def check_for_uid(d: Dict[str, Any]) -> bool:
     """
@@ -316,45 +635,109 @@ def reveal_all_recordings(driver: WebDriver) -> None:
 
     :return: None; modifies the website given by the WebDriver.
     """
-    hidden_recordings = True
-    while hidden_recordings:
-        hidden_recordings = False
-        show_more_buttons = driver.find_elements_by_xpath(
-            "//div[@class='full-width-message clickable']"
-        )
+    while reveal_more_recordings(driver):
+        pass
 
-        # Check for more hidden recordings
-        for button in show_more_buttons:
-            if button.text == "Show more":
-                hidden_recordings = True
-                button.click()
 
+def reveal_more_recordings(driver: WebDriver) -> bool:
+    """
+    Clicks the "Show more" button at the bottom of the page once, to reveal the next recordings that the page
+    hides.
 
-def find_div_id_in_metadata(
-    id_to_find: str, old_metadata: List[Dict[str, Any]]
-) -> Optional[Dict[str, Any]]:
+    :param driver: The WebDriver.
+
+    :return: Whether there were hidden recordings to reveal.
+    """
+    hidden_recordings = False
+    show_more_buttons = driver.find_elements_by_xpath(
+        "//div[@class='full-width-message clickable']"
+    )
+
+    # Check for more hidden recordings
+    for button in show_more_buttons:
+        if button.text == "Show more":
+            hidden_recordings = True
+            button.click()
+    return hidden_recordings
+
+
+def index_old_metadata(old_metadata: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
     """
-    Goes through the list of metadata information (located in the metadata file) and sees if any of the
-    metadata objects contain the given audio ID.
+    Indexes the metadata collected from the previous run(s) by div_id, so that each recording box can be looked up
+    without scanning all of the old metadata. Recordings without a div_id (i.e. recordings migrated from the
+    legacy metadata format, see migrate_metadata.py) are indexed by their audio ID instead.
 
-    :param id_to_find: The audio ID in question.
     :param old_metadata: The metadata collected from the previous run(s) (if any).
 
-    :return: None, if none of the metadata items contain the audio ID. Return the metadata dict if one of them
-        does contain the audio ID.
+    :return: A dict from the div_id (or audio ID) of each old recording to its metadata.
     """
+    known_metadata = {}
     for metadata_info in old_metadata:
-        for key, val in metadata_info.items():
-            if key == "div_id" and val == id_to_find:
-                return metadata_info
-    return None
+        key = metadata_info.get("div_id") or metadata_info.get("audio_id")
+        if key is not None:
+            known_metadata[key] = metadata_info
+    return known_metadata
+
+
+def find_div_id_in_metadata(
+    id_to_find: str, old_metadata: Dict[str, Dict[str, Any]], audio_id: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Looks up the metadata of an old recording (see index_old_metadata) by its div_id. If an audio ID is given,
+    falls back to it, so that recordings migrated from the legacy metadata format (which have no div_id) are
+    recognized once the audio ID of the recording box is known.
+
+    :param id_to_find: The div_id in question.
+    :param old_metadata: The metadata collected from the previous run(s) (if any), indexed by index_old_metadata.
+    :param audio_id: The audio ID of the recording, if it is known.
+
+    :return: None, if none of the metadata items have the div_id (or audio ID). Return the metadata dict if one of
+        them does.
+    """
+    metadata_info = old_metadata.get(id_to_find)
+    if metadata_info is None and audio_id is not None:
+        metadata_info = old_metadata.get(audio_id)
+        if metadata_info is not None and metadata_info.get("div_id") is not None:
+            return None
+    return metadata_info
+
+
+def merge_migrated_recordings(
+    metadata: List[Dict[str, Any]], indices_to_download: List[int], old_metadata: Dict[str, Dict[str, Any]]
+) -> List[int]:
+    """
+    Once the audio IDs of the new recordings are known, finds the ones that were migrated from the legacy metadata
+    format (which could not be matched by div_id), and gives their old metadata the div_id of the recording box,
+    so later runs skip them by div_id like any other recording.
+
+    :param metadata: The metadata information for all of the recordings, with the audio IDs attached.
+    :param indices_to_download: The indices of the new recordings in the metadata.
+    :param old_metadata: The metadata collected from the previous run(s) (if any), indexed by index_old_metadata.
+
+    :return: The indices of the recordings that are actually new.
+    """
+    new_indices = []
+    for i in indices_to_download:
+        audio_id = metadata[i].get("audio_id")
+        old_metadata_info = find_div_id_in_metadata(metadata[i]["div_id"], old_metadata, audio_id)
+        if old_metadata_info is None:
+            new_indices.append(i)
+            continue
+        print_log(f"Recording {audio_id} was migrated from the legacy metadata. Keeping its old metadata.")
+        metadata[i] = {**old_metadata_info, "div_id": metadata[i]["div_id"]}
+        old_metadata[metadata[i]["div_id"]] = metadata[i]
+    return new_indices
 
 
 def extract_recording_metadata(
     recording_boxes: List[WebElement],
     driver: WebDriver,
-    old_metadata: List[Dict[str, Any]],
+    old_metadata: Union[List[Dict[str, Any]], Dict[str, Dict[str, Any]]],
     download_duplicates: bool,
+    first_recording_number: int = 1,
+    recording_filter: Optional[Callable[[Dict[str, Any]], bool]] = None,
+    expand: bool = True,
+    on_progress: Optional[Callable[[], None]] = None,
 ) -> Tuple[List[Dict[str, Any]], List[int]]:
     """
     For each recording, extracts the message text, date of message, time of message, device on which the message
@@ -362,8 +745,14 @@ def extract_recording_metadata(
 
     :param recording_boxes:
     :param driver:
-    :param old_metadata:
+    :param old_metadata: The metadata collected from the previous run(s) (if any), or the same indexed by
+        index_old_metadata.
     :param download_duplicates:
+    :param first_recording_number: The number of the first recording box in the log messages.
+    :param recording_filter: If given, only the recordings for which it returns True are kept (and expanded).
+    :param expand: Whether to expand each recording box, which makes the page request its audio ID (see
+        extract_uid_from_recordings). Not needed when the audio IDs are resolved in batches (see uid_resolver.py).
+    :param on_progress: Called after each recording box, to report that the extraction is still making progress.
 
     :return: Outputs a tuple of two things:
         [0]: A list of all of the metadata for all of the recordings.
@@ -376,19 +765,26 @@ def extract_recording_metadata(
     print_log(f"Total recordings: {num_recordings}.")
 
     num_skipped_recordings = 0
+    if not isinstance(old_metadata, dict):
+        old_metadata = index_old_metadata(old_metadata)
 
     for i, recording_box in enumerate(recording_boxes):
+        if on_progress is not None:
+            on_progress()
         box_div_id = recording_box.get_property("id")
 
         # Skip this recording if it is already documented.
         if download_duplicates is False:
             old_metadata_info = find_div_id_in_metadata(box_div_id, old_metadata)
             if old_metadata_info is not None:
-                recording_metadata.append(old_metadata_info)
-                print_log(f"Skipping recording #{i + 1}.")
+                if recording_filter is None or recording_filter(old_metadata_info):
+                    recording_metadata.append(old_metadata_info)
+                else:
+                    num_skipped_recordings += 1
+                print_log(f"Skipping recording #{i + first_recording_number}.")
                 continue
 
-        print_log(f"Working on recording #{i + 1}.")
+        print_log(f"Working on recording #{i + first_recording_number}.")
         recording_date = ""
         recording_time = ""
         recording_device = ""
@@ -438,10 +834,16 @@ def extract_recording_metadata(
             "device": recording_device,
             "div_id": box_div_id,
         }
+        if recording_filter is not None and not recording_filter(metadata):
+            print_log(f"Recording #{i + first_recording_number} does not match the filters. Skipping it.")
+            num_skipped_recordings += 1
+            continue
         recording_metadata.append(metadata)
         indices_to_download.append(i - num_skipped_recordings)
 
         # Open box for audio ID extraction later
+        if not expand:
+            continue
         expand_button_list = recording_box.find_elements_by_xpath(".//button")
         if len(expand_button_list) == 0:
             print_log(
@@ -490,6 +892,172 @@ def extract_uid_from_recordings(
             metadata[idx_to_update].update({"audio_id": get_uid_from_event(event)})
 
 
+def discover_uid_endpoint(driver: WebDriver) -> Optional[str]:
+    """
+    Expands the first recording box and reads the uidArray[] request that the page sends for it from the
+    performance log, to find the endpoint that audio IDs can be resolved with in batches.
+
+    :param driver: The WebDriver, with the recordings shown.
+
+    :return: The endpoint, or None if no recording box or uidArray[] request was found.
+    """
+    first_boxes = driver.execute_script(
+        "return Array.from(document.getElementsByClassName('apd-content-box')).slice(0, 1);"
+    )
+    if len(first_boxes) == 0:
+        return None
+    expand_button_list = first_boxes[0].find_elements_by_xpath(".//button")
+    if len(expand_button_list) == 0:
+        return None
+
+    driver.get_log("performance")
+    expand_button_list[0].click()
+    driver.implicitly_wait(1)
+    time.sleep(2)
+    events = [json.loads(entry["message"])["message"] for entry in driver.get_log("performance")]
+    response_events = list(filter(check_for_uid, events))
+    if len(response_events) == 0:
+        return None
+    endpoint = get_endpoint_from_url(response_events[0]["params"]["response"]["url"])
+    print_log(f"Resolving audio IDs in batches with {endpoint}.")
+    return endpoint
+
+
+def get_first_recording_boxes(driver: WebDriver, num_boxes: int) -> List[WebElement]:
+    """
+    :param driver: The WebDriver.
+    :param num_boxes: The maximum number of recording boxes to return.
+
+    :return: The first num_boxes recording boxes on the page, without looking up the others.
+    """
+    return driver.execute_script(
+        "return Array.from(document.getElementsByClassName('apd-content-box')).slice(0, arguments[0]);",
+        num_boxes,
+    )
+
+
+def iter_recording_windows(
+    driver: WebDriver,
+    old_metadata: List[Dict[str, Any]],
+    download_duplicates: bool,
+    window_size: int,
+    recording_filter: Optional[Callable[[Dict[str, Any]], bool]] = None,
+    watchdog: Optional[DriverWatchdog] = None,
+    audio_id_resolver: Optional[UidResolver] = None,
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Extracts the metadata and audio IDs of the recordings window_size recording boxes at a time. The hidden
+    recordings are only revealed ("Show more") once the revealed ones run out, and after each window the
+    performance log is read (which also empties it) and the processed boxes are removed from the page, so that
+    neither the page nor this script holds on to much more than one window of recording boxes, no matter how
+    many recordings there are.
+
+    :param driver: The WebDriver, with the recordings searched for (the hidden ones do not have to be revealed).
+    :param old_metadata: The metadata collected from the previous run(s) (if any).
+    :param download_duplicates: Whether the script should find the metadata for recordings that already exist
+        within the config file or not.
+    :param window_size: Number of recording boxes to work on at a time.
+    :param recording_filter: If given, only the recordings for which it returns True are kept.
+    :param watchdog: If given, each window has to be extracted within the watchdog's "extract" budget.
+    :param audio_id_resolver: If given, the audio IDs of each window are resolved in batches with it, instead
+        of expanding every recording box.
+
+    :return: A generator of the metadata of the recordings of each window, with the audio IDs of the
+        recordings to download.
+    """
+    # Throw away the network events of the search, so the log only has the events of the first window.
+    driver.get_log("performance")
+    known_metadata = index_old_metadata(old_metadata)
+
+    def reveal_window() -> List[WebElement]:
+        recording_boxes = get_first_recording_boxes(driver, window_size)
+        while len(recording_boxes) < window_size and reveal_more_recordings(driver):
+            driver.implicitly_wait(1)
+            time.sleep(1)
+            recording_boxes = get_first_recording_boxes(driver, window_size)
+        return recording_boxes
+
+    num_boxes = 0
+    while True:
+        if watchdog is not None:
+            recording_boxes = watchdog.run("search", reveal_window)
+        else:
+            recording_boxes = reveal_window()
+        if len(recording_boxes) == 0:
+            break
+
+        def extract_window() -> List[Dict[str, Any]]:
+            window_metadata, indices_to_download = extract_recording_metadata(
+                recording_boxes,
+                driver,
+                known_metadata,
+                download_duplicates,
+                first_recording_number=num_boxes + 1,
+                recording_filter=recording_filter,
+                expand=audio_id_resolver is None,
+            )
+            if audio_id_resolver is not None:
+                audio_id_resolver.attach_audio_ids(window_metadata, sorted(indices_to_download))
+                # The boxes were not expanded, but Chrome still logs the network events of the page (such as the
+                # "Show more" requests) until they are read.
+                driver.get_log("performance")
+            else:
+                extract_uid_from_recordings(driver, sorted(indices_to_download), window_metadata)
+            if not download_duplicates:
+                indices_to_download = merge_migrated_recordings(window_metadata, indices_to_download, known_metadata)
+            print_log(f"Found {len(indices_to_download)} new recordings in this window.")
+            driver.execute_script("arguments[0].forEach(function (box) { box.remove(); });", recording_boxes)
+            return window_metadata
+
+        if watchdog is not None:
+            window_metadata = watchdog.run("extract", extract_window)
+        else:
+            window_metadata = extract_window()
+        num_boxes += len(recording_boxes)
+        del recording_boxes
+        yield window_metadata
+
+    print_log(f"Extracted {num_boxes} recordings in windows of {window_size}.")
+
+
+def extract_recordings_in_windows(
+    driver: WebDriver,
+    old_metadata: List[Dict[str, Any]],
+    download_duplicates: bool,
+    window_size: int,
+    recording_filter: Optional[Callable[[Dict[str, Any]], bool]] = None,
+    watchdog: Optional[DriverWatchdog] = None,
+    on_window_extracted: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+    audio_id_resolver: Optional[UidResolver] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Extracts the metadata and audio IDs of all of the recordings, window_size at a time (see
+    iter_recording_windows).
+
+    :param driver: The WebDriver, with the recordings searched for (see iter_recording_windows).
+    :param old_metadata: The metadata collected from the previous run(s) (if any).
+    :param download_duplicates: Whether the script should find the metadata for recordings that already exist
+        within the config file or not.
+    :param window_size: Number of recording boxes to work on at a time.
+    :param recording_filter: If given, only the recordings for which it returns True are kept.
+    :param watchdog: If given, each window has to be extracted within the watchdog's "extract" budget.
+    :param on_window_extracted: Called with the metadata of all of the recordings extracted so far after each
+        window, so that the progress can be saved. Default is None.
+    :param audio_id_resolver: If given, the audio IDs of each window are resolved in batches with it, instead
+        of expanding every recording box.
+
+    :return: The metadata for all of the recordings, with the audio IDs of the recordings to download.
+    """
+    recording_metadata = []
+    for window_metadata in iter_recording_windows(
+        driver, old_metadata, download_duplicates, window_size, recording_filter, watchdog, audio_id_resolver
+    ):
+        recording_metadata.extend(window_metadata)
+        if on_window_extracted is not None:
+            on_window_extracted(recording_metadata)
+    return recording_metadata
+
+
 def get_wav_from_audio_id(
     audio_id: str, user_agent: str, cookies: Dict[str, Any], audio_file: str
 ) -> None:
@@ -503,14 +1071,257 @@ def get_wav_from_audio_id(
 
     :return: None; writes the audio file to disk.
     """
-    url_base = "https://www.amazon.com/alexa-privacy/apd/rvh/audio?uid="
-    full_url = url_base + audio_id
+    full_url = AUDIO_URL_BASE + audio_id
     headers = {"User-Agent": user_agent}
     response = requests.get(full_url, headers=headers, cookies=cookies)
     with open(audio_file, "wb+") as f:
         f.write(response.content)
 
 
+def get_auth_failure(response: requests.Response, body_start: Optional[bytes] = None) -> Optional[str]:
+    """
+    Checks whether the response to an audio request looks like amazon.com did not accept the session's
+    cookies. In that case, amazon.com answers with an error status or with a (sign-in) page instead of the
+    recording.
+
+    :param response: The response to the audio request.
+    :param body_start: The first bytes of the body, for a streamed response. If None, then the body is read
+        from the response.
+
+    :return: The reason why the session was not accepted, or None if the response is not an auth failure.
+    """
+    if response.status_code in (401, 403):
+        return f"status {response.status_code}"
+    if response.status_code != 200:
+        return None
+    if "text/html" in response.headers.get("Content-Type", ""):
+        return "an html page was returned"
+    if (body_start if body_start is not None else response.content)[:4] != b"RIFF":
+        return "the response is not a wav file"
+    return None
+
+
+class AudioSession:
+    """
+    Downloads recordings with the cookies of a live driver session. amazon.com rotates the session cookies and
+    can end the session during long downloads, so instead of using one snapshot of the cookies:
+        - the cookies are pulled from the driver again every keep_alive_seconds (after checking that the
+          driver is still logged in, which also keeps the session active), and
+        - a request that is not authorized makes the session pull fresh cookies from the driver (or log in
+          again, if the driver's session has ended) and retry the request.
+    A request that fails on the network (a connection error, a timeout or a cut off response) is retried after
+    a backoff. Error pages are never saved as recordings, and a recording that cannot be downloaded (even when
+    the driver fails while refreshing the session) is reported as not saved instead of raising the error.
+    """
+
+    def __init__(
+        self,
+        driver: WebDriver,
+        user_agent: str,
+        log_in_again: Callable[[], List[Dict[str, Any]]],
+        keep_alive_seconds: float = 10 * 60,
+        max_retries: int = 2,
+        audio_url_base: str = AUDIO_URL_BASE,
+    ) -> None:
+        """
+        :param driver: The logged in WebDriver.
+        :param user_agent: The user agent of the WebDriver.
+        :param log_in_again: Logs the driver in again and returns the new cookies (see log_in).
+        :param keep_alive_seconds: Number of seconds after which the cookies are refreshed from the driver.
+        :param max_retries: Number of times an unauthorized request is retried with refreshed cookies, and a
+            request that failed on the network is retried.
+        :param audio_url_base: The url that the audio ID is appended to, to download a recording (for example the
+            one of a replay server, see session_replay.py).
+        """
+        self.driver = driver
+        self.audio_url_base = audio_url_base
+        self.log_in_again = log_in_again
+        self.keep_alive_seconds = keep_alive_seconds
+        self.max_retries = max_retries
+        self.num_refreshes = 0
+        # Downloads can run in several threads (see download_wav_files), but the driver can only be used by one.
+        self.refresh_lock = threading.Lock()
+        self.num_page_holds = 0
+        self.http = requests.Session()
+        self.http.headers.update({"User-Agent": user_agent})
+        self.last_refresh = 0.0
+        self.update_cookies(driver.get_cookies())
+
+    def update_cookies(self, cookies: List[Dict[str, Any]]) -> None:
+        """
+        :param cookies: The driver's cookies to send with the audio requests from now on.
+
+        :return: None.
+        """
+        self.http.cookies.clear()
+        for name, value in format_cookies_for_request(cookies).items():
+            self.http.cookies.set(name, value)
+        self.last_refresh = time.time()
+
+    def refresh(self) -> None:
+        """
+        Pulls fresh cookies from the driver. If the driver is no longer logged in, then the user logs in again
+        first. While the page is held (see hold_page), the cookies are pulled without checking the login.
+
+        :return: None.
+        """
+        with self.refresh_lock:
+            self.num_refreshes += 1
+            if self.num_page_holds > 0:
+                # Checking the login navigates away from the page that the recordings are extracted from.
+                self.update_cookies(self.driver.get_cookies())
+            elif is_logged_in(self.driver):
+                self.update_cookies(self.driver.get_cookies())
+            else:
+                print_log("The session has ended. Logging in again.")
+                self.update_cookies(self.log_in_again())
+
+    def refresh_cookies(self) -> None:
+        """
+        Pulls fresh cookies from the driver, without checking the login (which navigates the driver). This is
+        how the uidArray[] requests refresh the session, since they are sent in the middle of the extraction.
+
+        :return: None.
+        """
+        with self.refresh_lock:
+            self.num_refreshes += 1
+            self.update_cookies(self.driver.get_cookies())
+
+    @contextlib.contextmanager
+    def hold_page(self) -> Iterator[None]:
+        """
+        Keeps the driver on its current page while recordings are still being extracted from it, such as while
+        a generator of recordings is consumed. Refreshing the session in the meantime only pulls the driver's
+        cookies.
+
+        :return: A context manager.
+        """
+        with self.refresh_lock:
+            self.num_page_holds += 1
+        try:
+            yield
+        finally:
+            with self.refresh_lock:
+                self.num_page_holds -= 1
+
+    def try_refresh(self) -> bool:
+        """
+        Refreshes the session (see refresh), without letting a driver error end the downloads of the user.
+
+        :return: Whether the session was refreshed.
+        """
+        try:
+            self.refresh()
+            return True
+        except WebDriverException as e:
+            print_log(f"WARNING: The session could not be refreshed: {e}")
+            return False
+
+    def wait_before_retry(self, audio_id: str, error: Exception, attempt: int) -> None:
+        """
+        Waits before retrying a request that failed on the network, for longer after every attempt.
+
+        :param audio_id: The audio id of the recording.
+        :param error: The error of the request.
+        :param attempt: The number of the attempt that failed, starting at 0.
+
+        :return: None.
+        """
+        delay = AUDIO_RETRY_BACKOFF_SECONDS * 2 ** attempt
+        print_log(f"WARNING: The request for recording {audio_id} failed ({error}). Trying again in {delay:g} seconds.")
+        time.sleep(delay)
+
+    def download(self, audio_id: str, audio_file: str) -> bool:
+        """
+        Downloads one recording, refreshing the session and retrying if the request is not authorized.
+
+        :param audio_id: The audio id of the recording.
+        :param audio_file: The string location of the audio file to be saved.
+
+        :return: Whether the recording was saved.
+        """
+        if time.time() - self.last_refresh > self.keep_alive_seconds:
+            self.try_refresh()
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.http.get(self.audio_url_base + audio_id, timeout=AUDIO_REQUEST_TIMEOUT_SECONDS)
+            except requests.RequestException as e:
+                if attempt < self.max_retries:
+                    self.wait_before_retry(audio_id, e, attempt)
+                    continue
+                print_log(f"ERROR: Recording {audio_id} could not be downloaded: {e}")
+                return False
+            auth_failure = get_auth_failure(response)
+            if auth_failure is None and response.status_code == 200:
+                with open(audio_file, "wb+") as f:
+                    f.write(response.content)
+                return True
+            if auth_failure is None:
+                print_log(f"WARNING: The request for recording {audio_id} failed with status {response.status_code}.")
+                return False
+            if attempt < self.max_retries:
+                print_log(
+                    f"WARNING: The request for recording {audio_id} was not authorized ({auth_failure}). "
+                    "Refreshing the session and trying again."
+                )
+                if not self.try_refresh():
+                    break
+
+        print_log(f"ERROR: Recording {audio_id} could not be downloaded, even with a refreshed session.")
+        return False
+
+    def stream(self, audio_id: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """
+        Streams one recording in chunks instead of holding all of it in memory, refreshing the session and
+        retrying if the request is not authorized (like download).
+
+        :param audio_id: The audio id of the recording.
+        :param chunk_size: Number of bytes per chunk.
+
+        :return: A generator of the chunks of the wav file. Raises IOError if the recording could not be
+            downloaded, or if the response is cut off after its first chunk (which cannot be retried, since the
+            chunks before it were already passed on).
+        """
+        if time.time() - self.last_refresh > self.keep_alive_seconds:
+            self.try_refresh()
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.http.get(
+                    self.audio_url_base + audio_id, timeout=AUDIO_REQUEST_TIMEOUT_SECONDS, stream=True
+                )
+                chunks = response.iter_content(chunk_size)
+                first_chunk = next(chunks, b"") if response.status_code == 200 else b""
+            except requests.RequestException as e:
+                if attempt < self.max_retries:
+                    self.wait_before_retry(audio_id, e, attempt)
+                    continue
+                raise IOError(f"Recording {audio_id} could not be downloaded: {e}") from e
+            auth_failure = get_auth_failure(response, body_start=first_chunk)
+            if auth_failure is None and response.status_code == 200:
+                try:
+                    yield first_chunk
+                    yield from chunks
+                except requests.RequestException as e:
+                    raise IOError(f"The download of recording {audio_id} was cut off: {e}") from e
+                finally:
+                    response.close()
+                return
+            response.close()
+            if auth_failure is None:
+                raise IOError(f"The request for recording {audio_id} failed with status {response.status_code}.")
+            if attempt < self.max_retries:
+                print_log(
+                    f"WARNING: The request for recording {audio_id} was not authorized ({auth_failure}). "
+                    "Refreshing the session and trying again."
+                )
+                if not self.try_refresh():
+                    break
+
+        raise IOError(f"Recording {audio_id} could not be downloaded, even with a refreshed session.")
+
+
 def get_recording_path(
     date: str, output_folder: str, username: str, make_new_folder: bool = True
 ):
@@ -551,28 +1362,12 @@ def get_recording_path(
     if not os.path.exists(user_folder_full_path):
         os.mkdir(user_folder_full_path)
 
-    date_folder_full_path = os.path.join(user_folder_full_path, date_folder_name)
-    if not os.path.exists(date_folder_full_path):
-        os.mkdir(date_folder_full_path)
-
-    recording_trials = [
-        int(str(r.name)) for r in Path(date_folder_full_path).iterdir() if r.is_dir()
-    ]
-    new_recording_trial = max(recording_trials) + 1 if len(recording_trials) > 0 else 0
     if make_new_folder:
-        next_iteration_folder = os.path.join(
-            date_folder_full_path, str(new_recording_trial)
-        )
-        if not os.path.exists(next_iteration_folder):
-            os.mkdir(next_iteration_folder)
-
-        return next_iteration_folder
+        return allocate_run(user_folder_full_path, date_folder_name)
     else:
-        if new_recording_trial > 0:
-            next_iteration_folder = os.path.join(
-                date_folder_full_path, str(new_recording_trial - 1)
-            )
-            return next_iteration_folder
+        latest_run = get_latest_run(user_folder_full_path, date_folder_name)
+        if latest_run is not None:
+            return latest_run
         else:
             raise ValueError(
                 "There are no recordings for this date. Therefore, the folder path of the recording "
@@ -596,6 +1391,7 @@ def save_metadata(
     metadata_path = os.path.join(recording_path, metadata_file_name)
     with open(metadata_path, "w+") as metadata_file:
         json.dump(metadata, metadata_file, indent=4)
+    journal_run_files(recording_path, [metadata_file_name])
 
 
 def save_errors(
@@ -613,29 +1409,97 @@ def save_errors(
     error_path = os.path.join(recording_path, error_file_name)
     with open(error_path, "w+") as error_file:
         json.dump(errors, error_file, indent=4)
+    journal_run_files(recording_path, [error_file_name])
 
 
 def download_wav_files(
     audio_ids: List[str],
-    user_agent: str,
-    cookies: Dict[str, Any],
+    session: AudioSession,
     recording_path: str,
-) -> None:
+    on_file_saved: Optional[Callable[[str, str], None]] = None,
+    skip_existing: bool = False,
+    scheduler: Optional[DownloadScheduler] = None,
+    workers: int = 1,
+) -> List[str]:
     """
     Downloads all of the wav files given audio ids and output location.
 
     :param audio_ids: Audio IDs of the recordings to be downloaded.
-    :param user_agent: The user agent of the WebDriver.
-    :param cookies: The cookies of the WebDriver's session
+    :param session: The session to download the recordings with.
     :param recording_path: Directory path to save the recordings in.
-
-    :return: None; creates a directory structure and saves all recording files appropriately.
+    :param on_file_saved: Called with the audio id and the file path of each recording as soon as it is saved,
+        so that post-download stages can overlap with the rest of the downloads. Default is None.
+    :param skip_existing: Whether recordings that were already downloaded (by an earlier attempt of the run)
+        as valid wav files should be skipped. Default is False.
+    :param scheduler: If given, the recordings are downloaded in the scheduler's order, and the downloads stop
+        (writing the recordings that are left, and the ones that failed, to the run's pending file) once the
+        next one would not finish before the scheduler's deadline. Default is None.
+    :param workers: Number of recordings to download at a time (in threads that share the session). Default
+        is 1.
+
+    :return: The audio IDs of the recordings that could not be downloaded. Saves all recording files
+        appropriately.
     """
 
-    print_log("Downloading wav files.")
-    for i, audio_id in enumerate(audio_ids):
-        audio_file = os.path.join(recording_path, f"{i}.wav")
-        get_wav_from_audio_id(audio_id, user_agent, cookies, audio_file)
+    print_log("Downloading wav files." if workers <= 1 else f"Downloading wav files, {workers} at a time.")
+    failed_audio_ids = []
+    failed_positions = []
+    not_started_positions = []
+    order = scheduler.get_order() if scheduler is not None else list(range(len(audio_ids)))
+    # The downloads that are running, with the position of their recording and when they started.
+    running: Dict[Future, Tuple[int, float]] = {}
+    num_finished = 0
+
+    def finish_downloads(wait_for_all: bool) -> None:
+        nonlocal num_finished
+        finished, _ = wait(running, return_when=ALL_COMPLETED if wait_for_all else FIRST_COMPLETED)
+        for future in finished:
+            i, download_started = running.pop(future)
+            num_finished += 1
+            audio_file = os.path.join(recording_path, f"{i}.wav")
+            if not future.result():
+                failed_audio_ids.append(audio_ids[i])
+                failed_positions.append(i)
+                continue
+            journal_run_files(recording_path, [os.path.basename(audio_file)])
+            if scheduler is not None:
+                scheduler.record_download(time.time() - download_started, audio_file)
+                scheduler.report_progress(len(order) - num_finished)
+            if on_file_saved is not None:
+                on_file_saved(audio_ids[i], audio_file)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for num_started, i in enumerate(order):
+            audio_id = audio_ids[i]
+            audio_file = os.path.join(recording_path, f"{i}.wav")
+            if skip_existing and is_valid_wav_file(audio_file):
+                print_log(f"Recording #{i + 1} was already downloaded.")
+                num_finished += 1
+                if on_file_saved is not None:
+                    on_file_saved(audio_id, audio_file)
+            elif scheduler is not None and not scheduler.has_time_for_next():
+                not_started_positions = [
+                    j
+                    for j in order[num_started:]
+                    if not (skip_existing and is_valid_wav_file(os.path.join(recording_path, f"{j}.wav")))
+                ]
+                break
+            else:
+                while len(running) >= max(workers, 1):
+                    finish_downloads(wait_for_all=False)
+                running[executor.submit(session.download, audio_id, audio_file)] = (i, time.time())
+        finish_downloads(wait_for_all=True)
+
+    if scheduler is not None:
+        # Only written once the running downloads are finished, so that the ones that failed are listed too.
+        scheduler.save_pending(recording_path, not_started_positions, failed_positions)
+
+    if len(failed_audio_ids) > 0:
+        print_log(
+            f"WARNING: {len(failed_audio_ids)} recordings could not be downloaded. "
+            "Run \"python verify_recordings.py verify\" and \"repair\" to download them later."
+        )
+    return failed_audio_ids
 
 
 def get_recordings(
@@ -649,6 +1513,23 @@ def get_recordings(
     path_where_recordings_are_saved: str,
     download_duplicates: bool = False,
     system: str = "linux",
+    analyze_audio: bool = False,
+    compress_audio: bool = False,
+    window_size: Optional[int] = None,
+    reuse_session: bool = False,
+    until_date: Optional[str] = None,
+    devices: Optional[List[str]] = None,
+    watchdog: Optional[DriverWatchdog] = None,
+    uid_batch_size: Optional[int] = None,
+    uid_endpoint: Optional[str] = None,
+    challenges: Optional[ChallengeQueue] = None,
+    resume_from: Optional[str] = None,
+    download_priority: Optional[str] = None,
+    deadline: Optional[float] = None,
+    known_audio_ids: Optional[Set[str]] = None,
+    download_workers: int = 1,
+    earlier_metadata: Optional[List[Dict[str, Any]]] = None,
+    on_progress: Optional[Callable[[], None]] = None,
 ) -> None:
     """
     Logs in, searches for recordings, makes recording metadata, and downloads recordings. This function is the
@@ -666,54 +1547,192 @@ def get_recordings(
     :param user_agent: The user agent of the driver.
     :param path_where_recordings_are_saved: Directory path of where the recordings will be saved.
     :param system: The OS where the script is running.
+    :param analyze_audio: Whether the duration, sample rate, loudness and silence ratio of every downloaded
+        recording should be added to the metadata.
+    :param compress_audio: Whether every downloaded recording should be compressed losslessly (while the other
+        recordings are still downloading). The original wav files are deleted once they are compressed.
+    :param window_size: If given, the recordings are extracted this many at a time and removed from the page
+        afterwards, which keeps the memory use of Chrome flat for accounts with very many recordings.
+    :param reuse_session: Whether to skip the login if the driver is still logged in (see log_in).
+    :param until_date: The latest date to search for recordings from. If None, then the date range of
+        recordings goes until the date the script is ran on.
+    :param devices: The names of the devices to get the recordings of. If None, then the recordings of every
+        device are downloaded.
+    :param watchdog: If given, every phase gets a time budget (a PhaseTimeout is raised when it runs out), and
+        the progress of the run is saved in the run folder, so that a new attempt of the run (with a new
+        driver) continues from the last extracted recording and skips the recordings already downloaded.
+    :param uid_batch_size: If given, the audio IDs are resolved this many at a time with the uidArray[]
+        endpoint (see uid_resolver.py), instead of expanding every recording box.
+    :param uid_endpoint: The uidArray[] endpoint to resolve the audio IDs with. If None, then the endpoint is
+        taken from the request that the page sends when the first recording box is expanded.
+    :param challenges: If given, the login raises ChallengePending instead of waiting for the operator (see
+        log_in).
+    :param resume_from: The answered challenge step to continue a parked login from (see log_in).
+    :param download_priority: The order to download the recordings in (one of DOWNLOAD_PRIORITIES). If None
+        (and there is no deadline), then the recordings are downloaded in the order of the page.
+    :param deadline: The time (as a timestamp) by which the downloads have to be finished. The recordings that
+        are left when it comes are written to the run's pending file (see DownloadScheduler).
+    :param known_audio_ids: The audio IDs that are already in the catalog, for the "unknown" priority.
+    :param download_workers: Number of recordings to download at a time (see download_wav_files).
+    :param earlier_metadata: The metadata of the earlier date ranges of the same run (see run_planner.py), which
+        were saved in path_where_recordings_are_saved already. These recordings are kept first in the metadata,
+        so that their wav files keep their numbers and are not downloaded again.
+    :param on_progress: Called whenever the run makes progress (after each phase, recording box, extraction
+        window and download), such as to keep renewing a work queue lease (see Lease.heartbeat).
 
     :return: None.
     """
     print_log("Starting metadata extraction.")
 
-    enter_username_and_password(driver, username, password, slow=True, remember_me=True)
-    captcha(driver, username, password)
-    email_verification(driver)
+    def report_progress(*args: Any) -> None:
+        if on_progress is not None:
+            on_progress()
 
-    print_log("Loading old cookies.")
-
-    cookies = driver.get_cookies()
-    dump_cookies(cookies_file, cookies)
+    def run_phase(phase: str, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        if watchdog is None:
+            result = func(*args, **kwargs)
+        else:
+            result = watchdog.run(phase, func, *args, **kwargs)
+        report_progress()
+        return result
 
-    try:
-        search_for_recordings(driver, end_date, system=system)
-        reveal_all_recordings(driver)
-    except (
-        WebDriverException,
-        NoSuchElementException,
-        ProtocolError,
-        RemoteDisconnected,
-        TimeoutException
-    ):
-        driver.implicitly_wait(5)
-        print_log(
-            "WARNING: Finding the recordings errored out. Trying to search again."
-        )
-        search_for_recordings(driver, end_date, system=system)
-        driver.implicitly_wait(5)
-        reveal_all_recordings(driver)
+    def search_and_reveal() -> None:
+        search_for_recordings(driver, end_date, system=system, end_date=until_date, devices=devices)
         driver.implicitly_wait(5)
-    except ProtocolError as e:
-        print_log(
-            "ERROR. Amazon has closed this connection, likely because it has identified this script "
-            "and will stop it. This can happen from time to time. Please run this script again."
+        # The windows reveal the hidden recordings as they go instead (see iter_recording_windows).
+        if watchdog is None and window_size is None:
+            reveal_all_recordings(driver)
+            driver.implicitly_wait(5)
+
+    run_phase(
+        "login",
+        log_in,
+        driver,
+        username,
+        password,
+        cookies_file,
+        reuse_session=reuse_session,
+        challenges=challenges,
+        resume_from=resume_from,
+    )
+    audio_session = AudioSession(
+        driver, user_agent, log_in_again=lambda: log_in(driver, username, password, cookies_file)
+    )
+
+    # An earlier attempt of this run (that was stopped by the watchdog) may have already extracted recordings.
+    progress = load_progress(path_where_recordings_are_saved) if watchdog is not None else None
+    resumed_metadata = progress["metadata"] if progress is not None else []
+
+    if progress is not None and progress["finished"]:
+        print_log(f"Continuing with the {len(resumed_metadata)} recordings that were already extracted.")
+        recording_metadata = resumed_metadata
+    else:
+        try:
+            run_phase("search", search_and_reveal)
+        except (
+            WebDriverException,
+            NoSuchElementException,
+            ProtocolError,
+            RemoteDisconnected,
+            TimeoutException
+        ):
+            driver.implicitly_wait(5)
+            print_log(
+                "WARNING: Finding the recordings errored out. Trying to search again."
+            )
+            run_phase("search", search_and_reveal)
+        except ProtocolError as e:
+            print_log(
+                "ERROR. Amazon has closed this connection, likely because it has identified this script "
+                "and will stop it. This can happen from time to time. Please run this script again."
+            )
+            raise e
+
+        previous_path = find_last_recording_folder(path_where_recordings_are_saved)
+        old_recording_metadata = get_old_metadata(
+            os.path.join(previous_path, info_file.split("/")[-1]) if previous_path is not None else None
         )
-        raise e
+        if len(resumed_metadata) > 0:
+            # The recordings that were already extracted are skipped like recordings from an earlier run.
+            print_log(f"Skipping the {len(resumed_metadata)} recordings that were already extracted.")
+            old_recording_metadata = resumed_metadata + ([] if download_duplicates else old_recording_metadata)
+            download_duplicates = False
+
+        # The page is already filtered, but the recordings are checked again in case the filters were not applied.
+        recording_filter: Optional[Callable[[Dict[str, Any]], bool]] = None
+        if until_date is not None or devices:
+            today = datetime.date.today()
+            start_day = parse_input_date(end_date)
+            end_day = parse_input_date(until_date) if until_date is not None else None
+
+            def matches_filters(recording: Dict[str, Any]) -> bool:
+                return recording_matches_filters(recording, today, start_day, end_day, devices)
+
+            recording_filter = matches_filters
+
+        uid_resolver = None
+        if uid_batch_size is not None:
+            endpoint = uid_endpoint if uid_endpoint is not None else discover_uid_endpoint(driver)
+            if endpoint is None:
+                print_log("WARNING: The uidArray[] endpoint was not found. Expanding every recording instead.")
+            else:
+                uid_resolver = UidResolver(audio_session.http, endpoint, uid_batch_size, audio_session.refresh_cookies)
 
-    recording_boxes = driver.find_elements_by_class_name("apd-content-box")
-    previous_path = find_last_recording_folder(path_where_recordings_are_saved)
-    old_recording_metadata = get_old_metadata(os.path.join(previous_path, info_file))
+        def save_window_progress(metadata: List[Dict[str, Any]]) -> None:
+            save_progress(path_where_recordings_are_saved, metadata, finished=False)
+            report_progress()
 
-    recording_metadata, indices_to_download = extract_recording_metadata(
-        recording_boxes, driver, old_recording_metadata, download_duplicates
-    )
+        if watchdog is not None:
+            # Extract in windows, so that the progress can be saved and each window has its own time budget.
+            recording_metadata = extract_recordings_in_windows(
+                driver,
+                old_recording_metadata,
+                download_duplicates,
+                window_size if window_size is not None else DEFAULT_WATCHDOG_WINDOW_SIZE,
+                recording_filter,
+                watchdog=watchdog,
+                on_window_extracted=save_window_progress,
+                audio_id_resolver=uid_resolver,
+            )
+            save_progress(path_where_recordings_are_saved, recording_metadata, finished=True)
+        elif window_size is not None:
+            recording_metadata = extract_recordings_in_windows(
+                driver,
+                old_recording_metadata,
+                download_duplicates,
+                window_size,
+                recording_filter,
+                on_window_extracted=report_progress,
+                audio_id_resolver=uid_resolver,
+            )
+        else:
+            recording_boxes = driver.find_elements_by_class_name("apd-content-box")
+            recording_metadata, indices_to_download = extract_recording_metadata(
+                recording_boxes,
+                driver,
+                old_recording_metadata,
+                download_duplicates,
+                recording_filter=recording_filter,
+                expand=uid_resolver is None,
+                on_progress=on_progress,
+            )
+            if uid_resolver is not None:
+                uid_resolver.attach_audio_ids(recording_metadata, sorted(indices_to_download))
+            else:
+                extract_uid_from_recordings(driver, sorted(indices_to_download), recording_metadata)
+            if not download_duplicates:
+                indices_to_download = merge_migrated_recordings(
+                    recording_metadata, indices_to_download, index_old_metadata(old_recording_metadata)
+                )
+            print_log(f"Found {len(indices_to_download)} new recordings.")
 
-    extract_uid_from_recordings(driver, sorted(indices_to_download), recording_metadata)
+    if earlier_metadata:
+        earlier_recordings = index_old_metadata(earlier_metadata)
+        recording_metadata = earlier_metadata + [
+            metadata
+            for metadata in recording_metadata
+            if find_div_id_in_metadata(metadata.get("div_id"), earlier_recordings, metadata.get("audio_id")) is None
+        ]
 
     metadata_file_name = info_file.split("/")[-1]
     save_metadata(
@@ -723,14 +1742,61 @@ def get_recordings(
     )
 
     recording_ids = get_audio_ids(recording_metadata)
-    formatted_cookies = format_cookies_for_request(cookies)
-    download_wav_files(
-        audio_ids=recording_ids,
-        user_agent=user_agent,
-        cookies=formatted_cookies,
-        recording_path=path_where_recordings_are_saved,
-    )
+    scheduler = None
+    if download_priority is not None or deadline is not None:
+        scheduler = DownloadScheduler(
+            username, recording_metadata, download_priority or NEWEST_FIRST, deadline, known_audio_ids
+        )
+    compression_executor = ProcessPoolExecutor() if compress_audio else None
+    compression_futures: Dict[str, Future] = {}
+
+    def on_file_saved(audio_id: str, audio_file: str) -> None:
+        report_progress()
+        if compress_audio:
+            compression_futures[audio_id] = compression_executor.submit(compress_file, audio_file)
+
+    try:
+        download_wav_files(
+            audio_ids=recording_ids,
+            session=audio_session,
+            recording_path=path_where_recordings_are_saved,
+            on_file_saved=on_file_saved,
+            skip_existing=watchdog is not None or bool(earlier_metadata),
+            scheduler=scheduler,
+            workers=download_workers,
+        )
+    finally:
+        if compression_executor is not None:
+            compression_executor.shutdown(wait=True)
+
+    if analyze_audio:
+        print_log("Analyzing the downloaded recordings.")
+        analyze_run(path_where_recordings_are_saved, metadata_file_name, workers=os.cpu_count() or 1)
+
+    if compress_audio:
+        print_log("Recording the compressed sizes of the recordings.")
+        recording_metadata = get_old_metadata(os.path.join(path_where_recordings_are_saved, metadata_file_name))
+        for recording in recording_metadata:
+            future = compression_futures.get(recording.get("audio_id"))
+            if future is not None and future.exception() is None and future.result() is not None:
+                recording.update(future.result())
+        save_metadata(
+            metadata=recording_metadata,
+            recording_path=path_where_recordings_are_saved,
+            metadata_file_name=metadata_file_name,
+        )
+        journal_run_files(
+            path_where_recordings_are_saved,
+            [
+                os.path.basename(get_compressed_path(wav_path))
+                for wav_path in get_recording_files(recording_metadata, path_where_recordings_are_saved).values()
+                if os.path.isfile(get_compressed_path(wav_path))
+            ],
+        )
+        remove_compressed_originals(recording_metadata, path_where_recordings_are_saved)
 
+    if watchdog is not None:
+        clear_progress(path_where_recordings_are_saved)
     print_log(f"Finished downloading all recordings for user {username}.")
 
 
@@ -746,6 +1812,29 @@ def get_recordings_for_all_users(
     user: Optional[str],
     download_duplicates: bool = False,
     system: str = "linux",
+    index_file: Optional[str] = None,
+    analyze_audio: bool = False,
+    compress_audio: bool = False,
+    queue_dir: Optional[str] = None,
+    lease_seconds: float = 300.0,
+    max_stall_seconds: Optional[float] = DEFAULT_MAX_STALL_SECONDS,
+    window_size: Optional[int] = None,
+    lean_driver: bool = False,
+    profiles_dir: Optional[str] = None,
+    max_profile_bytes: int = DEFAULT_MAX_PROFILE_MEGABYTES * 1024 * 1024,
+    until_date: Optional[str] = None,
+    devices: Optional[List[str]] = None,
+    phase_budgets: Optional[Dict[str, float]] = None,
+    max_restarts: int = 3,
+    uid_batch_size: Optional[int] = None,
+    uid_endpoint: Optional[str] = None,
+    challenges_dir: Optional[str] = None,
+    challenge_timeout: float = DEFAULT_CHALLENGE_TIMEOUT_SECONDS,
+    time_budget: Optional[float] = None,
+    download_priority: Optional[str] = None,
+    export_dir: Optional[str] = None,
+    download_workers: int = 1,
+    plan_run: bool = False,
 ) -> None:
     """
     Runs the recording script for all users. If one user errors out, then the script will record the error
@@ -765,6 +1854,48 @@ def get_recordings_for_all_users(
     :param user: A specific user to run this script for.
     :param user_agent: The user agent of the driver.
     :param system: The OS where the script is running.
+    :param index_file: The search index to add each finished run to. If None, then no index is updated.
+    :param analyze_audio: Whether the duration, sample rate, loudness and silence ratio of every downloaded
+        recording should be added to the metadata.
+    :param compress_audio: Whether every downloaded recording should be compressed losslessly.
+    :param queue_dir: A directory (shared between machines) to use as a work queue of users. If given, then
+        every user is leased from the queue before it is worked on, so that any number of workers can run this
+        script on the same credentials file without processing a user twice. If None, then every user is run.
+    :param lease_seconds: Number of seconds after which a worker's lease on a user expires if it is not renewed.
+    :param max_stall_seconds: Number of seconds without progress after which a worker stops renewing its lease on
+        a user (see Lease.heartbeat). If None, then a lease is renewed until the user is finished.
+    :param window_size: If given, the number of recordings to extract at a time (see get_recordings).
+    :param lean_driver: Whether the drivers should block the resources that are not needed (see create_driver).
+    :param profiles_dir: The folder to keep a persistent Chrome profile per user in, so that the cache and the
+        login are reused by the next run. If None, then every driver starts with a temporary profile.
+    :param max_profile_bytes: The size cap of each Chrome profile, in bytes.
+    :param until_date: The latest date to search for recordings from (see get_recordings).
+    :param devices: The names of the devices to get the recordings of (see get_recordings).
+    :param phase_budgets: If given, a watchdog puts these time budgets (in seconds, by phase) on every run, and
+        a user whose driver hangs or crashes is continued with a new driver (see DriverWatchdog). If None, then
+        there is no watchdog.
+    :param max_restarts: Number of times that the driver of one user can be restarted by the watchdog.
+    :param uid_batch_size: If given, the number of audio IDs to resolve per request (see get_recordings).
+    :param uid_endpoint: The uidArray[] endpoint to resolve the audio IDs with (see get_recordings).
+    :param challenges_dir: If given, the captchas, two-step codes and email verifications are posted to a
+        challenge queue in this folder instead of blocking the script. A challenged user is parked with its
+        driver kept on the challenge page, the other users keep running, and the user continues once the
+        operator has answered (see challenges.py). If None, then the script waits for the answer on the console.
+    :param challenge_timeout: Number of seconds that a parked user waits for its challenge to be answered
+        before it errors out.
+    :param time_budget: If given, the number of seconds that the whole script may run for. Downloads stop
+        when the next one would not finish in time (the recordings that are left are written to each run's
+        pending file), and no new user or date range is started once the time is up. A user whose date ranges
+        were not all run gets a partial run, with the date ranges that are left in its error file.
+    :param download_priority: The order to download the recordings of each user in (one of
+        DOWNLOAD_PRIORITIES; see get_recordings).
+    :param export_dir: The columnar export to add each finished run to (see analytics_export.py). If None, then
+        nothing is exported.
+    :param download_workers: Number of recordings to download at a time (see download_wav_files).
+    :param plan_run: Whether to plan the run first (see RunPlanner): the users are run longest first, the date
+        range of a user with many recordings is split into several runs (except with a queue_dir), and the
+        number of downloads at a time is picked per user instead of download_workers. The planned and the actual
+        numbers of every run are appended to plans.jsonl in the output folder.
 
     :return: None.
     """
@@ -774,37 +1905,242 @@ def get_recordings_for_all_users(
         print_log("ERROR: Please modify the credentials.json file and add an account to use.")
         return
 
+    deadline = time.time() + time_budget if time_budget is not None else None
+    known_audio_ids = None
+    if download_priority == UNKNOWN_FIRST:
+        if index_file is None:
+            print_log("WARNING: Without an index (--index), every recording counts as unknown to the catalog.")
+        else:
+            known_audio_ids = get_catalog_audio_ids(index_file)
+
+    def is_out_of_time() -> bool:
+        return deadline is not None and time.time() >= deadline
+
     today_date = get_today_date_mm_dd_yyyy()
     error_file_name = "errors.json"
     output_dir_name = output_dir.split("/")[-1]
 
-    for i, credentials_for_one_user in enumerate(credentials):
-        web_driver = create_driver(
-            user_agent=user_agent,
-            show=show_driver,
-            system=system,
-            driver_location=driver_location,
-        )
+    planner = None
+    user_plans: Dict[int, UserPlan] = {}
+    # The runs to do, as (user index, shard of the plan) pairs.
+    jobs: List[Tuple[int, Optional[Dict[str, Any]]]] = [(i, None) for i in range(total_users)]
+    if plan_run:
+        planner = RunPlanner(output_dir_name, end_date, until_date, index_file, download_duplicates)
+        plans = planner.plan([credentials_for_one_user["username"] for credentials_for_one_user in credentials])
+        planner.print_plan(plans)
+        user_plans = {user_plan.user_index: user_plan for user_plan in plans}
+        if queue_dir is None:
+            jobs = [(user_plan.user_index, shard) for user_plan in plans for shard in user_plan.shards]
+        else:
+            jobs = [(user_plan.user_index, planner.get_unsharded(user_plan)) for user_plan in plans]
+
+    # The run folder of every user whose plan is split into shards. All of the shards of a user are run into
+    # one run folder, which is only completed after the last one, so that it holds the user's whole catalog.
+    # Between two shards, the user's logged in driver is kept in the "session" of its shard run.
+    shard_runs: Dict[int, Dict[str, Any]] = {}
+
+    challenge_queue = ChallengeQueue(challenges_dir) if challenges_dir is not None else None
+    # The users that are waiting on a challenge, with their drivers kept alive, by job index (by user index with
+    # a queue_dir).
+    parked: Dict[int, Dict[str, Any]] = {}
+    # The work queue leases of the users that are being worked on, by user index (with a queue_dir).
+    leases: Dict[int, Lease] = {}
+
+    def run_user(
+        i: int,
+        credentials_for_one_user: Dict[str, str],
+        parked_run: Optional[Dict[str, Any]] = None,
+        shard: Optional[Dict[str, Any]] = None,
+        key: Optional[int] = None,
+    ) -> Optional[str]:
+        """
+        Runs the recording script for one user. If the login hits a challenge (and there is a challenge queue),
+        then the user is parked in `parked` and its driver is kept alive.
+
+        :param parked_run: The parked run of the user, if the user is continued after its challenge.
+        :param shard: The shard of the user's plan to run (its date range). If None, then the whole date range.
+        :param key: The key to park the run under. If None, then the user index.
+
+        :return: None if the user finished or was parked, else the error message.
+        """
+        key = i if key is None else key
+        started = time.time() - (parked_run["seconds"] if parked_run is not None else 0.0)
         username = credentials_for_one_user["username"]
         password = credentials_for_one_user["password"]
-        print_log(f"Working on user #{i+1}: {username} (out of {total_users} users).")
-        path_where_recordings_are_saved = get_recording_path(
-            date=today_date, output_folder=output_dir_name, username=username
-        )
-        try:
-            get_recordings(
-                driver=web_driver,
-                end_date=end_date,
-                cookies_file=cookies_file,
-                username=username,
-                password=password,
-                info_file=info_file,
+        shard_run = shard_runs.get(i) if shard is not None else None
+        if shard_run is not None and shard_run["failed"]:
+            print_log(f"Skipping the next date range of user {username}, since an earlier one failed.")
+            return None
+        # The driver that the previous shard of the user logged in with.
+        kept_session = shard_run.pop("session", None) if shard_run is not None and parked_run is None else None
+        if parked_run is not None:
+            profile = parked_run["profile"]
+        elif kept_session is not None:
+            profile = kept_session["profile"]
+        else:
+            profile = open_profile(profiles_dir, username) if profiles_dir is not None else None
+
+        def start_driver() -> WebDriver:
+            return create_driver(
                 user_agent=user_agent,
-                download_duplicates=download_duplicates,
+                show=show_driver,
                 system=system,
-                path_where_recordings_are_saved=path_where_recordings_are_saved,
+                driver_location=driver_location,
+                lean=lean_driver,
+                profile_path=profile.path if profile is not None else None,
+            )
+
+        if parked_run is not None:
+            web_driver = parked_run["driver"]
+            watchdog = parked_run["watchdog"]
+            resume_from = parked_run["challenge"].kind
+            print_log(f"Continuing user #{i+1}: {username} after its {resume_from} challenge.")
+        else:
+            web_driver = kept_session["driver"] if kept_session is not None else start_driver()
+            watchdog = DriverWatchdog(phase_budgets, max_restarts) if phase_budgets is not None else None
+            resume_from = None
+            if kept_session is not None:
+                print_log(f"Continuing user #{i+1}: {username} with its next date range.")
+            else:
+                print_log(f"Working on user #{i+1}: {username} (out of {total_users} users).")
+        if parked_run is not None:
+            # The run folder was allocated before the user was parked.
+            path_where_recordings_are_saved = parked_run["path"]
+        elif shard_run is not None:
+            path_where_recordings_are_saved = shard_run["path"]
+        else:
+            path_where_recordings_are_saved = get_recording_path(
+                date=today_date, output_folder=output_dir_name, username=username
             )
+            if shard is not None:
+                shard_run = {
+                    "path": path_where_recordings_are_saved,
+                    "shards": [job_shard for user_index, job_shard in jobs if user_index == i],
+                    "shards_done": 0,
+                    "failed": False,
+                }
+                shard_runs[i] = shard_run
+        earlier_metadata = []
+        if shard_run is not None and shard_run["shards_done"] > 0:
+            earlier_metadata = get_old_metadata(os.path.join(path_where_recordings_are_saved, info_file.split("/")[-1]))
+        try:
+            if parked_run is not None:
+                challenge = parked_run["challenge"]
+                if not is_challenge_answered(web_driver, challenge_queue, challenge):
+                    raise TimeoutException(
+                        f"The {challenge.kind} challenge was not answered within {challenge_timeout:g} seconds."
+                    )
+                submit_challenge_answer(web_driver, challenge, challenge_queue.get_answer(challenge))
+                challenge_queue.resolve(challenge)
+            while True:
+                try:
+                    get_recordings(
+                        driver=web_driver,
+                        end_date=shard["start_date"] if shard is not None else end_date,
+                        cookies_file=cookies_file,
+                        username=username,
+                        password=password,
+                        info_file=info_file,
+                        user_agent=user_agent,
+                        download_duplicates=download_duplicates,
+                        system=system,
+                        path_where_recordings_are_saved=path_where_recordings_are_saved,
+                        analyze_audio=analyze_audio,
+                        compress_audio=compress_audio,
+                        window_size=window_size,
+                        reuse_session=(
+                            profile is not None
+                            or kept_session is not None
+                            or (watchdog is not None and watchdog.restarts > 0)
+                        ),
+                        until_date=shard["until_date"] if shard is not None else until_date,
+                        devices=devices,
+                        watchdog=watchdog,
+                        uid_batch_size=uid_batch_size,
+                        uid_endpoint=uid_endpoint,
+                        challenges=challenge_queue,
+                        resume_from=resume_from,
+                        download_priority=download_priority,
+                        deadline=deadline,
+                        known_audio_ids=known_audio_ids,
+                        download_workers=user_plans[i].workers if i in user_plans else download_workers,
+                        earlier_metadata=earlier_metadata,
+                        on_progress=leases[i].heartbeat if i in leases else None,
+                    )
+                    break
+                except ChallengePending as e:
+                    if i in leases:
+                        leases[i].park()
+                    parked[key] = {
+                        "driver": web_driver,
+                        "profile": profile,
+                        "watchdog": watchdog,
+                        "challenge": e.challenge,
+                        "user_index": i,
+                        "shard": shard,
+                        "path": path_where_recordings_are_saved,
+                        "seconds": time.time() - started,
+                    }
+                    print_log(
+                        f"ACTION NEEDED: {e} Parking this user and continuing with the others. Answer it with "
+                        f"`python challenges.py answer --challenges-dir {challenges_dir}`."
+                    )
+                    return None
+                except Exception as e:
+                    if watchdog is None or not watchdog.should_restart(e, web_driver):
+                        raise
+                    watchdog.restarts += 1
+                    print_log(
+                        f"WARNING: The driver for user {username} has hung or crashed ({e}). Restarting it and "
+                        f"continuing from the saved progress (restart {watchdog.restarts} of "
+                        f"{watchdog.max_restarts})."
+                    )
+                    stop_driver(web_driver)
+                    web_driver = start_driver()
+                    resume_from = None
+                    if profile is None:
+                        restore_cookies(web_driver, cookies_file)
+            if planner is not None and i in user_plans and shard is not None:
+                planner.record_actual(
+                    user_plans[i],
+                    shard,
+                    path_where_recordings_are_saved,
+                    time.time() - started,
+                    info_file.split("/")[-1],
+                    num_earlier_recordings=len(earlier_metadata),
+                )
+            if shard_run is not None:
+                shard_run["shards_done"] += 1
+                if shard_run["shards_done"] < len(shard_run["shards"]):
+                    # Keep the driver logged in for the next date range.
+                    shard_run["session"] = {"driver": web_driver, "profile": profile}
+                    print_log(f"Finished a date range of user {username}. The run continues with the next one.")
+                    return None
             web_driver.quit()
+            close_profile(profile, max_profile_bytes)
+            set_run_status(path_where_recordings_are_saved, RUN_COMPLETE)
+            if index_file is not None:
+                index_connection = open_index(index_file)
+                index_run_folder(
+                    connection=index_connection,
+                    username=username,
+                    run_date=os.path.basename(os.path.dirname(path_where_recordings_are_saved)),
+                    run_path=path_where_recordings_are_saved,
+                    info_file=info_file.split("/")[-1],
+                )
+                index_connection.close()
+            if export_dir is not None:
+                export_connection = open_export_state(export_dir)
+                export_run_folder(
+                    connection=export_connection,
+                    export_dir=export_dir,
+                    username=username,
+                    run_date=os.path.basename(os.path.dirname(path_where_recordings_are_saved)),
+                    run_path=path_where_recordings_are_saved,
+                    info_file=info_file.split("/")[-1],
+                )
+                export_connection.close()
+            return None
         except Exception as e:
             print_log(
                 f"ERROR: The script has errored out for user {username}. These recordings will be skipped. "
@@ -821,9 +2157,168 @@ def get_recordings_for_all_users(
                 recording_path=path_where_recordings_are_saved,
                 error_file_name=error_file_name,
             )
-            web_driver.quit()
+            set_run_status(path_where_recordings_are_saved, RUN_FAILED)
+            if shard_run is not None:
+                shard_run["failed"] = True
+            stop_driver(web_driver)
+            close_profile(profile, max_profile_bytes)
+            return str(e)
+
+    def resume_parked_users() -> Dict[int, Optional[str]]:
+        """
+        Continues every parked user whose challenge has been answered (or has run out of time).
+
+        :return: What run_user returned for every run that is no longer parked, by its key in `parked`.
+        """
+        results = {}
+        for key in list(parked):
+            lease_of_user = leases.get(parked[key]["user_index"])
+            if lease_of_user is not None and lease_of_user.lost:
+                # Another worker has taken the user over; leave the challenge to it.
+                parked_run = parked.pop(key)
+                print_log(f"WARNING: The lease on {lease_of_user.username} was lost while it was parked. Dropping it.")
+                stop_driver(parked_run["driver"])
+                close_profile(parked_run["profile"], max_profile_bytes)
+                set_run_status(parked_run["path"], RUN_FAILED)
+                results[key] = "The lease was lost while the user was parked."
+                continue
+            challenge = parked[key]["challenge"]
+            timed_out = time.time() - challenge.created > challenge_timeout
+            if not timed_out and not is_challenge_answered(parked[key]["driver"], challenge_queue, challenge):
+                continue
+            parked_run = parked.pop(key)
+            i = parked_run["user_index"]
+            if lease_of_user is not None:
+                lease_of_user.unpark()
+            error = run_user(i, credentials[i], parked_run=parked_run, shard=parked_run["shard"], key=key)
+            print("\n")
+            if key not in parked:
+                results[key] = error
+        return results
+
+    def is_user_parked(i: int) -> bool:
+        return any(parked_run["user_index"] == i for parked_run in parked.values())
+
+    def end_unfinished_shard_runs() -> None:
+        """
+        Ends the run of every user whose date ranges were not all run (because the time budget ran out). The
+        run keeps the recordings of the date ranges that were run, so it is marked partial (failed if none
+        were), and the date ranges that are left are written to its error file.
+
+        :return: None.
+        """
+        for i, shard_run in shard_runs.items():
+            if shard_run["failed"] or shard_run["shards_done"] == len(shard_run["shards"]):
+                continue
+            session = shard_run.pop("session", None)
+            if session is not None:
+                stop_driver(session["driver"])
+                close_profile(session["profile"], max_profile_bytes)
+            username = credentials[i]["username"]
+            shards_left = shard_run["shards"][shard_run["shards_done"]:]
+            print_log(
+                f"WARNING: The time budget ran out before {len(shards_left)} date ranges of user {username} were "
+                f"run. They are listed in the error file ({error_file_name})."
+            )
+            save_errors(
+                errors={
+                    username: {
+                        "error message": "The time budget ran out before all of the date ranges were run.",
+                        "date ranges not run": [
+                            {"start_date": shard_left["start_date"], "until_date": shard_left["until_date"]}
+                            for shard_left in shards_left
+                        ],
+                    }
+                },
+                recording_path=shard_run["path"],
+                error_file_name=error_file_name,
+            )
+            set_run_status(shard_run["path"], RUN_PARTIAL if shard_run["shards_done"] > 0 else RUN_FAILED)
+
+    if queue_dir is None:
+        pending_jobs = list(enumerate(jobs))
+        # The jobs of the users that are parked, by user index. They are run once the user is continued, with
+        # the same driver, instead of logging the user in again next to its parked driver.
+        deferred_jobs: Dict[int, List[Tuple[int, Tuple[int, Optional[Dict[str, Any]]]]]] = {}
+
+        def resume_and_requeue() -> None:
+            resume_parked_users()
+            for user_index in list(deferred_jobs):
+                if not is_user_parked(user_index):
+                    pending_jobs[0:0] = deferred_jobs.pop(user_index)
+
+        out_of_time = False
+        while len(pending_jobs) > 0 or len(parked) > 0:
+            if len(pending_jobs) > 0 and not out_of_time and is_out_of_time():
+                out_of_time = True
+                num_left = len({i for _, (i, _) in pending_jobs} | set(deferred_jobs))
+                print_log(f"The time budget is used up. {num_left} users were not started (or finished).")
+            if out_of_time or len(pending_jobs) == 0:
+                if len(parked) == 0:
+                    break
+                time.sleep(CHALLENGE_POLL_SECONDS)
+                resume_and_requeue()
+                continue
+            j, (i, shard) = pending_jobs.pop(0)
+            if is_user_parked(i):
+                deferred_jobs.setdefault(i, []).append((j, (i, shard)))
+                continue
+            run_user(i, credentials[i], shard=shard, key=j)
+            print("\n")
+            resume_and_requeue()
+        end_unfinished_shard_runs()
+        return
 
-        print("\n")
+    # Work through the accounts as a queue that is shared with the workers on other machines.
+    work_queue = WorkQueue(
+        queue_dir=queue_dir,
+        batch=today_date.replace("/", "-"),
+        lease_seconds=lease_seconds,
+        max_stall_seconds=max_stall_seconds,
+    )
+    usernames = [credentials_for_one_user["username"] for credentials_for_one_user in credentials]
+    print_log(f"Working on the queue in {work_queue.batch_dir} as worker {work_queue.worker_id}.")
+
+    def finish_lease(i: int, error: Optional[str]) -> None:
+        lease_of_user = leases.pop(i)
+        if error is None:
+            work_queue.complete(lease_of_user)
+        else:
+            work_queue.fail(lease_of_user, error)
+
+    while True:
+        leased_any = False
+        for i, shard in jobs:
+            if is_out_of_time():
+                break
+            lease = work_queue.try_lease(credentials[i]["username"])
+            if lease is None:
+                continue
+            leased_any = True
+            leases[i] = lease
+            error = run_user(i, credentials[i], shard=shard)
+            print("\n")
+            # A parked user keeps its lease (which is still renewed) until it is continued.
+            if i not in parked:
+                finish_lease(i, error)
+            for parked_index, parked_error in resume_parked_users().items():
+                finish_lease(parked_index, parked_error)
+        for parked_index, parked_error in resume_parked_users().items():
+            finish_lease(parked_index, parked_error)
+
+        queue_status = work_queue.status(usernames)
+        if queue_status["leased"] == 0 and queue_status["waiting"] == 0:
+            print_log(
+                f"The queue is finished: {queue_status['done']} users done, {queue_status['failed']} failed."
+            )
+            return
+        if is_out_of_time() and len(parked) == 0:
+            print_log(f"The time budget is used up. {queue_status['waiting']} users are left in the queue.")
+            return
+        if not leased_any:
+            # Other workers hold the remaining users (or this worker's users are parked); wait in case one of
+            # their leases expires or a challenge is answered.
+            time.sleep(CHALLENGE_POLL_SECONDS if len(parked) > 0 else min(lease_seconds / 3, 30))
 
 
 @click.command()
@@ -888,6 +2383,171 @@ def get_recordings_for_all_users(
     help="Specify a single user to be run from the config file.",
     required=False,
 )
+@click.option(
+    "--index",
+    type=str,
+    help="specify a search index file to add every finished run to (see recording_index.py).",
+    required=False,
+)
+@click.option(
+    "--analyze",
+    is_flag=True,
+    help="add the duration, sample rate, loudness and silence ratio of every recording to the recording info.",
+)
+@click.option(
+    "--compress",
+    is_flag=True,
+    help="compress every recording losslessly while the others download (see audio_compression.py).",
+)
+@click.option(
+    "--queue-dir",
+    type=str,
+    help="use this (shared) directory as a work queue, so several workers can share the credentials file.",
+    required=False,
+)
+@click.option(
+    "--lease-seconds",
+    type=float,
+    help="seconds after which a worker's lease on a user expires if it is not renewed.",
+    required=False,
+    default=300.0,
+)
+@click.option(
+    "--max-stall-seconds",
+    type=float,
+    help="seconds without progress after which a worker stops renewing its lease on a user.",
+    required=False,
+    default=DEFAULT_MAX_STALL_SECONDS,
+)
+@click.option(
+    "--window-size",
+    type=int,
+    help="extract the recordings this many at a time and remove them from the page afterwards, "
+    "to keep memory use flat for accounts with very many recordings.",
+    required=False,
+)
+@click.option(
+    "--lean",
+    is_flag=True,
+    help="block images, fonts and third-party trackers in chrome, for faster page loads.",
+)
+@click.option(
+    "--profiles-dir",
+    type=str,
+    help="keep a persistent chrome profile per user in this folder, to reuse its cache and login.",
+    required=False,
+)
+@click.option(
+    "--max-profile-size",
+    type=int,
+    help="size cap of each chrome profile, in megabytes.",
+    required=False,
+    default=DEFAULT_MAX_PROFILE_MEGABYTES,
+)
+@click.option(
+    "--end-date",
+    type=str,
+    help="only get the recordings until this date, in the format 'YYYY/MM/DD HH:MM:SS'",
+    required=False,
+)
+@click.option(
+    "--device",
+    type=str,
+    multiple=True,
+    help="only get the recordings of this device (can be given more than once).",
+)
+@click.option(
+    "--watchdog",
+    is_flag=True,
+    help="put time budgets on every phase and restart hung or crashed drivers, continuing from the last "
+    "extracted recording.",
+)
+@click.option(
+    "--phase-budget",
+    type=str,
+    multiple=True,
+    help="time budget of a phase for the watchdog, as 'phase=seconds' (phases: login, search, extract).",
+)
+@click.option(
+    "--max-restarts",
+    type=int,
+    help="number of times the watchdog can restart the driver of one user.",
+    required=False,
+    default=3,
+)
+@click.option(
+    "--uid-batch-size",
+    type=int,
+    help="resolve the audio IDs this many at a time with the uidArray[] endpoint, instead of expanding "
+    "every recording.",
+    required=False,
+)
+@click.option(
+    "--uid-endpoint",
+    type=str,
+    help="the uidArray[] endpoint to resolve audio IDs with (for example a local stand-in server). "
+    "By default it is taken from the page.",
+    required=False,
+)
+@click.option(
+    "--challenges-dir",
+    type=str,
+    help="post captchas, two-step codes and email verifications to a challenge queue in this folder and keep "
+    "working on the other users while they wait (answer them with challenges.py).",
+    required=False,
+)
+@click.option(
+    "--challenge-timeout",
+    type=float,
+    help="number of seconds a user waits for its challenge to be answered.",
+    required=False,
+    default=DEFAULT_CHALLENGE_TIMEOUT_SECONDS,
+)
+@click.option(
+    "--time-budget",
+    type=float,
+    help="number of seconds the script may run for. The recordings that are left when the time is up are "
+    "written to each run's pending.json.",
+    required=False,
+)
+@click.option(
+    "--priority",
+    type=click.Choice(DOWNLOAD_PRIORITIES),
+    help="download the newest recordings first, the ones that are not in the index yet, or the smallest ones.",
+    required=False,
+)
+@click.option(
+    "--mirror",
+    type=str,
+    help="after the run, copy the new recordings to this directory (see mirror_recordings.py).",
+    required=False,
+)
+@click.option(
+    "--mirror-workers",
+    type=int,
+    help="number of files to copy to the mirror at a time.",
+    required=False,
+    default=4,
+)
+@click.option(
+    "--export",
+    type=str,
+    help="specify a directory to export the metadata of every finished run to as parquet (see analytics_export.py).",
+    required=False,
+)
+@click.option(
+    "--download-workers",
+    type=int,
+    help="number of recordings to download at a time.",
+    required=False,
+    default=1,
+)
+@click.option(
+    "--plan",
+    is_flag=True,
+    help="estimate every user's run from the index and past runs first, and pick the order of the users, the "
+    "downloads at a time and the date range splits from it (see run_planner.py).",
+)
 def main(
     config: str,
     info: str,
@@ -899,6 +2559,32 @@ def main(
     download_duplicates: bool,
     driver: str,
     user: str,
+    index: Optional[str],
+    analyze: bool,
+    compress: bool,
+    queue_dir: Optional[str],
+    lease_seconds: float,
+    max_stall_seconds: float,
+    window_size: Optional[int],
+    lean: bool,
+    profiles_dir: Optional[str],
+    max_profile_size: int,
+    end_date: Optional[str],
+    device: Tuple[str, ...],
+    watchdog: bool,
+    phase_budget: Tuple[str, ...],
+    max_restarts: int,
+    uid_batch_size: Optional[int],
+    uid_endpoint: Optional[str],
+    challenges_dir: Optional[str],
+    challenge_timeout: float,
+    time_budget: Optional[float],
+    priority: Optional[str],
+    mirror: Optional[str],
+    mirror_workers: int,
+    export: Optional[str],
+    download_workers: int,
+    plan: bool,
 ) -> None:
     """
     This script takes a list of credentials from the credentials file and downloads all recordings from a certain
@@ -915,6 +2601,29 @@ def main(
             "\"YYYY/MM/DD HH:MM:SS\" and run \"./download_recordings.py --help\" for more information. "
         )
         return
+    if end_date is not None and not verify_input_date(date=end_date):
+        print_log(
+            "ERROR: The end date is not correctly formatted. Please format the date as such: "
+            "\"YYYY/MM/DD HH:MM:SS\" and run \"./download_recordings.py --help\" for more information. "
+        )
+        return
+
+    if export is not None:
+        try:
+            require_pyarrow()
+        except ImportError as e:
+            print_log(f"ERROR: {e}")
+            return
+
+    phase_budgets = None
+    if watchdog:
+        phase_budgets = {}
+        for budget in phase_budget:
+            phase, _, seconds = budget.partition("=")
+            if phase not in DEFAULT_PHASE_BUDGETS or not seconds.replace(".", "", 1).isdigit():
+                print_log(f"ERROR: \"{budget}\" is not a valid phase budget. Use 'phase=seconds'.")
+                return
+            phase_budgets[phase] = float(seconds)
 
     show = False if show is None else show
     download_duplicates = False if download_duplicates is None else download_duplicates
@@ -934,7 +2643,32 @@ def main(
         download_duplicates=download_duplicates,
         system=system,
         user=user,
+        index_file=index,
+        analyze_audio=False if analyze is None else analyze,
+        compress_audio=False if compress is None else compress,
+        queue_dir=queue_dir,
+        lease_seconds=lease_seconds,
+        max_stall_seconds=max_stall_seconds,
+        window_size=window_size,
+        lean_driver=False if lean is None else lean,
+        profiles_dir=profiles_dir,
+        max_profile_bytes=max_profile_size * 1024 * 1024,
+        until_date=end_date,
+        devices=list(device) if device else None,
+        phase_budgets=phase_budgets,
+        max_restarts=max_restarts,
+        uid_batch_size=uid_batch_size,
+        uid_endpoint=uid_endpoint,
+        challenges_dir=challenges_dir,
+        challenge_timeout=challenge_timeout,
+        time_budget=time_budget,
+        download_priority=priority,
+        export_dir=export,
+        download_workers=max(download_workers, 1),
+        plan_run=False if plan is None else plan,
     )
+    if mirror is not None:
+        mirror_output_folder(output, mirror, mirror_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,224 @@
+import os
+import re
+import sqlite3
+import time
+from typing import Dict, Any, List, Optional, Set
+
+from mirror_recordings import journal_run_files
+from utils import print_log, write_json_atomically
+
+PENDING_FILE_NAME = "pending.json"
+
+NEWEST_FIRST = "newest"
+UNKNOWN_FIRST = "unknown"
+SMALLEST_FIRST = "smallest"
+DOWNLOAD_PRIORITIES = [NEWEST_FIRST, UNKNOWN_FIRST, SMALLEST_FIRST]
+
+# Number of downloads between two estimates of the remaining time.
+PROGRESS_REPORT_INTERVAL = 25
+AUDIO_ID_TIME_PATTERN = re.compile(r"/([0-9]{4})/([0-9]{2})/([0-9]{2})/([0-9]{2})/[^/]+/([0-9]{2}):([0-9]{2})::")
+
+
+def get_time_from_audio_id(audio_id: Optional[str]) -> str:
+    """
+    Gets the (UTC) time at which a recording was made from its audio ID (see get_date_from_audio_id in utils.py),
+    down to the second.
+
+    :param audio_id: The audio ID of the recording.
+
+    :return: The time as "YYYY-MM-DD HH:MM:SS", or "" if the audio ID does not contain a time.
+    """
+    match = AUDIO_ID_TIME_PATTERN.search(audio_id or "")
+    if match is None:
+        return ""
+    year, month, day, hour, minute, second = match.groups()
+    return f"{year}-{month}-{day} {hour}:{minute}:{second}"
+
+
+def estimate_recording_size(recording: Dict[str, Any]) -> int:
+    """
+    The size of a recording is only known once it is downloaded, so the number of words in its transcript is
+    used as an estimate of its length (and so of its size).
+
+    :param recording: The metadata of the recording.
+
+    :return: The estimated size, in words.
+    """
+    return len((recording.get("message") or "").split())
+
+
+def get_catalog_audio_ids(index_file: str) -> Set[str]:
+    """
+    :param index_file: The search index (see recording_index.py).
+
+    :return: The audio IDs of every recording that is already in the catalog.
+    """
+    if not os.path.isfile(index_file):
+        return set()
+    connection = sqlite3.connect(index_file)
+    try:
+        rows = connection.execute("SELECT audio_id FROM recordings WHERE audio_id IS NOT NULL").fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    finally:
+        connection.close()
+    return {row[0] for row in rows}
+
+
+def order_downloads(
+    recordings: List[Dict[str, Any]], priority: str = NEWEST_FIRST, known_audio_ids: Optional[Set[str]] = None
+) -> List[int]:
+    """
+    Orders the recordings by how valuable they are to download first. Ties keep the order of the page.
+
+    :param recordings: The metadata of the recordings to download (the ones with an audio ID).
+    :param priority: NEWEST_FIRST (by the time in the audio ID), UNKNOWN_FIRST (recordings that are not in
+        the catalog yet, newest first) or SMALLEST_FIRST (by estimate_recording_size).
+    :param known_audio_ids: The audio IDs in the catalog, for UNKNOWN_FIRST.
+
+    :return: The positions of the recordings in download order.
+    """
+    known_audio_ids = known_audio_ids or set()
+    positions = list(range(len(recordings)))
+    # Python's sort is stable, so sorting by the secondary key first keeps it within the primary key.
+    positions.sort(key=lambda i: get_time_from_audio_id(recordings[i]["audio_id"]), reverse=True)
+    if priority == UNKNOWN_FIRST:
+        positions.sort(key=lambda i: recordings[i]["audio_id"] in known_audio_ids)
+    elif priority == SMALLEST_FIRST:
+        positions.sort(key=lambda i: estimate_recording_size(recordings[i]))
+    return positions
+
+
+class DownloadScheduler:
+    """
+    Decides the order in which the recordings of a run are downloaded and stops the downloads before a deadline.
+    The time per download is measured as the downloads go, and a download is only started if it is expected to
+    finish before the deadline. The recordings that were not downloaded are written to the run's pending file,
+    in the format of the repair queue, so that `python verify_recordings.py repair --queue <pending file>`
+    downloads them later.
+    """
+
+    def __init__(
+        self,
+        username: str,
+        recordings: List[Dict[str, Any]],
+        priority: str = NEWEST_FIRST,
+        deadline: Optional[float] = None,
+        known_audio_ids: Optional[Set[str]] = None,
+    ) -> None:
+        """
+        :param username: The username of the user.
+        :param recordings: The metadata of the run's recordings.
+        :param priority: One of DOWNLOAD_PRIORITIES (see order_downloads).
+        :param deadline: The time (as a timestamp) by which the downloads have to be finished. If None, then
+            every recording is downloaded.
+        :param known_audio_ids: The audio IDs in the catalog, for UNKNOWN_FIRST.
+        """
+        self.username = username
+        self.recordings = [recording for recording in recordings if recording.get("audio_id") is not None]
+        self.priority = priority
+        self.deadline = deadline
+        self.known_audio_ids = known_audio_ids
+        self.num_downloaded = 0
+        self.download_seconds = 0.0
+        self.download_bytes = 0
+
+    def get_order(self) -> List[int]:
+        """
+        :return: The positions of the audio IDs (as in get_audio_ids) in download order.
+        """
+        return order_downloads(self.recordings, self.priority, self.known_audio_ids)
+
+    def get_seconds_per_download(self) -> Optional[float]:
+        """
+        :return: The average time that a download has taken so far, or None before the first download.
+        """
+        if self.num_downloaded == 0:
+            return None
+        return self.download_seconds / self.num_downloaded
+
+    def has_time_for_next(self) -> bool:
+        """
+        :return: Whether the next download is expected to finish before the deadline.
+        """
+        if self.deadline is None:
+            return True
+        return time.time() + (self.get_seconds_per_download() or 0.0) <= self.deadline
+
+    def record_download(self, seconds: float, audio_file: str) -> None:
+        """
+        Adds a finished download to the throughput.
+
+        :param seconds: How long the download took.
+        :param audio_file: The file the recording was saved to.
+
+        :return: None.
+        """
+        self.num_downloaded += 1
+        self.download_seconds += seconds
+        if os.path.isfile(audio_file):
+            self.download_bytes += os.path.getsize(audio_file)
+
+    def report_progress(self, num_left: int) -> None:
+        """
+        Logs the throughput and the estimated time that the remaining downloads need, every
+        PROGRESS_REPORT_INTERVAL downloads.
+
+        :param num_left: Number of recordings that are still to be downloaded.
+
+        :return: None.
+        """
+        seconds_per_download = self.get_seconds_per_download()
+        if seconds_per_download is None or self.num_downloaded % PROGRESS_REPORT_INTERVAL != 0:
+            return
+        throughput = self.download_bytes / max(self.download_seconds, 1e-6) / 1024
+        message = (
+            f"Downloaded {self.num_downloaded} recordings at {throughput:.0f} KB/s. The other {num_left} need "
+            f"about {seconds_per_download * num_left / 60:.1f} minutes"
+        )
+        if self.deadline is not None:
+            message += f" ({max(self.deadline - time.time(), 0) / 60:.1f} minutes are left in the time budget)"
+        print_log(message + ".")
+
+    def save_pending(
+        self, recording_path: str, pending_positions: List[int], failed_positions: Optional[List[int]] = None
+    ) -> None:
+        """
+        Writes the recordings that were not downloaded to the run's pending file, or removes the pending file if
+        every recording was downloaded.
+
+        :param recording_path: Directory path where the recordings of the run are saved.
+        :param pending_positions: The positions of the recordings that were not started before the deadline.
+        :param failed_positions: The positions of the recordings whose download failed.
+
+        :return: None.
+        """
+        failed_positions = failed_positions or []
+        pending_path = os.path.join(recording_path, PENDING_FILE_NAME)
+        if len(pending_positions) == 0 and len(failed_positions) == 0:
+            if os.path.exists(pending_path):
+                os.remove(pending_path)
+            return
+        reasons = {i: "the time budget ran out" for i in pending_positions}
+        reasons.update({i: "the download failed" for i in failed_positions})
+        run_path = os.path.abspath(recording_path)
+        write_json_atomically(
+            pending_path,
+            [
+                {
+                    "username": self.username,
+                    "run_path": run_path,
+                    "audio_id": self.recordings[i]["audio_id"],
+                    "file": os.path.join(run_path, f"{i}.wav"),
+                    "status": "pending",
+                    "reason": reasons[i],
+                }
+                for i in sorted(reasons)
+            ],
+        )
+        journal_run_files(recording_path, [PENDING_FILE_NAME])
+        print_log(
+            f"{len(reasons)} recordings were not downloaded ({len(pending_positions)} left when the time budget "
+            f"ran out, {len(failed_positions)} failed). They are listed in {pending_path}; run "
+            f"\"python verify_recordings.py repair --queue {pending_path}\" to download them."
+        )
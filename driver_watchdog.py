@@ -0,0 +1,204 @@
+import json
+import os
+import threading
+from typing import Dict, Any, List, Optional, Callable
+
+from selenium.webdriver.chrome.webdriver import WebDriver
+
+from utils import print_log, write_json_atomically
+
+PROGRESS_FILE_NAME = "progress.json"
+
+# Default time budgets of the phases of a run, in seconds. The extraction budget applies to each window of
+# recordings (see extract_recordings_in_windows), so that it does not depend on the size of the account.
+DEFAULT_PHASE_BUDGETS = {
+    "login": 15 * 60,
+    "search": 10 * 60,
+    "extract": 15 * 60,
+}
+DEFAULT_WATCHDOG_WINDOW_SIZE = 100
+HEALTH_CHECK_SECONDS = 15
+QUIT_SECONDS = 15
+
+
+class PhaseTimeout(Exception):
+    """
+    Raised when a phase of a run takes longer than its time budget, which usually means that Chrome or
+    chromedriver has hung.
+    """
+
+
+def call_with_timeout(func: Callable[..., Any], timeout: float, *args: Any, **kwargs: Any) -> Any:
+    """
+    Calls a function in a separate thread and waits for it for at most timeout seconds. A hung WebDriver call
+    cannot be interrupted, so the thread is left behind (as a daemon thread) when the timeout runs out; the
+    caller is expected to kill the driver, which makes the call return.
+
+    :param func: The function to call.
+    :param timeout: Number of seconds to wait for the function.
+
+    :return: What the function returned. Raises PhaseTimeout if the function did not return in time, and
+        re-raises the exception of the function if it raised one.
+    """
+    result: Dict[str, Any] = {}
+
+    def target() -> None:
+        try:
+            result["value"] = func(*args, **kwargs)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise PhaseTimeout(f"{getattr(func, '__name__', 'The call')} did not finish within {timeout:g} seconds.")
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+def is_driver_alive(driver: WebDriver, timeout: float = HEALTH_CHECK_SECONDS) -> bool:
+    """
+    :param driver: The WebDriver.
+    :param timeout: Number of seconds that the driver has to answer in.
+
+    :return: Whether chromedriver is still running and the browser still answers a trivial script.
+    """
+    service = getattr(driver, "service", None)
+    process = getattr(service, "process", None)
+    if process is not None and process.poll() is not None:
+        return False
+    try:
+        return call_with_timeout(driver.execute_script, timeout, "return 1;") == 1
+    except Exception:
+        return False
+
+
+def stop_driver(driver: WebDriver) -> None:
+    """
+    Quits a driver that may be hung or dead. If quitting does not finish in time, then the chromedriver
+    process is killed.
+
+    :param driver: The WebDriver.
+
+    :return: None.
+    """
+    try:
+        call_with_timeout(driver.quit, QUIT_SECONDS)
+        return
+    except Exception:
+        pass
+    process = getattr(getattr(driver, "service", None), "process", None)
+    if process is not None and process.poll() is None:
+        print_log("WARNING: The driver did not quit. Killing chromedriver.")
+        process.kill()
+
+
+def restore_cookies(driver: WebDriver, cookies_file: str) -> None:
+    """
+    Loads the cookies that the last session of the user dumped into a new driver, so that the new driver can
+    skip the login if the session is still valid.
+
+    :param driver: The WebDriver.
+    :param cookies_file: The file location where the session's cookies were saved.
+
+    :return: None; adds the cookies to the driver.
+    """
+    if not os.path.isfile(cookies_file):
+        return
+    with open(cookies_file, "r") as f:
+        cookies = json.load(f)
+    driver.get("https://www.amazon.com")
+    for cookie in cookies:
+        cookie = {key: value for key, value in cookie.items() if key != "sameSite"}
+        if "expiry" in cookie:
+            cookie["expiry"] = int(cookie["expiry"])
+        try:
+            driver.add_cookie(cookie)
+        except Exception:
+            # Cookies of other domains (such as alexa.amazon.com) cannot be added from this page.
+            continue
+
+
+class DriverWatchdog:
+    """
+    Puts a time budget on each phase of a run and keeps track of how often the driver was restarted. When a
+    phase runs out of time, or the driver crashes, the run is restarted with a new driver and continues from
+    the progress that was saved in the run folder.
+    """
+
+    def __init__(self, budgets: Optional[Dict[str, float]] = None, max_restarts: int = 3) -> None:
+        self.budgets = dict(DEFAULT_PHASE_BUDGETS)
+        self.budgets.update(budgets or {})
+        self.max_restarts = max_restarts
+        self.restarts = 0
+
+    def run(self, phase: str, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Runs one phase of a run within its time budget.
+
+        :param phase: The name of the phase ("login", "search" or "extract").
+        :param func: The function that does the phase.
+
+        :return: What the function returned. Raises PhaseTimeout if the phase ran out of time.
+        """
+        try:
+            return call_with_timeout(func, self.budgets[phase], *args, **kwargs)
+        except PhaseTimeout:
+            print_log(f"WARNING: The {phase} phase ran out of its time budget of {self.budgets[phase]:g} seconds.")
+            raise
+
+    def should_restart(self, error: Exception, driver: WebDriver) -> bool:
+        """
+        :param error: The exception that a run raised.
+        :param driver: The driver of the run.
+
+        :return: Whether the run should be restarted with a new driver: the driver is hung or has crashed, and
+            there are restarts left.
+        """
+        if self.restarts >= self.max_restarts:
+            return False
+        return isinstance(error, PhaseTimeout) or not is_driver_alive(driver)
+
+
+def load_progress(recording_path: str) -> Dict[str, Any]:
+    """
+    :param recording_path: Directory path where the recordings of the run are saved.
+
+    :return: The progress that an earlier attempt of the run saved: the "metadata" of the recordings that
+        were extracted, and whether the extraction was "finished".
+    """
+    progress_path = os.path.join(recording_path, PROGRESS_FILE_NAME)
+    if not os.path.isfile(progress_path):
+        return {"metadata": [], "finished": False}
+    with open(progress_path, "r") as f:
+        return json.load(f)
+
+
+def save_progress(recording_path: str, metadata: List[Dict[str, Any]], finished: bool) -> None:
+    """
+    Saves the recordings that have been extracted so far, so that a restarted run can continue from them.
+
+    :param recording_path: Directory path where the recordings of the run are saved.
+    :param metadata: The metadata of the recordings that have been extracted.
+    :param finished: Whether every recording has been extracted.
+
+    :return: None.
+    """
+    write_json_atomically(
+        os.path.join(recording_path, PROGRESS_FILE_NAME), {"metadata": metadata, "finished": finished}
+    )
+
+
+def clear_progress(recording_path: str) -> None:
+    """
+    Deletes the saved progress of a run once the run is finished.
+
+    :param recording_path: Directory path where the recordings of the run are saved.
+
+    :return: None.
+    """
+    progress_path = os.path.join(recording_path, PROGRESS_FILE_NAME)
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
@@ -0,0 +1,318 @@
+#!venv/bin/python
+
+import datetime
+import json
+import os
+import itertools
+import re
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Dict, Any, Iterator, List, Optional, Set, Tuple
+
+import click
+
+from mirror_recordings import journal_run_files
+from utils import (
+    print_log,
+    iter_json_array,
+    resolve_relative_date,
+    get_date_from_audio_id,
+)
+
+LEGACY_DATE_PATTERN = re.compile(
+    r"^(?P<day>.+?) at (?P<time>[0-9]{1,2}:[0-9]{2}\s*[AaPp][Mm])(?: on (?P<device>.+))?$"
+)
+RUN_DATE_PATTERN = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})")
+
+
+def is_legacy_metadata_file(file_path: str) -> bool:
+    """
+    Checks whether a metadata file uses the legacy format, where every recording looks like
+    {"audio-id": ..., "text": ..., "date": "Yesterday at 11:18 PM on Echo Dot"}.
+
+    :param file_path: Path of the metadata file.
+
+    :return: True if the first recording in the file uses the legacy keys.
+    """
+    try:
+        for recording in iter_json_array(file_path):
+            return isinstance(recording, dict) and "audio-id" in recording
+    except (ValueError, UnicodeDecodeError):
+        return False
+    return False
+
+
+def get_run_date(file_path: str) -> Optional[datetime.date]:
+    """
+    Finds the date on which the run that wrote the metadata file happened, which is the closest year-month-day
+    folder in the file's path.
+
+    :param file_path: Path of the metadata file.
+
+    :return: The date of the run, or None if no folder in the path is named after a date.
+    """
+    for part in reversed(os.path.abspath(file_path).split(os.sep)):
+        match = RUN_DATE_PATTERN.fullmatch(part)
+        if match is not None:
+            year, month, day = match.groups()
+            return datetime.date(int(year), int(month), int(day))
+    return None
+
+
+def convert_legacy_recording(
+    recording: Dict[str, Any], run_date: Optional[datetime.date], file_date: Optional[datetime.date] = None
+) -> Dict[str, Any]:
+    """
+    Converts one recording from the legacy format to the format written by save_metadata.
+
+    :param recording: The legacy recording ("audio-id", "text", "date").
+    :param run_date: The date of the run, used to resolve relative days such as "Yesterday". If None (the run
+        date is not known), then the date in the audio ID is used instead.
+    :param file_date: The modification date of the metadata file. Only used to resolve relative days when neither
+        the run date nor an audio ID is known, since copying the file changes it.
+
+    :return: The recording with "message", "date", "time", "device", "div_id" and "audio_id" keys. The div_id of
+        a legacy recording is not known, so it is None; the audio ID is kept as the key that the next run
+        deduplicates the recording by (see merge_migrated_recordings in download_recordings.py).
+    """
+    audio_id = recording.get("audio-id")
+    legacy_date = (recording.get("date") or "").strip()
+    # The (UTC) date that is part of the audio ID.
+    audio_id_date = get_date_from_audio_id(audio_id)
+
+    recording_date = ""
+    recording_time = ""
+    recording_device = ""
+    match = LEGACY_DATE_PATTERN.match(legacy_date)
+    if match is not None:
+        recording_time = match.group("time").upper()
+        recording_device = (match.group("device") or "").strip()
+        reference_date = run_date if run_date is not None or audio_id_date is not None else file_date
+        if reference_date is not None:
+            resolved_date = resolve_relative_date(match.group("day"), reference_date)
+            if resolved_date is not None:
+                recording_date = resolved_date.strftime("%m/%d/%Y")
+
+    if recording_date == "":
+        if audio_id_date is not None:
+            year, month, day = audio_id_date.split("-")
+            recording_date = f"{month}/{day}/{year}"
+        else:
+            recording_date = legacy_date
+
+    return {
+        "message": recording.get("text", ""),
+        "date": recording_date,
+        "time": recording_time,
+        "device": recording_device,
+        "div_id": None,
+        "audio_id": audio_id,
+    }
+
+
+def get_migrated_path(file_path: str, input_root: str, output_root: Optional[str], info_file: str) -> str:
+    """
+    :param file_path: Path of the legacy metadata file.
+    :param input_root: The directory that is being migrated.
+    :param output_root: The directory to write the migrated files to. If None, then the migrated file is written
+        next to the legacy file.
+    :param info_file: Filename of the migrated metadata file.
+
+    :return: The path that the migrated metadata file is written to.
+    """
+    if output_root is None:
+        return os.path.join(os.path.dirname(file_path), info_file)
+    relative_folder = os.path.relpath(os.path.dirname(os.path.abspath(file_path)), os.path.abspath(input_root))
+    return os.path.normpath(os.path.join(output_root, relative_folder, info_file))
+
+
+def migrate_files(file_paths: List[str], migrated_path: str, overwrite: bool = False) -> Tuple[str, int, int]:
+    """
+    Converts the legacy metadata files of one folder (e.g. recordinginfo.json.old and recordinginfo.json.dup)
+    into a single metadata file in the current format. The recordings are streamed to the migrated file one at a
+    time and deduplicated by audio ID, so memory use only depends on the number of distinct audio IDs. If the
+    migrated file already exists (and is not one of the legacy files), its recordings are kept and the legacy
+    recordings are merged into it. The migrated file is written under a temporary name and renamed into place
+    once it is complete.
+
+    :param file_paths: Paths of the legacy metadata files.
+    :param migrated_path: Path to write the migrated metadata file to.
+    :param overwrite: Whether the recordings of an existing migrated file should be dropped instead of merged.
+
+    :return: A tuple of the migrated path, the number of recordings converted and the number of duplicate
+        recordings that were dropped.
+    """
+    os.makedirs(os.path.dirname(migrated_path) or ".", exist_ok=True)
+    temporary_path = f"{migrated_path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    keep_existing = (
+        not overwrite
+        and os.path.exists(migrated_path)
+        and os.path.abspath(migrated_path) not in [os.path.abspath(file_path) for file_path in file_paths]
+        and not is_legacy_metadata_file(migrated_path)
+    )
+
+    seen_audio_ids: Set[str] = set()
+    num_written = 0
+    num_recordings = 0
+    num_duplicates = 0
+
+    def iter_recordings() -> Iterator[Tuple[Dict[str, Any], bool]]:
+        if keep_existing:
+            for recording in iter_json_array(migrated_path):
+                yield recording, False
+        for file_path in sorted(file_paths):
+            run_date = get_run_date(file_path)
+            file_date = datetime.date.fromtimestamp(os.path.getmtime(file_path))
+            for recording in iter_json_array(file_path):
+                yield convert_legacy_recording(recording, run_date, file_date), True
+
+    with open(temporary_path, "w+") as f:
+        f.write("[")
+        for recording, converted in iter_recordings():
+            audio_id = recording.get("audio_id")
+            if audio_id is not None:
+                if audio_id in seen_audio_ids:
+                    num_duplicates += 1
+                    continue
+                seen_audio_ids.add(audio_id)
+            item = json.dumps(recording, indent=4).replace("\n", "\n    ")
+            f.write(("," if num_written > 0 else "") + "\n    " + item)
+            num_written += 1
+            num_recordings += int(converted)
+        f.write("\n]" if num_written > 0 else "\n\n]")
+    os.replace(temporary_path, migrated_path)
+    journal_run_files(os.path.dirname(os.path.abspath(migrated_path)), [os.path.basename(migrated_path)])
+    return migrated_path, num_recordings, num_duplicates
+
+
+def find_legacy_files(input_root: str) -> Iterator[str]:
+    """
+    Walks the input directory (or takes the single input file) and yields every legacy metadata file.
+
+    :param input_root: A directory to search, or a single metadata file.
+
+    :return: A generator of legacy metadata file paths.
+    """
+    if os.path.isfile(input_root):
+        if is_legacy_metadata_file(input_root):
+            yield input_root
+        return
+    for folder, _, file_names in os.walk(input_root):
+        for file_name in file_names:
+            if file_name.startswith("recordinginfo.json"):
+                file_path = os.path.join(folder, file_name)
+                if is_legacy_metadata_file(file_path):
+                    yield file_path
+
+
+def migrate_archive(
+    input_root: str,
+    output_root: Optional[str],
+    info_file: str,
+    workers: int,
+    overwrite: bool = False,
+) -> None:
+    """
+    Migrates every legacy metadata file under input_root with a pool of worker processes. Only a bounded
+    number of files are queued at a time, so archives of any size can be migrated with constant memory.
+
+    :param input_root: A directory to search, or a single metadata file.
+    :param output_root: The directory to write the migrated files to. If None, then every migrated file is
+        written next to its legacy file.
+    :param info_file: Filename of the migrated metadata files.
+    :param workers: Number of worker processes.
+    :param overwrite: Whether existing metadata files should be overwritten instead of merged with.
+
+    :return: None.
+    """
+    started = time.time()
+    max_in_flight = workers * 4
+    in_flight: Set[Future] = set()
+    num_files = 0
+    num_recordings = 0
+    num_duplicates = 0
+
+    def collect(done: Set[Future]) -> None:
+        nonlocal num_recordings, num_duplicates
+        for future in done:
+            try:
+                migrated_path, converted, duplicates = future.result()
+            except Exception as e:
+                print_log(f"ERROR: A folder could not be migrated: {e}")
+                continue
+            num_recordings += converted
+            num_duplicates += duplicates
+            print_log(f"Migrated {converted} recordings ({duplicates} duplicates dropped) into {migrated_path}.")
+
+    def get_group_key(file_path: str) -> str:
+        return get_migrated_path(file_path, input_root, output_root, info_file)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Several legacy files (.old, .dup) can live in one folder; they are all merged into one migrated file.
+        # os.walk lists the files of a folder together, so the files of one migrated file are consecutive.
+        for migrated_path, group in itertools.groupby(find_legacy_files(input_root), key=get_group_key):
+            file_paths = list(group)
+            num_files += len(file_paths)
+
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(executor.submit(migrate_files, file_paths, migrated_path, overwrite))
+
+        done, _ = wait(in_flight)
+        collect(done)
+
+    print_log(
+        f"Migrated {num_recordings} recordings from {num_files} legacy files ({num_duplicates} duplicates dropped) "
+        f"in {time.time() - started:.1f} seconds."
+    )
+
+
+@click.command()
+@click.argument("input_path", type=str)
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify a directory to write the migrated files to (default: next to each legacy file)",
+    required=False,
+)
+@click.option(
+    "-i",
+    "--info",
+    type=str,
+    help="specify the filename of the migrated recording info",
+    required=False,
+    default="recordinginfo.json",
+)
+@click.option(
+    "--workers",
+    type=int,
+    help="number of worker processes",
+    required=False,
+    default=os.cpu_count() or 1,
+)
+@click.option(
+    "--overwrite", is_flag=True, help="overwrite existing recording info files instead of merging into them."
+)
+def main(input_path: str, output: Optional[str], info: str, workers: int, overwrite: bool) -> None:
+    """
+    This script converts legacy recording info files (with "audio-id", "text" and "date" such as
+    "Yesterday at 11:18 PM on Echo Dot") found under INPUT_PATH into the current format, with "message", "date",
+    "time", "device", "div_id" and "audio_id".
+
+    Relative days are resolved against the date of the run folder that the file is in. Files that are not in a
+    run folder take the date of each recording's audio ID instead.
+    """
+    migrate_archive(
+        input_root=input_path,
+        output_root=output,
+        info_file=info.split("/")[-1],
+        workers=max(1, workers),
+        overwrite=overwrite,
+    )
+
+
+if __name__ == "__main__":
+    main()
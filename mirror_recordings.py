@@ -0,0 +1,291 @@
+#!venv/bin/python
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+import click
+
+from utils import print_log
+
+JOURNAL_FILE_NAME = ".mirror_journal.jsonl"
+MIRROR_STATE_FILE_NAME = ".mirror_state.db"
+COPY_CHUNK_SIZE = 1 << 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    source TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending (
+    path TEXT PRIMARY KEY
+);
+"""
+
+
+def get_output_folder(run_path: str) -> str:
+    """
+    :param run_path: A run folder path (output_folder/username/year-month-day/trial).
+
+    :return: The output folder that the run is in.
+    """
+    return os.path.dirname(os.path.dirname(os.path.dirname(os.path.normpath(os.path.abspath(run_path)))))
+
+
+def journal_changes(output_folder: str, file_paths: List[str]) -> None:
+    """
+    Appends written files to the output folder's change journal, so that the next mirror only copies them. The
+    journal is only kept once the first mirror has started it (see mirror_output_folder); until then this
+    does nothing. Appends are locked, so several workers can share one output folder.
+
+    :param output_folder: The folder where all of the recordings are saved.
+    :param file_paths: The paths of the files that were written.
+
+    :return: None.
+    """
+    journal_path = os.path.join(output_folder, JOURNAL_FILE_NAME)
+    if len(file_paths) == 0 or not os.path.exists(journal_path):
+        return
+    now = time.time()
+    lines = "".join(
+        json.dumps({"path": os.path.relpath(os.path.abspath(file_path), os.path.abspath(output_folder)), "time": now})
+        + "\n"
+        for file_path in file_paths
+    )
+    with open(journal_path, "a") as journal:
+        fcntl.flock(journal.fileno(), fcntl.LOCK_EX)
+        try:
+            journal.write(lines)
+            journal.flush()
+        finally:
+            fcntl.flock(journal.fileno(), fcntl.LOCK_UN)
+
+
+def journal_run_files(run_path: str, file_names: List[str]) -> None:
+    """
+    Appends files of a run folder to the change journal (see journal_changes).
+
+    :param run_path: The run folder path.
+    :param file_names: The names of the files in the run folder that were written.
+
+    :return: None.
+    """
+    journal_changes(get_output_folder(run_path), [os.path.join(run_path, file_name) for file_name in file_names])
+
+
+def read_journal(output_folder: str, offset: int) -> Tuple[List[str], int]:
+    """
+    :param output_folder: The folder where all of the recordings are saved.
+    :param offset: The position in the journal up to which the changes have already been mirrored.
+
+    :return: The paths (relative to the output folder) of the files that changed after the offset, in the
+        order of the journal without repeats, and the new offset. A line that is still being written is left
+        for the next mirror.
+    """
+    journal_path = os.path.join(output_folder, JOURNAL_FILE_NAME)
+    with open(journal_path, "rb") as journal:
+        journal.seek(offset)
+        data = journal.read()
+    end = data.rfind(b"\n") + 1
+    paths: Dict[str, None] = {}
+    for line in data[:end].splitlines():
+        if line.strip():
+            paths[json.loads(line)["path"]] = None
+    return list(paths), offset + end
+
+
+def scan_output_folder(output_folder: str) -> List[str]:
+    """
+    :param output_folder: The folder where all of the recordings are saved.
+
+    :return: The paths (relative to the output folder) of every file in the recordings tree.
+    """
+    paths = []
+    for root, _, file_names in os.walk(output_folder):
+        for file_name in file_names:
+            if file_name == JOURNAL_FILE_NAME or file_name.endswith(".tmp"):
+                continue
+            paths.append(os.path.relpath(os.path.join(root, file_name), output_folder))
+    return sorted(paths)
+
+
+def get_file_sha256(file_path: str) -> str:
+    """
+    :param file_path: Path of a file.
+
+    :return: The sha256 of the file.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def copy_file_checksummed(source_path: str, target_path: str) -> Dict[str, Any]:
+    """
+    Copies a file to a temporary file next to its target, checks that the copy has the checksum of the
+    source and then moves it into place, so that the target never holds a partial or corrupt copy.
+
+    :param source_path: Path of the file to copy.
+    :param target_path: Path to copy the file to.
+
+    :return: The "size", "mtime" and "sha256" of the source file. Raises IOError if the copy does not match.
+    """
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    stat = os.stat(source_path)
+    temporary_path = f"{target_path}.{os.getpid()}.tmp"
+    sha256 = hashlib.sha256()
+    with open(source_path, "rb") as source, open(temporary_path, "wb") as target:
+        for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            target.write(chunk)
+        target.flush()
+        os.fsync(target.fileno())
+    checksum = sha256.hexdigest()
+    if get_file_sha256(temporary_path) != checksum:
+        os.remove(temporary_path)
+        raise IOError(f"The copy of {source_path} does not match its checksum.")
+    shutil.copystat(source_path, temporary_path)
+    os.replace(temporary_path, target_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": checksum}
+
+
+def open_mirror_state(target_dir: str) -> sqlite3.Connection:
+    """
+    :param target_dir: The folder that the recordings are mirrored to.
+
+    :return: A connection to the mirror's state, which is kept in the target folder.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(target_dir, MIRROR_STATE_FILE_NAME))
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def mirror_output_folder(
+    output_folder: str, target_dir: str, workers: int = 4, rescan: bool = False
+) -> Dict[str, int]:
+    """
+    Copies the files that were written since the last mirror (according to the change journal) to the target
+    folder, with a pool of threads. The first mirror to a target (or a rescan) walks the whole recordings tree
+    instead, and starts the journal. Files that are unchanged since they were mirrored (same size and
+    modification time) are skipped, and files that fail to copy are retried by the next mirror.
+
+    :param output_folder: The folder where all of the recordings are saved.
+    :param target_dir: The folder to mirror the recordings to.
+    :param workers: Number of files to copy at a time.
+    :param rescan: Whether to walk the whole recordings tree instead of reading the journal.
+
+    :return: The number of files that were "copied", "unchanged", "missing" (deleted since they were
+        journaled, such as compressed originals) and "failed".
+    """
+    output_folder = os.path.abspath(output_folder)
+    journal_path = os.path.join(output_folder, JOURNAL_FILE_NAME)
+    connection = open_mirror_state(target_dir)
+    row = connection.execute("SELECT offset FROM journal WHERE source = ?", (output_folder,)).fetchone()
+
+    if row is None or rescan or not os.path.exists(journal_path):
+        # Start the journal before the walk, so that files written during the walk are not missed.
+        if not os.path.exists(journal_path):
+            open(journal_path, "a").close()
+        new_offset = os.path.getsize(journal_path)
+        paths = scan_output_folder(output_folder)
+        print_log(f"Scanned {len(paths)} files in {output_folder}.")
+    else:
+        paths, new_offset = read_journal(output_folder, row[0])
+    retry_paths = [path for (path,) in connection.execute("SELECT path FROM pending")]
+    paths = list(dict.fromkeys(retry_paths + paths))
+
+    counts = {"copied": 0, "unchanged": 0, "missing": 0, "failed": 0}
+    to_copy = []
+    for path in paths:
+        source_path = os.path.join(output_folder, path)
+        if not os.path.isfile(source_path):
+            counts["missing"] += 1
+            continue
+        stat = os.stat(source_path)
+        mirrored = connection.execute("SELECT size, mtime FROM files WHERE path = ?", (path,)).fetchone()
+        if (
+            mirrored is not None
+            and mirrored == (stat.st_size, stat.st_mtime)
+            and os.path.isfile(os.path.join(target_dir, path))
+        ):
+            counts["unchanged"] += 1
+            continue
+        to_copy.append(path)
+
+    def copy(path: str) -> Optional[Dict[str, Any]]:
+        try:
+            return copy_file_checksummed(os.path.join(output_folder, path), os.path.join(target_dir, path))
+        except (IOError, OSError) as e:
+            print_log(f"WARNING: {path} could not be mirrored: {e}")
+            return None
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(copy, to_copy))
+
+    with connection:
+        connection.execute("DELETE FROM pending")
+        for path, record in zip(to_copy, results):
+            if record is None:
+                counts["failed"] += 1
+                connection.execute("INSERT OR IGNORE INTO pending (path) VALUES (?)", (path,))
+                continue
+            counts["copied"] += 1
+            connection.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+                (path, record["size"], record["mtime"], record["sha256"]),
+            )
+        connection.execute(
+            "INSERT OR REPLACE INTO journal (source, offset) VALUES (?, ?)", (output_folder, new_offset)
+        )
+    connection.close()
+    print_log(
+        f"Mirrored {counts['copied']} files to {target_dir} in {time.time() - started:.1f} seconds "
+        f"({counts['unchanged']} unchanged, {counts['missing']} deleted since, {counts['failed']} failed)."
+    )
+    return counts
+
+
+@click.command()
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify the directory where the recordings are saved",
+    required=False,
+    default="recordings",
+)
+@click.option("--target", type=str, required=True, help="the directory to mirror the recordings to.")
+@click.option(
+    "--workers",
+    type=int,
+    help="number of files to copy at a time",
+    required=False,
+    default=4,
+)
+@click.option("--rescan", is_flag=True, help="walk the whole recordings tree instead of reading the journal.")
+def main(output: str, target: str, workers: int, rescan: bool) -> None:
+    """
+    Copies the recordings that were written since the last mirror to the target directory. The first mirror
+    to a target copies the whole tree and starts the change journal that the next mirrors read.
+    """
+    mirror_output_folder(output, target, workers, rescan)
+
+
+if __name__ == "__main__":
+    main()
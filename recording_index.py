@@ -0,0 +1,414 @@
+#!venv/bin/python
+
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, Any, List, Optional
+
+import click
+
+from archive_recordings import PACK_FILE_NAME, PackReader
+from audio_compression import get_compressed_path
+from utils import (
+    print_log,
+    get_recording_files,
+    get_date_from_audio_id,
+    iter_run_folders,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    run_date TEXT NOT NULL,
+    trial INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY,
+    recording_key TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL,
+    div_id TEXT,
+    audio_id TEXT,
+    message TEXT,
+    date TEXT,
+    time TEXT,
+    device TEXT,
+    recorded_on TEXT,
+    run_path TEXT NOT NULL,
+    run_order TEXT NOT NULL,
+    wav_path TEXT
+);
+CREATE INDEX IF NOT EXISTS recordings_user_date ON recordings (username, recorded_on);
+CREATE INDEX IF NOT EXISTS recordings_device ON recordings (device COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS recordings_recorded_on ON recordings (recorded_on);
+CREATE INDEX IF NOT EXISTS recordings_run_path ON recordings (run_path);
+CREATE VIRTUAL TABLE IF NOT EXISTS recordings_fts USING fts5 (
+    message, device, content='recordings', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS recordings_insert AFTER INSERT ON recordings BEGIN
+    INSERT INTO recordings_fts (rowid, message, device) VALUES (new.id, new.message, new.device);
+END;
+CREATE TRIGGER IF NOT EXISTS recordings_delete AFTER DELETE ON recordings BEGIN
+    INSERT INTO recordings_fts (recordings_fts, rowid, message, device)
+    VALUES ('delete', old.id, old.message, old.device);
+END;
+CREATE TRIGGER IF NOT EXISTS recordings_update AFTER UPDATE ON recordings BEGIN
+    INSERT INTO recordings_fts (recordings_fts, rowid, message, device)
+    VALUES ('delete', old.id, old.message, old.device);
+    INSERT INTO recordings_fts (rowid, message, device) VALUES (new.id, new.message, new.device);
+END;
+"""
+
+
+def open_index(index_file: str) -> sqlite3.Connection:
+    """
+    Opens (and creates, if needed) the search index.
+
+    :param index_file: Path of the SQLite index file.
+
+    :return: A connection to the index.
+    """
+    connection = sqlite3.connect(index_file)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def index_run_folder(
+    connection: sqlite3.Connection,
+    username: str,
+    run_date: str,
+    run_path: str,
+    info_file: str = "recordinginfo.json",
+    force: bool = False,
+) -> int:
+    """
+    Adds the metadata of one run to the index. A run whose metadata file has not changed since it was last
+    indexed is skipped. A recording that shows up in several runs is kept once, pointing at its latest run.
+
+    :param connection: A connection to the index.
+    :param username: The username of the user of the run.
+    :param run_date: The date folder name of the run (year-month-day).
+    :param run_path: The run folder path.
+    :param info_file: The filename of the metadata file in the run folder.
+    :param force: Whether the run should be indexed again even if it has not changed.
+
+    :return: The number of recordings that were indexed from this run.
+    """
+    metadata_path = os.path.join(run_path, info_file)
+    try:
+        stat = os.stat(metadata_path)
+    except FileNotFoundError:
+        return 0
+
+    run_path = os.path.abspath(run_path)
+    indexed_run = connection.execute(
+        "SELECT mtime, size FROM runs WHERE path = ?", (run_path,)
+    ).fetchone()
+    if (
+        not force
+        and indexed_run is not None
+        and indexed_run["mtime"] == stat.st_mtime
+        and indexed_run["size"] == stat.st_size
+    ):
+        return 0
+
+    with open(metadata_path, "r") as f:
+        try:
+            metadata = json.load(f)
+        except json.JSONDecodeError:
+            print_log(f"WARNING: {metadata_path} is not valid json. Skipping this run.")
+            return 0
+
+    trial = int(os.path.basename(run_path))
+    run_order = f"{run_date}/{trial:06d}"
+    recording_files = get_recording_files(metadata, run_path)
+    rows = []
+    for recording in metadata:
+        div_id = recording.get("div_id")
+        audio_id = recording.get("audio_id")
+        rows.append(
+            (
+                f"{username}|{div_id}|{audio_id}",
+                username,
+                div_id,
+                audio_id,
+                recording.get("message"),
+                recording.get("date"),
+                recording.get("time"),
+                recording.get("device"),
+                get_date_from_audio_id(audio_id) or run_date,
+                run_path,
+                run_order,
+                recording_files.get(audio_id),
+            )
+        )
+
+    with connection:
+        connection.execute("DELETE FROM recordings WHERE run_path = ?", (run_path,))
+        connection.executemany(
+            """
+            INSERT INTO recordings (
+                recording_key, username, div_id, audio_id, message, date, time, device,
+                recorded_on, run_path, run_order, wav_path
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (recording_key) DO UPDATE SET
+                message = excluded.message,
+                date = excluded.date,
+                time = excluded.time,
+                device = excluded.device,
+                recorded_on = excluded.recorded_on,
+                run_path = excluded.run_path,
+                run_order = excluded.run_order,
+                wav_path = excluded.wav_path
+            WHERE excluded.run_order >= recordings.run_order
+            """,
+            rows,
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO runs (path, username, run_date, trial, mtime, size) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (run_path, username, run_date, trial, stat.st_mtime, stat.st_size),
+        )
+    return len(rows)
+
+
+def build_index(
+    index_file: str, output_folder: str, info_file: str = "recordinginfo.json", force: bool = False
+) -> None:
+    """
+    Indexes every run in the recordings tree that is new or has changed since the last build.
+
+    :param index_file: Path of the SQLite index file.
+    :param output_folder: The folder where all of the recordings are saved.
+    :param info_file: The filename of the metadata file in each run folder.
+    :param force: Whether every run should be indexed again.
+
+    :return: None.
+    """
+    started = time.time()
+    connection = open_index(index_file)
+    num_runs = 0
+    num_recordings = 0
+    for username, run_date, run_path in iter_run_folders(output_folder):
+        indexed = index_run_folder(connection, username, run_date, run_path, info_file, force)
+        if indexed > 0:
+            num_runs += 1
+            num_recordings += indexed
+    connection.close()
+    print_log(
+        f"Indexed {num_recordings} recordings from {num_runs} new or changed runs "
+        f"in {time.time() - started:.1f} seconds."
+    )
+
+
+def format_fts_query(text: str) -> str:
+    """
+    Turns plain text into an FTS5 query that matches the recordings containing every word of it. Each word is
+    quoted as an FTS5 string, so that apostrophes, hyphens and FTS5 operators in ordinary transcripts (such as
+    "what's" or "echo-dot") are searched for instead of being parsed as query syntax.
+
+    :param text: The text to search for.
+
+    :return: The FTS5 query.
+    """
+    return " ".join('"' + token.replace('"', '""') + '"' for token in text.split())
+
+
+def resolve_wav_path(
+    wav_path: Optional[str], audio_id: Optional[str], run_path: str, pack_indexes: Dict[str, Optional[Dict]]
+) -> Optional[str]:
+    """
+    Finds where the audio of an indexed recording is now. The index stores the path of the wav file in the run
+    folder, but the wav file may since have been compressed (see audio_compression.py) or packed with the rest
+    of its run (see archive_recordings.py).
+
+    :param wav_path: The wav path stored in the index.
+    :param audio_id: The audio ID of the recording.
+    :param run_path: The run folder path of the recording.
+    :param pack_indexes: The audio IDs of each run folder's pack (or None, if the run is not packed), by run
+        folder path. Filled in as the runs are looked up.
+
+    :return: The wav file, its compressed copy, or "<pack path>:<name in the pack>" if the run was packed (read it
+        with `archive_recordings.py read`). The stored path if none of them exist.
+    """
+    if wav_path is None or os.path.isfile(wav_path):
+        return wav_path
+    if os.path.isfile(get_compressed_path(wav_path)):
+        return get_compressed_path(wav_path)
+    if run_path not in pack_indexes:
+        pack_path = os.path.join(run_path, PACK_FILE_NAME)
+        pack_indexes[run_path] = None
+        if os.path.isfile(pack_path):
+            with PackReader(pack_path) as reader:
+                pack_indexes[run_path] = reader.index["audio_ids"]
+    pack_index = pack_indexes[run_path]
+    if pack_index is not None and audio_id in pack_index:
+        return f"{os.path.join(run_path, PACK_FILE_NAME)}:{pack_index[audio_id]}"
+    return wav_path
+
+
+def query_index(
+    connection: sqlite3.Connection,
+    text: Optional[str] = None,
+    username: Optional[str] = None,
+    device: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    limit: int = 100,
+    raw_fts: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Finds the recordings that match all of the given filters.
+
+    :param connection: A connection to the index.
+    :param text: Words to match against the transcript and device (see format_fts_query).
+    :param username: Only return recordings of this user.
+    :param device: Only return recordings from this device (case insensitive).
+    :param since: Only return recordings made on or after this date (YYYY-MM-DD).
+    :param until: Only return recordings made on or before this date (YYYY-MM-DD).
+    :param limit: Maximum number of recordings to return.
+    :param raw_fts: Whether text is a query in the SQLite FTS5 syntax (such as "weather OR music"), instead of
+        plain words. An invalid query raises sqlite3.OperationalError.
+
+    :return: The matching recordings, newest first, with the current location of their audio (see
+        resolve_wav_path).
+    """
+    conditions = []
+    parameters: List[Any] = []
+    if text:
+        conditions.append("recordings.id IN (SELECT rowid FROM recordings_fts WHERE recordings_fts MATCH ?)")
+        parameters.append(text if raw_fts else format_fts_query(text))
+    if username:
+        conditions.append("recordings.username = ?")
+        parameters.append(username)
+    if device:
+        conditions.append("recordings.device = ? COLLATE NOCASE")
+        parameters.append(device)
+    if since:
+        conditions.append("recordings.recorded_on >= ?")
+        parameters.append(since)
+    if until:
+        conditions.append("recordings.recorded_on <= ?")
+        parameters.append(until)
+
+    where = f"WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+    rows = connection.execute(
+        "SELECT username, div_id, audio_id, message, date, time, device, recorded_on, wav_path, run_path "
+        f"FROM recordings {where} ORDER BY recorded_on DESC, audio_id DESC LIMIT ?",
+        parameters + [limit],
+    ).fetchall()
+    pack_indexes: Dict[str, Optional[Dict]] = {}
+    results = []
+    for row in rows:
+        result = dict(row)
+        run_path = result.pop("run_path")
+        result["wav_path"] = resolve_wav_path(result["wav_path"], result["audio_id"], run_path, pack_indexes)
+        results.append(result)
+    return results
+
+
+@click.group()
+def cli() -> None:
+    """
+    Builds and queries a full-text index over the recording metadata of every run.
+    """
+
+
+@cli.command()
+@click.option(
+    "--index",
+    type=str,
+    help="specify the index file",
+    required=False,
+    default="recordings.db",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify the directory where the recordings are saved",
+    required=False,
+    default="recordings",
+)
+@click.option(
+    "-i",
+    "--info",
+    type=str,
+    help="specify the filename of the recording info",
+    required=False,
+    default="recordinginfo.json",
+)
+@click.option("--force", is_flag=True, help="index every run again, even unchanged ones.")
+def build(index: str, output: str, info: str, force: bool) -> None:
+    """
+    Indexes every run that is new or has changed since the last build.
+    """
+    build_index(index, output, info.split("/")[-1], force)
+
+
+@cli.command()
+@click.argument("text", type=str, required=False)
+@click.option(
+    "--index",
+    type=str,
+    help="specify the index file",
+    required=False,
+    default="recordings.db",
+)
+@click.option("--user", type=str, help="only show recordings of this user.")
+@click.option("--device", type=str, help="only show recordings from this device.")
+@click.option("--since", type=str, help="only show recordings made on or after this date (YYYY-MM-DD).")
+@click.option("--until", type=str, help="only show recordings made on or before this date (YYYY-MM-DD).")
+@click.option("--limit", type=int, default=100, help="maximum number of recordings to show.")
+@click.option("--json", "as_json", is_flag=True, help="print every recording as a json line.")
+@click.option("--raw", is_flag=True, help="treat TEXT as an SQLite FTS5 query (e.g. \"weather OR music\").")
+def query(
+    text: Optional[str],
+    index: str,
+    user: Optional[str],
+    device: Optional[str],
+    since: Optional[str],
+    until: Optional[str],
+    limit: int,
+    as_json: bool,
+    raw: bool,
+) -> None:
+    """
+    Prints the recordings whose transcript or device match TEXT, filtered by user, device and date range.
+    """
+    if not os.path.isfile(index):
+        print_log(f"ERROR: The index {index} does not exist. Run \"./recording_index.py build\" first.")
+        return
+
+    connection = open_index(index)
+    started = time.time()
+    try:
+        results = query_index(connection, text, user, device, since, until, limit, raw_fts=raw)
+    except sqlite3.OperationalError as e:
+        print_log(f"ERROR: The query could not be run: {e}")
+        return
+    finally:
+        connection.close()
+    elapsed = time.time() - started
+
+    for result in results:
+        if as_json:
+            print(json.dumps(result))
+        else:
+            print(
+                f"{result['recorded_on']} | {result['username']} | {result['device']} | "
+                f"{result['message']} | {result['wav_path']}"
+            )
+    if not as_json:
+        print_log(f"{len(results)} recordings found in {elapsed * 1000:.1f} ms.")
+
+
+if __name__ == "__main__":
+    cli()
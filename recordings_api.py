@@ -0,0 +1,281 @@
+import datetime
+from typing import Dict, Any, Iterator, List, Optional, Union
+
+from selenium.webdriver.chrome.webdriver import WebDriver
+
+from download_recordings import (
+    AudioSession,
+    create_driver,
+    log_in,
+    search_for_recordings,
+    discover_uid_endpoint,
+    iter_recording_windows,
+)
+from uid_resolver import UidResolver
+from utils import (
+    print_log,
+    create_user_agent,
+    verify_input_date,
+    parse_input_date,
+    recording_matches_filters,
+    get_date_from_audio_id,
+)
+
+DEFAULT_WINDOW_SIZE = 100
+INPUT_DATE_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+
+class CrawlerSession:
+    """
+    A logged in Chrome session of one account, for using the crawler as a library. Use open_session to create
+    one (or wrap a driver that is already logged in), and close it (or use it as a context manager) when done.
+    """
+
+    def __init__(
+        self,
+        driver: WebDriver,
+        username: str,
+        password: str,
+        cookies_file: str = "cookies.json",
+        user_agent: Optional[str] = None,
+        system: str = "linux",
+    ) -> None:
+        """
+        :param driver: The logged in WebDriver.
+        :param username: Username of the account.
+        :param password: Password of the account (to log in again if the session ends).
+        :param cookies_file: The file location where the session's cookies are saved.
+        :param user_agent: The user agent of the driver.
+        :param system: The OS where the driver is running.
+        """
+        self.driver = driver
+        self.username = username
+        self.system = system
+        self.audio = AudioSession(
+            driver,
+            user_agent if user_agent is not None else driver.execute_script("return navigator.userAgent;"),
+            log_in_again=lambda: log_in(driver, username, password, cookies_file),
+        )
+
+    def close(self) -> None:
+        """
+        Quits the driver.
+        """
+        self.driver.quit()
+
+    def __enter__(self) -> "CrawlerSession":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def open_session(
+    username: str,
+    password: str,
+    cookies_file: str = "cookies.json",
+    user_agent: Optional[str] = None,
+    show: bool = False,
+    system: str = "linux",
+    driver_location: Optional[str] = None,
+    lean: bool = False,
+    profile_path: Optional[str] = None,
+) -> CrawlerSession:
+    """
+    Starts a driver and logs the account in.
+
+    :param username: Username of the account.
+    :param password: Password of the account.
+    :param cookies_file: The file location where the session's cookies will be saved.
+    :param user_agent: The user agent of the driver. If None, then a random one is used.
+    :param show: Whether the driver should display the window.
+    :param system: The OS where the script is running.
+    :param driver_location: Location of the WebDriver.
+    :param lean: Whether the driver should block the resources that are not needed (see create_driver).
+    :param profile_path: The Chrome profile to use (see chrome_profiles.py). If given, then the login is
+        skipped while the profile is still logged in.
+
+    :return: The logged in session.
+    """
+    user_agent = user_agent if user_agent is not None else create_user_agent()
+    driver = create_driver(
+        user_agent=user_agent,
+        show=show,
+        system=system,
+        driver_location=driver_location,
+        lean=lean,
+        profile_path=profile_path,
+    )
+    try:
+        log_in(driver, username, password, cookies_file, reuse_session=profile_path is not None)
+    except Exception:
+        driver.quit()
+        raise
+    return CrawlerSession(driver, username, password, cookies_file, user_agent, system)
+
+
+class Recording:
+    """
+    One recording of an account, as it is extracted from the activity history page. The audio is not
+    downloaded until it is asked for (see iter_audio and read_audio).
+    """
+
+    __slots__ = ("username", "div_id", "audio_id", "message", "date", "time", "device", "_session")
+
+    def __init__(
+        self,
+        username: str,
+        div_id: str,
+        audio_id: Optional[str],
+        message: str,
+        date: str,
+        time: str,
+        device: str,
+        session: Optional[CrawlerSession] = None,
+    ) -> None:
+        self.username = username
+        self.div_id = div_id
+        self.audio_id = audio_id
+        self.message = message
+        self.date = date
+        self.time = time
+        self.device = device
+        self._session = session
+
+    @classmethod
+    def from_metadata(
+        cls, metadata: Dict[str, Any], username: str, session: Optional[CrawlerSession] = None
+    ) -> "Recording":
+        """
+        :param metadata: The metadata of the recording, as in the recording info file.
+        :param username: Username of the account.
+        :param session: The session to download the audio with.
+
+        :return: The recording.
+        """
+        return cls(
+            username=username,
+            div_id=metadata.get("div_id"),
+            audio_id=metadata.get("audio_id"),
+            message=metadata.get("message", ""),
+            date=metadata.get("date", ""),
+            time=metadata.get("time", ""),
+            device=metadata.get("device", ""),
+            session=session,
+        )
+
+    def to_metadata(self) -> Dict[str, Any]:
+        """
+        :return: The metadata of the recording, as in the recording info file.
+        """
+        metadata = {
+            "message": self.message,
+            "date": self.date,
+            "time": self.time,
+            "device": self.device,
+            "div_id": self.div_id,
+        }
+        if self.audio_id is not None:
+            metadata["audio_id"] = self.audio_id
+        return metadata
+
+    @property
+    def recorded_on(self) -> Optional[str]:
+        """
+        :return: The (UTC) day on which the recording was made as "YYYY-MM-DD", from its audio ID.
+        """
+        return get_date_from_audio_id(self.audio_id)
+
+    def iter_audio(self, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """
+        Streams the wav file of the recording.
+
+        :param chunk_size: Number of bytes per chunk.
+
+        :return: A generator of the chunks of the wav file. Raises ValueError if the recording has no audio ID
+            or no session, and IOError if it could not be downloaded.
+        """
+        if self.audio_id is None or self._session is None:
+            raise ValueError(f"Recording {self.div_id} has no audio ID or no session to download it with.")
+        return self._session.audio.stream(self.audio_id, chunk_size)
+
+    def read_audio(self) -> bytes:
+        """
+        :return: The whole wav file of the recording (see iter_audio).
+        """
+        return b"".join(self.iter_audio())
+
+    def __repr__(self) -> str:
+        return f"Recording({self.username!r}, {self.div_id!r}, {self.date!r} {self.time!r}, {self.message!r})"
+
+
+def format_input_date(date: Union[str, datetime.date]) -> str:
+    """
+    :param date: A date or datetime, or a string in the input format "YYYY/MM/DD HH:MM:SS".
+
+    :return: The date in the input format. Raises ValueError if a string is not in the input format.
+    """
+    if isinstance(date, datetime.datetime):
+        return date.strftime(INPUT_DATE_FORMAT)
+    if isinstance(date, datetime.date):
+        return datetime.datetime.combine(date, datetime.time()).strftime(INPUT_DATE_FORMAT)
+    if not verify_input_date(date):
+        raise ValueError(f'{date} is not in the format "YYYY/MM/DD HH:MM:SS".')
+    return date
+
+
+def iter_recordings(
+    session: CrawlerSession,
+    since: Union[str, datetime.date],
+    until: Optional[Union[str, datetime.date]] = None,
+    devices: Optional[List[str]] = None,
+    window_size: int = DEFAULT_WINDOW_SIZE,
+    uid_batch_size: Optional[int] = None,
+) -> Iterator[Recording]:
+    """
+    Searches the account's activity history and yields its recordings as they are extracted, window_size at a
+    time (see iter_recording_windows), without saving anything to disk.
+
+    :param session: The logged in session.
+    :param since: The earliest date to get recordings from.
+    :param until: The latest date to get recordings from. If None, then until today.
+    :param devices: The names of the devices to get the recordings of. If None, then of every device.
+    :param window_size: Number of recordings to extract at a time.
+    :param uid_batch_size: If given, the audio IDs are resolved this many at a time (see uid_resolver.py)
+        instead of expanding every recording.
+
+    :return: A generator of the recordings.
+    """
+    start_date = format_input_date(since)
+    end_date = format_input_date(until) if until is not None else None
+    search_for_recordings(session.driver, start_date, system=session.system, end_date=end_date, devices=devices)
+    session.driver.implicitly_wait(5)
+
+    today = datetime.date.today()
+    start_day = parse_input_date(start_date)
+    end_day = parse_input_date(end_date) if end_date is not None else None
+
+    def recording_filter(recording: Dict[str, Any]) -> bool:
+        return recording_matches_filters(recording, today, start_day, end_day, devices)
+
+    uid_resolver = None
+    if uid_batch_size is not None:
+        endpoint = discover_uid_endpoint(session.driver)
+        if endpoint is None:
+            print_log("WARNING: The uidArray[] endpoint was not found. Expanding every recording instead.")
+        else:
+            uid_resolver = UidResolver(session.audio.http, endpoint, uid_batch_size, session.audio.refresh_cookies)
+
+    # The audio of the recordings can be downloaded while they are yielded, so the session must not navigate away
+    # from the page to keep itself alive until the generator is done.
+    with session.audio.hold_page():
+        for window_metadata in iter_recording_windows(
+            session.driver,
+            [],
+            True,
+            window_size,
+            recording_filter=recording_filter if end_day is not None or devices else None,
+            audio_id_resolver=uid_resolver,
+        ):
+            for metadata in window_metadata:
+                yield Recording.from_metadata(metadata, session.username, session)
@@ -0,0 +1,305 @@
+import datetime
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from mirror_recordings import journal_changes
+from utils import print_log, write_json_atomically
+
+MANIFEST_FILE_NAME = "manifest.json"
+RUNS_LOG_FILE_NAME = "runs.jsonl"
+LOCK_FILE_NAME = ".manifest.lock"
+ERROR_FILE_NAME = "errors.json"
+
+RUN_STARTED = "started"
+RUN_COMPLETE = "complete"
+# A finished run that only holds the recordings that were new since the runs before it (see daemon.py), so it
+# does not become the latest complete run.
+RUN_PARTIAL = "partial"
+RUN_FAILED = "failed"
+RUN_ARCHIVED = "archived"
+
+
+def split_run_path(run_path: str) -> Tuple[str, str, int]:
+    """
+    Splits a run folder path (output_folder/username/year-month-day/trial) into its parts.
+
+    :param run_path: The run folder path.
+
+    :return: A tuple of the user folder path, the date folder name and the trial number.
+    """
+    run_path = os.path.normpath(run_path)
+    date_folder, trial = os.path.split(run_path)
+    user_folder, date_folder_name = os.path.split(date_folder)
+    return user_folder, date_folder_name, int(trial)
+
+
+def run_key(date_folder_name: str, trial: int) -> str:
+    """
+    :return: The key of a run in the manifest, such as "2020-02-04/3".
+    """
+    return f"{date_folder_name}/{trial}"
+
+
+def run_order(key: Optional[str]) -> Tuple[str, int]:
+    """
+    :return: A sortable (date, trial) tuple for a run key. Runs are ordered by date and then by trial.
+    """
+    if key is None:
+        return "", -1
+    date_folder_name, trial = key.split("/")
+    return date_folder_name, int(trial)
+
+
+def get_user_output_folder(user_folder: str) -> str:
+    """
+    :param user_folder: The user's folder in the recordings tree.
+
+    :return: The output folder that the user's folder is in.
+    """
+    return os.path.dirname(os.path.normpath(os.path.abspath(user_folder)))
+
+
+@contextmanager
+def locked_manifest(user_folder: str) -> Iterator[Dict[str, Any]]:
+    """
+    Locks the manifest of a user for a read-modify-write. The manifest is yielded, and any changes to it are
+    written back atomically when the block finishes without an exception.
+
+    :param user_folder: The user's folder in the recordings tree.
+
+    :return: A context manager that yields the manifest.
+    """
+    os.makedirs(user_folder, exist_ok=True)
+    with open(os.path.join(user_folder, LOCK_FILE_NAME), "a+") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            manifest = load_manifest(user_folder)
+            yield manifest
+            write_json_atomically(os.path.join(user_folder, MANIFEST_FILE_NAME), manifest)
+            journal_changes(get_user_output_folder(user_folder), [os.path.join(user_folder, MANIFEST_FILE_NAME)])
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def load_manifest(user_folder: str) -> Dict[str, Any]:
+    """
+    Loads the manifest of a user. The manifest only holds pointers (the latest date, the next trial on that
+    date, the latest run and the latest complete run), so it stays the same size however many runs there are.
+    If the user has no manifest yet, then one is built from the existing folders.
+
+    :param user_folder: The user's folder in the recordings tree.
+
+    :return: The manifest.
+    """
+    manifest_path = os.path.join(user_folder, MANIFEST_FILE_NAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    return build_manifest_from_folders(user_folder)
+
+
+def build_manifest_from_folders(user_folder: str) -> Dict[str, Any]:
+    """
+    Builds the manifest for a user whose runs were saved before manifests existed. This walks the user's
+    folder once; afterwards, the manifest is kept up to date as runs are allocated and completed. Existing runs
+    without an error file are treated as complete.
+
+    :param user_folder: The user's folder in the recordings tree.
+
+    :return: The manifest.
+    """
+    manifest = {
+        "latest_date": None,
+        "next_trial": 0,
+        "latest_run": None,
+        "latest_complete_run": None,
+    }
+    if not os.path.isdir(user_folder):
+        return manifest
+
+    print_log(f"Building the run manifest for {user_folder}.")
+    for date_entry in sorted((d for d in os.scandir(user_folder) if d.is_dir()), key=lambda d: d.name):
+        trials = sorted(
+            int(t.name) for t in os.scandir(date_entry.path) if t.is_dir() and t.name.isdigit()
+        )
+        if len(trials) == 0:
+            continue
+        manifest["latest_date"] = date_entry.name
+        manifest["next_trial"] = trials[-1] + 1
+        manifest["latest_run"] = run_key(date_entry.name, trials[-1])
+        for trial in trials:
+            trial_path = os.path.join(date_entry.path, str(trial))
+            if not os.path.exists(os.path.join(trial_path, ERROR_FILE_NAME)) and len(os.listdir(trial_path)) > 0:
+                manifest["latest_complete_run"] = run_key(date_entry.name, trial)
+    return manifest
+
+
+def log_run(user_folder: str, key: str, status: str) -> None:
+    """
+    Appends a status change of a run to the user's run log.
+
+    :param user_folder: The user's folder in the recordings tree.
+    :param key: The key of the run.
+    :param status: The new status of the run.
+
+    :return: None.
+    """
+    with open(os.path.join(user_folder, RUNS_LOG_FILE_NAME), "a+") as f:
+        f.write(
+            json.dumps(
+                {
+                    "run": key,
+                    "folder": os.path.join(user_folder, key),
+                    "status": status,
+                    "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                }
+            )
+            + "\n"
+        )
+    journal_changes(get_user_output_folder(user_folder), [os.path.join(user_folder, RUNS_LOG_FILE_NAME)])
+
+
+def allocate_run(user_folder: str, date_folder_name: str) -> str:
+    """
+    Allocates (and creates) the folder for a new run on the given date, without listing the date folder.
+
+    :param user_folder: The user's folder in the recordings tree.
+    :param date_folder_name: The date of the run, as year-month-day.
+
+    :return: The path of the new run folder.
+    """
+    with locked_manifest(user_folder) as manifest:
+        if manifest["latest_date"] == date_folder_name:
+            trial = manifest["next_trial"]
+        elif manifest["latest_date"] is None or date_folder_name > manifest["latest_date"]:
+            trial = 0
+        else:
+            # The clock went backwards; fall back on the folder contents for this older date.
+            date_folder = os.path.join(user_folder, date_folder_name)
+            trials = [int(t) for t in os.listdir(date_folder) if t.isdigit()] if os.path.isdir(date_folder) else []
+            trial = max(trials) + 1 if len(trials) > 0 else 0
+
+        run_path = os.path.join(user_folder, date_folder_name, str(trial))
+        os.makedirs(run_path, exist_ok=True)
+
+        key = run_key(date_folder_name, trial)
+        if run_order(key) > run_order(manifest["latest_run"]):
+            manifest["latest_date"] = date_folder_name
+            manifest["next_trial"] = trial + 1
+            manifest["latest_run"] = key
+        log_run(user_folder, key, RUN_STARTED)
+    return run_path
+
+
+def set_run_status(run_path: str, status: str) -> None:
+    """
+    Records the new status of a run. Completing a run makes it the latest complete run (unless a newer run
+    has completed already).
+
+    :param run_path: The run folder path.
+    :param status: The new status of the run (RUN_COMPLETE, RUN_PARTIAL, RUN_FAILED or RUN_ARCHIVED).
+
+    :return: None.
+    """
+    user_folder, date_folder_name, trial = split_run_path(run_path)
+    key = run_key(date_folder_name, trial)
+    with locked_manifest(user_folder) as manifest:
+        if status == RUN_COMPLETE and run_order(key) > run_order(manifest["latest_complete_run"]):
+            manifest["latest_complete_run"] = key
+        log_run(user_folder, key, status)
+
+
+def get_run_history(user_folder: str) -> Dict[str, List[str]]:
+    """
+    Reads the status changes of every run from the user's run log.
+
+    :param user_folder: The user's folder in the recordings tree.
+
+    :return: A dict from the key of each logged run to its statuses, oldest first.
+    """
+    history: Dict[str, List[str]] = {}
+    runs_log_path = os.path.join(user_folder, RUNS_LOG_FILE_NAME)
+    if not os.path.isfile(runs_log_path):
+        return history
+    with open(runs_log_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            history.setdefault(entry["run"], []).append(entry["status"])
+    return history
+
+
+def get_run_statuses(user_folder: str) -> Dict[str, str]:
+    """
+    :param user_folder: The user's folder in the recordings tree.
+
+    :return: A dict from the key of each logged run to its latest status.
+    """
+    return {key: statuses[-1] for key, statuses in get_run_history(user_folder).items()}
+
+
+def find_partial_recording_folders(output_folder: str, username: str) -> List[str]:
+    """
+    Locates the partial runs (see RUN_PARTIAL) of a user that are newer than the latest complete run.
+
+    :param output_folder: The folder where all of the recordings are saved.
+    :param username: The username of the user.
+
+    :return: The directories of the partial runs, oldest first.
+    """
+    user_folder = os.path.join(output_folder, username)
+    latest_complete_run = load_manifest(user_folder)["latest_complete_run"]
+    keys = [
+        key
+        for key, status in get_run_statuses(user_folder).items()
+        if status == RUN_PARTIAL and run_order(key) > run_order(latest_complete_run)
+    ]
+    return [os.path.join(user_folder, key) for key in sorted(keys, key=run_order)]
+
+
+def get_latest_run(user_folder: str, date_folder_name: Optional[str] = None) -> Optional[str]:
+    """
+    :param user_folder: The user's folder in the recordings tree.
+    :param date_folder_name: If given, then only a run on this date is returned.
+
+    :return: The path of the latest run of the user (whether it completed or not), or None if there is none.
+    """
+    manifest = load_manifest(user_folder)
+    key = manifest["latest_run"]
+    if key is None or (date_folder_name is not None and manifest["latest_date"] != date_folder_name):
+        return None
+    return os.path.join(user_folder, key)
+
+
+def find_latest_recording_folder(output_folder: str, username: str) -> Optional[str]:
+    """
+    Locates the most recent complete run folder for a user.
+
+    :param output_folder: The folder where all of the recordings are saved.
+    :param username: The username of the user.
+
+    :return: A string representing the directory of the latest complete run, or None if there is none.
+    """
+    user_folder = os.path.join(output_folder, username)
+    key = load_manifest(user_folder)["latest_complete_run"]
+    return os.path.join(user_folder, key) if key is not None else None
+
+
+def find_last_recording_folder(current_recording_directory: str) -> Optional[str]:
+    """
+    Locates the previous complete recording folder (prior to this run).
+
+    :param current_recording_directory: The folder of the current run.
+
+    :return: A string representing the directory of the past run, or None if there is no complete past run.
+    """
+    user_folder, date_folder_name, trial = split_run_path(current_recording_directory)
+    key = load_manifest(user_folder)["latest_complete_run"]
+    if key is None or key == run_key(date_folder_name, trial):
+        return None
+    return os.path.join(user_folder, key)
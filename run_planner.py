@@ -0,0 +1,590 @@
+#!venv/bin/python
+
+import datetime
+import json
+import math
+import os
+import sqlite3
+import statistics
+from typing import Dict, Any, List, Optional, Tuple
+
+import click
+import numpy as np
+
+from utils import (
+    print_log,
+    load_credentials,
+    verify_input_date,
+    parse_input_date,
+    get_old_metadata,
+    get_recording_files,
+)
+from audio_compression import get_compressed_path
+
+PLAN_HISTORY_FILE_NAME = "plans.jsonl"
+INPUT_DATE_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+# The timing model before there is any history: a fixed cost per run (starting the driver, logging in and
+# searching), a cost per recording on the page (revealing and extracting it) and a cost per download.
+DEFAULT_SECONDS_PER_RUN = 90.0
+DEFAULT_SECONDS_PER_RECORDING = 0.5
+DEFAULT_SECONDS_PER_DOWNLOAD = 1.0
+DEFAULT_RECORDING_BYTES = 128 * 1024
+DEFAULT_RECORDINGS_PER_DAY = 5.0
+# The number of days before the newest known recording of a user that its recording rate is measured over.
+RATE_WINDOW_DAYS = 90
+# Number of recent plans that the timing model is fitted to, and the least that a least squares fit needs.
+HISTORY_WINDOW = 200
+MIN_FIT_RECORDS = 5
+MAX_DOWNLOAD_WORKERS = 4
+DOWNLOADS_PER_WORKER = 100
+MAX_RECORDINGS_PER_SHARD = 2000
+NUM_SIZE_SAMPLES = 50
+
+
+def format_input_date(day: datetime.date, end_of_day: bool = False) -> str:
+    """
+    :param day: A day.
+    :param end_of_day: Whether to use the last second of the day instead of the first.
+
+    :return: The day in the input format "YYYY/MM/DD HH:MM:SS".
+    """
+    return datetime.datetime.combine(day, datetime.time(23, 59, 59) if end_of_day else datetime.time()).strftime(
+        INPUT_DATE_FORMAT
+    )
+
+
+def get_daily_counts(index_file: Optional[str], username: str) -> Dict[datetime.date, int]:
+    """
+    :param index_file: The search index (see recording_index.py).
+    :param username: The username of the user.
+
+    :return: The number of recordings in the catalog per day on which they were made.
+    """
+    if index_file is None or not os.path.isfile(index_file):
+        return {}
+    connection = sqlite3.connect(index_file)
+    try:
+        rows = connection.execute(
+            "SELECT recorded_on, COUNT(*) FROM recordings WHERE username = ? AND recorded_on IS NOT NULL "
+            "GROUP BY recorded_on",
+            (username,),
+        ).fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    finally:
+        connection.close()
+    counts = {}
+    for recorded_on, count in rows:
+        try:
+            counts[datetime.date.fromisoformat(recorded_on)] = count
+        except ValueError:
+            continue
+    return counts
+
+
+def estimate_recording_bytes(index_file: Optional[str], username: str) -> Optional[float]:
+    """
+    :param index_file: The search index (see recording_index.py).
+    :param username: The username of the user.
+
+    :return: The average size of the newest wav files of the user that are still on disk, or None if there are
+        none.
+    """
+    if index_file is None or not os.path.isfile(index_file):
+        return None
+    connection = sqlite3.connect(index_file)
+    try:
+        rows = connection.execute(
+            "SELECT wav_path FROM recordings WHERE username = ? AND wav_path IS NOT NULL "
+            "ORDER BY recorded_on DESC LIMIT ?",
+            (username, NUM_SIZE_SAMPLES),
+        ).fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    finally:
+        connection.close()
+    sizes = [os.path.getsize(wav_path) for (wav_path,) in rows if os.path.isfile(wav_path)]
+    return sum(sizes) / len(sizes) if len(sizes) > 0 else None
+
+
+def load_plan_history(output_folder: str) -> List[Dict[str, Any]]:
+    """
+    :param output_folder: The folder where all of the recordings are saved.
+
+    :return: The planned and actual numbers of the most recent runs (at most HISTORY_WINDOW), oldest first.
+    """
+    history_path = os.path.join(output_folder, PLAN_HISTORY_FILE_NAME)
+    if not os.path.isfile(history_path):
+        return []
+    history = []
+    with open(history_path, "r") as f:
+        for line in f:
+            try:
+                history.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return history[-HISTORY_WINDOW:]
+
+
+def fit_timing_model(history: List[Dict[str, Any]]) -> Dict[str, float]:
+    """
+    Fits the seconds that a run takes as seconds_per_run + seconds_per_recording * recordings
+    + seconds_per_download * downloads / workers, to the actual numbers of the past runs. With too little (or
+    too uniform) history for a least squares fit, the default model is scaled by how much the past runs took
+    longer or shorter than planned.
+
+    :param history: The plan history (see load_plan_history).
+
+    :return: The "seconds_per_run", "seconds_per_recording" and "seconds_per_download".
+    """
+    model = {
+        "seconds_per_run": DEFAULT_SECONDS_PER_RUN,
+        "seconds_per_recording": DEFAULT_SECONDS_PER_RECORDING,
+        "seconds_per_download": DEFAULT_SECONDS_PER_DOWNLOAD,
+    }
+    records = [record for record in history if record.get("actual", {}).get("seconds") is not None]
+    if len(records) >= MIN_FIT_RECORDS:
+        features = np.array(
+            [
+                [1.0, record["actual"]["recordings"], record["actual"]["downloads"] / max(record["workers"], 1)]
+                for record in records
+            ]
+        )
+        seconds = np.array([record["actual"]["seconds"] for record in records])
+        coefficients, _, rank, _ = np.linalg.lstsq(features, seconds, rcond=None)
+        if rank == features.shape[1] and np.all(coefficients >= 0):
+            return dict(zip(model, (float(coefficient) for coefficient in coefficients)))
+
+    ratios = [
+        record["actual"]["seconds"] / record["planned"]["seconds"]
+        for record in records
+        if record["planned"].get("seconds", 0) > 0
+    ]
+    if len(ratios) > 0:
+        scale = statistics.median(ratios)
+        model = {name: value * scale for name, value in model.items()}
+    return model
+
+
+def get_count_correction(history: List[Dict[str, Any]], username: str) -> float:
+    """
+    :param history: The plan history (see load_plan_history).
+    :param username: The username of the user.
+
+    :return: How many more (or fewer) recordings the past runs of the user had than estimated (before the
+        correction of their own plan), as a factor between 0.25 and 4.
+    """
+    ratios = [
+        record["actual"]["recordings"] * record.get("correction", 1.0) / record["planned"]["recordings"]
+        for record in history
+        if record["username"] == username
+        and record.get("actual") is not None
+        and record["planned"].get("recordings", 0) > 0
+    ]
+    if len(ratios) == 0:
+        return 1.0
+    return min(max(statistics.median(ratios), 0.25), 4.0)
+
+
+class UserPlan:
+    """
+    The expected size of the run of one user, and the options that were picked for it: the number of
+    recordings to download at a time, and the date ranges (shards) to run it in.
+    """
+
+    def __init__(
+        self,
+        username: str,
+        user_index: int,
+        recordings: float,
+        downloads: float,
+        recording_bytes: float,
+        source: str,
+        correction: float = 1.0,
+    ) -> None:
+        """
+        :param username: The username of the user.
+        :param user_index: The position of the user in the credentials file.
+        :param recordings: The expected number of recordings on the page.
+        :param downloads: The expected number of recordings to download.
+        :param recording_bytes: The expected size of one recording.
+        :param source: Where the estimate comes from: "catalog", "history" or "default".
+        :param correction: The factor that the estimate was corrected by (see get_count_correction).
+        """
+        self.username = username
+        self.user_index = user_index
+        self.recordings = recordings
+        self.downloads = downloads
+        self.recording_bytes = recording_bytes
+        self.source = source
+        self.correction = correction
+        self.workers = 1
+        self.seconds = 0.0
+        self.shards: List[Dict[str, Any]] = []
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "username": self.username,
+            "recordings": round(self.recordings),
+            "downloads": round(self.downloads),
+            "bytes": round(self.downloads * self.recording_bytes),
+            "seconds": round(self.seconds, 1),
+            "workers": self.workers,
+            "source": self.source,
+            "shards": self.shards,
+        }
+
+
+class RunPlanner:
+    """
+    Plans a run before any driver is started. The number of recordings of each user in the date range is
+    estimated from the search index (the recordings it already holds, and the user's recording rate for the
+    days after the newest one), corrected by how far off the past plans of the user were. From that, the
+    planner picks the download concurrency of each user, splits long date ranges into shards, and orders the
+    users longest job first. The planned and the actual numbers of every run are appended to plans.jsonl in
+    the output folder, which the timing model is fitted to the next time.
+    """
+
+    def __init__(
+        self,
+        output_folder: str,
+        start_date: str,
+        until_date: Optional[str] = None,
+        index_file: Optional[str] = None,
+        download_duplicates: bool = False,
+        max_recordings_per_shard: int = MAX_RECORDINGS_PER_SHARD,
+        max_workers: int = MAX_DOWNLOAD_WORKERS,
+    ) -> None:
+        """
+        :param output_folder: The folder where all of the recordings are saved.
+        :param start_date: The earliest date to search for recordings from ("YYYY/MM/DD HH:MM:SS").
+        :param until_date: The latest date to search for recordings from. If None, then until today.
+        :param index_file: The search index (see recording_index.py). If None, then the estimates only come
+            from the plan history.
+        :param download_duplicates: Whether the recordings that were downloaded before are downloaded again.
+        :param max_recordings_per_shard: The number of recordings above which the date range of a user is split.
+        :param max_workers: The most recordings that a user may download at a time.
+        """
+        self.output_folder = output_folder
+        self.start_date = start_date
+        self.until_date = until_date
+        self.start_day = parse_input_date(start_date)
+        self.end_day = parse_input_date(until_date) if until_date is not None else datetime.date.today()
+        self.index_file = index_file
+        self.download_duplicates = download_duplicates
+        self.max_recordings_per_shard = max_recordings_per_shard
+        self.max_workers = max_workers
+        self.history = load_plan_history(output_folder)
+        self.model = fit_timing_model(self.history)
+
+    def estimate_seconds(self, recordings: float, downloads: float, workers: int) -> float:
+        """
+        :return: The expected duration of a run with these numbers (see fit_timing_model).
+        """
+        return (
+            self.model["seconds_per_run"]
+            + self.model["seconds_per_recording"] * recordings
+            + self.model["seconds_per_download"] * downloads / max(workers, 1)
+        )
+
+    def get_expected_counts(
+        self, daily_counts: Dict[datetime.date, int], rate: float
+    ) -> List[Tuple[datetime.date, float, float]]:
+        """
+        :param daily_counts: The recordings of the user in the catalog per day (see get_daily_counts).
+        :param rate: The number of new recordings per day after the newest one in the catalog.
+
+        :return: The expected number of recordings on the page and of downloads for each day of the range.
+        """
+        latest_known = max(daily_counts) if len(daily_counts) > 0 else None
+        expected = []
+        day = self.start_day
+        while day <= self.end_day:
+            if latest_known is not None and day <= latest_known:
+                known = daily_counts.get(day, 0)
+                expected.append((day, known, known if self.download_duplicates else 0))
+            else:
+                expected.append((day, rate, rate))
+            day += datetime.timedelta(days=1)
+        return expected
+
+    def get_rate(self, username: str, daily_counts: Dict[datetime.date, int]) -> Tuple[Optional[float], str]:
+        """
+        :return: The number of recordings per day of the user (or None if nothing is known about the user),
+            and where it comes from.
+        """
+        if len(daily_counts) > 0:
+            window_end = max(daily_counts)
+            window_start = max(min(daily_counts), window_end - datetime.timedelta(days=RATE_WINDOW_DAYS - 1))
+            count = sum(n for day, n in daily_counts.items() if window_start <= day <= window_end)
+            return count / ((window_end - window_start).days + 1), "catalog"
+        for record in reversed(self.history):
+            if record["username"] == username and record.get("actual") is not None:
+                days = (parse_input_date(record["until_date"]) - parse_input_date(record["start_date"])).days + 1
+                return record["actual"]["recordings"] / max(days, 1), "history"
+        return None, "default"
+
+    def split_into_shards(
+        self, expected: List[Tuple[datetime.date, float, float]], correction: float, workers: int
+    ) -> List[Dict[str, Any]]:
+        """
+        Splits the date range into consecutive shards of at most max_recordings_per_shard expected recordings
+        each (a day is never split).
+
+        :param expected: The expected numbers per day (see get_expected_counts).
+        :param correction: The count correction of the user (see get_count_correction).
+        :param workers: The number of recordings to download at a time.
+
+        :return: The shards, each with its "start_date" and "until_date" (in the input format) and its
+            expected "recordings", "downloads" and "seconds".
+        """
+        groups: List[List[Tuple[datetime.date, float, float]]] = [[]]
+        num_in_group = 0.0
+        for day, recordings, downloads in expected:
+            if len(groups[-1]) > 0 and num_in_group + recordings * correction > self.max_recordings_per_shard:
+                groups.append([])
+                num_in_group = 0.0
+            groups[-1].append((day, recordings, downloads))
+            num_in_group += recordings * correction
+
+        shards = []
+        for i, group in enumerate(groups):
+            recordings = sum(day_recordings for _, day_recordings, _ in group) * correction
+            downloads = sum(day_downloads for _, _, day_downloads in group) * correction
+            shards.append(
+                {
+                    "start_date": self.start_date if i == 0 else format_input_date(group[0][0]),
+                    "until_date": (
+                        self.until_date if i == len(groups) - 1 else format_input_date(group[-1][0], end_of_day=True)
+                    ),
+                    "recordings": round(recordings),
+                    "downloads": round(downloads),
+                    "seconds": round(self.estimate_seconds(recordings, downloads, workers), 1),
+                }
+            )
+        return shards
+
+    def plan(self, usernames: List[str]) -> List[UserPlan]:
+        """
+        Plans the runs of the users.
+
+        :param usernames: The usernames of the users, in the order of the credentials file.
+
+        :return: The plans of the users, longest first.
+        """
+        rates = {}
+        daily_counts = {}
+        for username in usernames:
+            daily_counts[username] = get_daily_counts(self.index_file, username)
+            rates[username] = self.get_rate(username, daily_counts[username])
+        known_rates = [rate for rate, _ in rates.values() if rate is not None]
+        default_rate = statistics.median(known_rates) if len(known_rates) > 0 else DEFAULT_RECORDINGS_PER_DAY
+
+        plans = []
+        for user_index, username in enumerate(usernames):
+            rate, source = rates[username]
+            correction = get_count_correction(self.history, username)
+            expected = self.get_expected_counts(daily_counts[username], rate if rate is not None else default_rate)
+            recordings = sum(day_recordings for _, day_recordings, _ in expected) * correction
+            downloads = sum(day_downloads for _, _, day_downloads in expected) * correction
+            recording_bytes = estimate_recording_bytes(self.index_file, username) or DEFAULT_RECORDING_BYTES
+            user_plan = UserPlan(username, user_index, recordings, downloads, recording_bytes, source, correction)
+            user_plan.workers = min(self.max_workers, max(1, math.ceil(downloads / DOWNLOADS_PER_WORKER)))
+            user_plan.shards = self.split_into_shards(expected, correction, user_plan.workers)
+            user_plan.seconds = sum(shard["seconds"] for shard in user_plan.shards)
+            plans.append(user_plan)
+
+        # Longest job first, so that the runs of several workers (see work_queue.py) finish close together.
+        plans.sort(key=lambda user_plan: user_plan.seconds, reverse=True)
+        return plans
+
+    def get_unsharded(self, user_plan: UserPlan) -> Dict[str, Any]:
+        """
+        :param user_plan: The plan of a user.
+
+        :return: The whole date range of the plan as one shard, for runs that cannot be split (such as the runs
+            of a work queue, which are leased per user).
+        """
+        return {
+            "start_date": self.start_date,
+            "until_date": self.until_date,
+            "recordings": round(user_plan.recordings),
+            "downloads": round(user_plan.downloads),
+            "seconds": round(self.estimate_seconds(user_plan.recordings, user_plan.downloads, user_plan.workers), 1),
+        }
+
+    def print_plan(self, plans: List[UserPlan]) -> None:
+        """
+        Logs the plan of every user and the total.
+
+        :param plans: The plans (see plan).
+
+        :return: None.
+        """
+        for user_plan in plans:
+            print_log(
+                f"Plan for {user_plan.username}: about {user_plan.recordings:.0f} recordings, "
+                f"{user_plan.downloads:.0f} downloads ({user_plan.downloads * user_plan.recording_bytes / 2 ** 20:.1f} "
+                f"MB) in {user_plan.seconds / 60:.1f} minutes, {user_plan.workers} download(s) at a time, "
+                f"{len(user_plan.shards)} shard(s) (estimated from the {user_plan.source})."
+            )
+        total_seconds = sum(user_plan.seconds for user_plan in plans)
+        print_log(f"The run is planned to take {total_seconds / 60:.1f} minutes for {len(plans)} users.")
+
+    def record_actual(
+        self,
+        user_plan: UserPlan,
+        shard: Dict[str, Any],
+        run_path: str,
+        seconds: float,
+        info_file: str,
+        num_earlier_recordings: int = 0,
+    ) -> None:
+        """
+        Appends the planned and the actual numbers of a finished shard to the plan history.
+
+        :param user_plan: The plan of the user.
+        :param shard: The shard of the plan that was run.
+        :param run_path: The run folder path.
+        :param seconds: How long the shard took.
+        :param info_file: The filename of the metadata file in the run folder.
+        :param num_earlier_recordings: Number of recordings at the start of the metadata that are from the
+            earlier shards of the user, which were run into the same run folder.
+
+        :return: None.
+        """
+        metadata = get_old_metadata(os.path.join(run_path, info_file))
+        recording_files = get_recording_files(metadata, run_path)
+        metadata = metadata[num_earlier_recordings:]
+        file_sizes = []
+        for wav_path in [recording_files[m["audio_id"]] for m in metadata if m.get("audio_id") in recording_files]:
+            for file_path in [wav_path, get_compressed_path(wav_path)]:
+                if os.path.isfile(file_path):
+                    file_sizes.append(os.path.getsize(file_path))
+                    break
+        record = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "username": user_plan.username,
+            "run_path": os.path.abspath(run_path),
+            "start_date": shard["start_date"],
+            "until_date": shard["until_date"] or format_input_date(datetime.date.today(), end_of_day=True),
+            "workers": user_plan.workers,
+            "source": user_plan.source,
+            "correction": user_plan.correction,
+            "planned": {
+                "recordings": shard["recordings"],
+                "downloads": shard["downloads"],
+                "bytes": round(shard["downloads"] * user_plan.recording_bytes),
+                "seconds": shard["seconds"],
+            },
+            "actual": {
+                "recordings": len(metadata),
+                "downloads": len(file_sizes),
+                "bytes": sum(file_sizes),
+                "seconds": round(seconds, 1),
+            },
+        }
+        os.makedirs(self.output_folder, exist_ok=True)
+        with open(os.path.join(self.output_folder, PLAN_HISTORY_FILE_NAME), "a+") as f:
+            f.write(json.dumps(record) + "\n")
+        self.history.append(record)
+        print_log(
+            f"{user_plan.username} took {seconds / 60:.1f} minutes for {len(metadata)} recordings "
+            f"(planned: {shard['seconds'] / 60:.1f} minutes for {shard['recordings']} recordings)."
+        )
+
+
+@click.group()
+def cli() -> None:
+    """
+    Plans runs from the search index and the plan history, and reports how well past plans did.
+    """
+
+
+@cli.command()
+@click.option(
+    "-c",
+    "--config",
+    type=str,
+    help="specify a file for credential information",
+    required=False,
+    default="credentials.json",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify the directory where the recordings are saved",
+    required=False,
+    default="recordings",
+)
+@click.option("-d", "--date", type=str, help="specify a date in the format 'YYYY/MM/DD HH:MM:SS'", required=True)
+@click.option("--end-date", type=str, help="the latest date, in the format 'YYYY/MM/DD HH:MM:SS'", required=False)
+@click.option("--index", type=str, help="specify the search index file (see recording_index.py).", required=False)
+@click.option("--user", type=str, help="only plan for this user.", required=False)
+@click.option("--download-duplicates", is_flag=True, help="plan to download recordings that were downloaded before.")
+@click.option("--json", "as_json", is_flag=True, help="print the plan of every user as a json line.")
+def plan(
+    config: str,
+    output: str,
+    date: str,
+    end_date: Optional[str],
+    index: Optional[str],
+    user: Optional[str],
+    download_duplicates: bool,
+    as_json: bool,
+) -> None:
+    """
+    Prints the plan of a run without running it.
+    """
+    if not verify_input_date(date) or (end_date is not None and not verify_input_date(end_date)):
+        print_log("ERROR: The dates have to be in the format \"YYYY/MM/DD HH:MM:SS\".")
+        return
+    usernames = [credentials["username"] for credentials in load_credentials(credentials_file=config, user=user)]
+    planner = RunPlanner(output, date, end_date, index, download_duplicates)
+    plans = planner.plan(usernames)
+    if as_json:
+        for user_plan in plans:
+            print(json.dumps(user_plan.to_dict()))
+    else:
+        planner.print_plan(plans)
+
+
+@cli.command()
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify the directory where the recordings are saved",
+    required=False,
+    default="recordings",
+)
+def report(output: str) -> None:
+    """
+    Prints how far off the planned recordings and durations of the past runs were, and the current timing model.
+    """
+    history = [record for record in load_plan_history(output) if record.get("actual") is not None]
+    if len(history) == 0:
+        print_log(f"There is no plan history in {output} yet.")
+        return
+    for record in history:
+        print(
+            f"{record['time']} | {record['username']} | recordings {record['planned']['recordings']} -> "
+            f"{record['actual']['recordings']} | minutes {record['planned']['seconds'] / 60:.1f} -> "
+            f"{record['actual']['seconds'] / 60:.1f}"
+        )
+    errors = [
+        abs(record["actual"]["seconds"] - record["planned"]["seconds"]) / max(record["actual"]["seconds"], 1)
+        for record in history
+    ]
+    model = fit_timing_model(history)
+    print_log(
+        f"The median error of the planned durations is {statistics.median(errors) * 100:.0f}%. Timing model: "
+        f"{model['seconds_per_run']:.1f} s per run, {model['seconds_per_recording']:.2f} s per recording and "
+        f"{model['seconds_per_download']:.2f} s per download."
+    )
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,480 @@
+#!venv/bin/python
+
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional
+
+import click
+from selenium.webdriver.chrome.webdriver import WebDriver
+
+from download_recordings import (
+    AudioSession,
+    create_driver,
+    log_in,
+    search_for_recordings,
+    reveal_all_recordings,
+    check_for_uid,
+    extract_recording_metadata,
+    extract_uid_from_recordings,
+    extract_recordings_in_windows,
+)
+from utils import (
+    print_log,
+    create_user_agent,
+    load_credentials,
+    verify_input_date,
+    get_uid_from_event,
+    write_json_atomically,
+)
+
+BUNDLE_FILE_NAME = "bundle.json"
+ACTIVITY_FILE_NAME = "activity.html"
+PERFORMANCE_LOG_FILE_NAME = "performance.jsonl"
+UID_EVENTS_FILE_NAME = "uid_events.json"
+EXPECTED_METADATA_FILE_NAME = "expected_metadata.json"
+AUDIO_FOLDER = "audio"
+AUDIO_INDEX_FILE_NAME = "audio.json"
+
+# Scripts and stylesheets are removed from the snapshots, so that a replayed page never reaches amazon.com.
+STRIPPED_TAGS = re.compile(r"<script\b[^>]*>.*?</script>|<link\b[^>]*>", re.IGNORECASE | re.DOTALL)
+# Added to a replayed page to remember which recording boxes were expanded, since the recorded uidArray[]
+# events are handed out for those boxes (see ReplayDriver).
+EXPANSION_TRACKER = """
+<script>
+window.__expandedBoxes = [];
+document.addEventListener("click", function (event) {
+    var box = event.target.closest(".apd-content-box");
+    if (box !== null && event.target.closest("button") !== null) {
+        window.__expandedBoxes.push(box.id);
+    }
+}, true);
+</script>
+"""
+
+
+class DriverProxy:
+    """
+    Passes everything on to a WebDriver, so that subclasses can change single methods of it.
+    """
+
+    def __init__(self, driver: WebDriver) -> None:
+        self.driver = driver
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.driver, name)
+
+
+class SessionRecorder:
+    """
+    Writes a fixture bundle of a live session: a snapshot of the revealed activity history page, every
+    performance log entry that the pipeline read, the uidArray[] event of every recording, the extracted
+    metadata and the audio of the recordings.
+    """
+
+    def __init__(self, bundle_dir: str) -> None:
+        self.bundle_dir = bundle_dir
+        self.num_log_calls = 0
+        self.uid_events: List[Dict[str, Any]] = []
+        os.makedirs(os.path.join(bundle_dir, AUDIO_FOLDER), exist_ok=True)
+        self.audio_index: Dict[str, str] = {}
+
+    def snapshot_page(self, driver: WebDriver) -> None:
+        """
+        Saves the page that the driver shows, without its scripts and stylesheets.
+
+        :param driver: The WebDriver, with all of the recordings revealed.
+
+        :return: None.
+        """
+        with open(os.path.join(self.bundle_dir, ACTIVITY_FILE_NAME), "w") as f:
+            f.write(STRIPPED_TAGS.sub("", driver.page_source))
+
+    def record_log(self, entries: List[Dict[str, Any]]) -> None:
+        """
+        Appends the entries of one get_log("performance") call to the bundle.
+
+        :param entries: The performance log entries.
+
+        :return: None.
+        """
+        with open(os.path.join(self.bundle_dir, PERFORMANCE_LOG_FILE_NAME), "a") as f:
+            for entry in entries:
+                f.write(json.dumps({"call": self.num_log_calls, "entry": entry}) + "\n")
+        self.num_log_calls += 1
+        events = [json.loads(entry["message"])["message"] for entry in entries]
+        self.uid_events.extend(filter(check_for_uid, events))
+
+    def record_audio(self, audio_id: str, data: bytes) -> None:
+        """
+        :param audio_id: The audio ID of the recording.
+        :param data: The wav file of the recording.
+
+        :return: None.
+        """
+        file_name = os.path.join(AUDIO_FOLDER, f"{len(self.audio_index)}.wav")
+        with open(os.path.join(self.bundle_dir, file_name), "wb") as f:
+            f.write(data)
+        self.audio_index[audio_id] = file_name
+
+    def save(self, metadata: List[Dict[str, Any]], start_date: str) -> None:
+        """
+        Writes the metadata, the uidArray[] event of every recording (by div id) and the bundle description.
+
+        :param metadata: The metadata that the pipeline extracted.
+        :param start_date: The date that the recordings were searched from.
+
+        :return: None.
+        """
+        div_ids = {recording["audio_id"]: recording["div_id"] for recording in metadata if "audio_id" in recording}
+        uid_events = {}
+        for event in self.uid_events:
+            div_id = div_ids.get(get_uid_from_event(event))
+            if div_id is not None:
+                uid_events[div_id] = event
+        write_json_atomically(os.path.join(self.bundle_dir, UID_EVENTS_FILE_NAME), uid_events)
+        write_json_atomically(os.path.join(self.bundle_dir, EXPECTED_METADATA_FILE_NAME), metadata)
+        write_json_atomically(os.path.join(self.bundle_dir, AUDIO_INDEX_FILE_NAME), self.audio_index)
+        write_json_atomically(
+            os.path.join(self.bundle_dir, BUNDLE_FILE_NAME),
+            {
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "start_date": start_date,
+                "num_recordings": len(metadata),
+                "num_uid_events": len(uid_events),
+                "num_audio": len(self.audio_index),
+                "num_log_calls": self.num_log_calls,
+            },
+        )
+
+
+class RecordingDriver(DriverProxy):
+    """
+    A WebDriver that writes every performance log entry that the pipeline reads into a bundle.
+    """
+
+    def __init__(self, driver: WebDriver, recorder: SessionRecorder) -> None:
+        super().__init__(driver)
+        self.recorder = recorder
+
+    def get_log(self, log_type: str) -> List[Dict[str, Any]]:
+        entries = self.driver.get_log(log_type)
+        if log_type == "performance":
+            self.recorder.record_log(entries)
+        return entries
+
+
+class ReplayDriver(DriverProxy):
+    """
+    A WebDriver on a replayed page (see serve_bundle). Its performance log holds the recorded uidArray[] event
+    of every recording box that was expanded since the log was last read, like the log of the live page.
+    """
+
+    def __init__(self, driver: WebDriver, bundle_dir: str) -> None:
+        super().__init__(driver)
+        with open(os.path.join(bundle_dir, UID_EVENTS_FILE_NAME), "r") as f:
+            self.uid_events = json.load(f)
+
+    def get_log(self, log_type: str) -> List[Dict[str, Any]]:
+        if log_type != "performance":
+            return self.driver.get_log(log_type)
+        div_ids = self.driver.execute_script(
+            "var ids = window.__expandedBoxes || []; window.__expandedBoxes = []; return ids;"
+        )
+        return [
+            {"level": "INFO", "message": json.dumps({"message": self.uid_events[div_id]}), "timestamp": 0}
+            for div_id in div_ids
+            if div_id in self.uid_events
+        ]
+
+
+def serve_bundle(bundle_dir: str, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Serves a bundle on localhost, in a background thread: the activity history page at /activity and the
+    recordings at /audio?uid=<audio ID>.
+
+    :param bundle_dir: The folder of the bundle.
+    :param port: The port to listen on. If 0, then a free port is used.
+
+    :return: The server (its port is server.server_address[1]). Call shutdown() to stop it.
+    """
+    with open(os.path.join(bundle_dir, ACTIVITY_FILE_NAME), "r") as f:
+        activity_page = f.read()
+    activity_page = activity_page.replace("</body>", EXPANSION_TRACKER + "</body>", 1)
+    if EXPANSION_TRACKER not in activity_page:
+        activity_page += EXPANSION_TRACKER
+    with open(os.path.join(bundle_dir, AUDIO_INDEX_FILE_NAME), "r") as f:
+        audio_index = json.load(f)
+
+    class BundleHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            parts = urllib.parse.urlsplit(self.path)
+            if parts.path == "/activity":
+                self.send_body(activity_page.encode("utf-8"), "text/html; charset=utf-8")
+                return
+            audio_id = urllib.parse.parse_qs(parts.query).get("uid", [None])[0]
+            if parts.path == "/audio" and audio_id in audio_index:
+                with open(os.path.join(bundle_dir, audio_index[audio_id]), "rb") as audio_file:
+                    self.send_body(audio_file.read(), "audio/wav")
+                return
+            self.send_error(404)
+
+        def send_body(self, body: bytes, content_type: str) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            return
+
+    server = ThreadingHTTPServer(("localhost", port), BundleHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def record_session(
+    bundle_dir: str,
+    username: str,
+    password: str,
+    start_date: str,
+    cookies_file: str,
+    driver_location: Optional[str],
+    show_driver: bool,
+    system: str,
+    max_audio: Optional[int],
+) -> None:
+    """
+    Logs a user in, searches for their recordings and runs the extraction on a recording driver, then
+    downloads the audio of the recordings into the bundle.
+
+    :param bundle_dir: The folder to write the bundle to.
+    :param username: Username of the user.
+    :param password: Password of the user.
+    :param start_date: The date to search for recordings from.
+    :param cookies_file: The file location where the session's cookies will be saved.
+    :param driver_location: Location of the WebDriver.
+    :param show_driver: Whether to show the driver or run it in the background.
+    :param system: The OS where the script is running.
+    :param max_audio: The number of recordings to save the audio of. If None, then of every recording.
+
+    :return: None.
+    """
+    user_agent = create_user_agent()
+    driver = create_driver(user_agent=user_agent, show=show_driver, system=system, driver_location=driver_location)
+    recorder = SessionRecorder(bundle_dir)
+    try:
+        log_in(driver, username, password, cookies_file)
+        search_for_recordings(driver, start_date, system=system)
+        driver.implicitly_wait(5)
+        reveal_all_recordings(driver)
+        driver.implicitly_wait(5)
+        recorder.snapshot_page(driver)
+
+        recording_driver = RecordingDriver(driver, recorder)
+        # Throw away the events of the search, like extract_recordings_in_windows does.
+        recording_driver.get_log("performance")
+        recording_boxes = driver.find_elements_by_class_name("apd-content-box")
+        metadata, indices_to_download = extract_recording_metadata(recording_boxes, recording_driver, [], True)
+        extract_uid_from_recordings(recording_driver, sorted(indices_to_download), metadata)
+
+        audio_session = AudioSession(
+            driver, user_agent, log_in_again=lambda: log_in(driver, username, password, cookies_file)
+        )
+        audio_ids = [recording["audio_id"] for recording in metadata if "audio_id" in recording]
+        for audio_id in audio_ids[:max_audio]:
+            try:
+                recorder.record_audio(audio_id, b"".join(audio_session.stream(audio_id)))
+            except IOError as e:
+                print_log(f"WARNING: {e}")
+        recorder.save(metadata, start_date)
+    finally:
+        driver.quit()
+    print_log(f"Recorded {len(metadata)} recordings ({len(recorder.audio_index)} with audio) into {bundle_dir}.")
+
+
+def replay_session(
+    bundle_dir: str,
+    driver_location: Optional[str],
+    show_driver: bool,
+    system: str,
+    window_size: Optional[int],
+    output_dir: Optional[str],
+) -> bool:
+    """
+    Runs the extraction and the downloads against a bundle served from localhost, and compares the results
+    with what was recorded.
+
+    :param bundle_dir: The folder of the bundle.
+    :param driver_location: Location of the WebDriver.
+    :param show_driver: Whether to show the driver or run it in the background.
+    :param system: The OS where the script is running.
+    :param window_size: If given, the recordings are extracted this many at a time (see
+        extract_recordings_in_windows).
+    :param output_dir: The folder to download the recordings to. If None, then they are only compared.
+
+    :return: Whether the extracted metadata and the downloaded recordings match the bundle.
+    """
+    with open(os.path.join(bundle_dir, EXPECTED_METADATA_FILE_NAME), "r") as f:
+        expected_metadata = json.load(f)
+    with open(os.path.join(bundle_dir, AUDIO_INDEX_FILE_NAME), "r") as f:
+        audio_index = json.load(f)
+
+    server = serve_bundle(bundle_dir)
+    base_url = f"http://localhost:{server.server_address[1]}"
+    user_agent = create_user_agent()
+    driver = create_driver(user_agent=user_agent, show=show_driver, system=system, driver_location=driver_location)
+    timings = {}
+    try:
+        replay_driver = ReplayDriver(driver, bundle_dir)
+        started = time.time()
+        driver.get(base_url + "/activity")
+        reveal_all_recordings(driver)
+        timings["load"] = time.time() - started
+
+        started = time.time()
+        if window_size is not None:
+            metadata = extract_recordings_in_windows(replay_driver, [], True, window_size)
+        else:
+            replay_driver.get_log("performance")
+            recording_boxes = driver.find_elements_by_class_name("apd-content-box")
+            metadata, indices_to_download = extract_recording_metadata(recording_boxes, replay_driver, [], True)
+            extract_uid_from_recordings(replay_driver, sorted(indices_to_download), metadata)
+        timings["extract"] = time.time() - started
+
+        started = time.time()
+        audio_session = AudioSession(
+            driver,
+            user_agent,
+            log_in_again=lambda: driver.get_cookies(),
+            keep_alive_seconds=float("inf"),
+            max_retries=0,
+            audio_url_base=base_url + "/audio?uid=",
+        )
+        num_audio_mismatches = 0
+        for i, audio_id in enumerate(audio_index):
+            data = b"".join(audio_session.stream(audio_id))
+            with open(os.path.join(bundle_dir, audio_index[audio_id]), "rb") as f:
+                num_audio_mismatches += data != f.read()
+            if output_dir is not None:
+                os.makedirs(output_dir, exist_ok=True)
+                with open(os.path.join(output_dir, f"{i}.wav"), "wb") as f:
+                    f.write(data)
+        timings["download"] = time.time() - started
+    finally:
+        driver.quit()
+        server.shutdown()
+
+    num_metadata_mismatches = sum(
+        1 for expected, actual in zip(expected_metadata, metadata) if expected != actual
+    ) + abs(len(expected_metadata) - len(metadata))
+    print_log(
+        f"Replayed {len(metadata)} recordings: loading took {timings['load']:.2f} s, extraction "
+        f"{timings['extract']:.2f} s and {len(audio_index)} downloads {timings['download']:.2f} s."
+    )
+    if num_metadata_mismatches > 0 or num_audio_mismatches > 0:
+        print_log(
+            f"ERROR: {num_metadata_mismatches} recordings were extracted differently from the recorded session, "
+            f"and {num_audio_mismatches} recordings were downloaded differently."
+        )
+        return False
+    print_log("The replay matches the recorded session.")
+    return True
+
+
+@click.group()
+def cli() -> None:
+    """
+    Records live sessions into fixture bundles and replays them offline.
+    """
+
+
+@cli.command()
+@click.option("--bundle", type=str, required=True, help="the folder to write the bundle to.")
+@click.option(
+    "-c",
+    "--config",
+    type=str,
+    help="specify a file for credential information",
+    required=False,
+    default="credentials.json",
+)
+@click.option("-u", "--user", type=str, help="the user to record (default: the first one).", required=False)
+@click.option(
+    "-C",
+    "--cookies",
+    type=str,
+    help="specify a file for the stored cookies",
+    required=False,
+    default="cookies.json",
+)
+@click.option(
+    "-d",
+    "--date",
+    type=str,
+    help='record the recordings from this date on ("YYYY/MM/DD HH:MM:SS")',
+    required=True,
+)
+@click.option("--max-audio", type=int, help="number of recordings to save the audio of.", required=False)
+@click.option("--driver", type=str, help="specify the location of the driver", required=False)
+@click.option("--show", is_flag=True, help="show the driver.")
+@click.option("--system", type=str, help="the operating system", required=False, default="linux")
+def record(
+    bundle: str,
+    config: str,
+    user: Optional[str],
+    cookies: str,
+    date: str,
+    max_audio: Optional[int],
+    driver: Optional[str],
+    show: bool,
+    system: str,
+) -> None:
+    """
+    Records a live session of one user into a bundle.
+    """
+    if not verify_input_date(date):
+        raise click.BadParameter('The date has to be in the format "YYYY/MM/DD HH:MM:SS".')
+    credentials = load_credentials(credentials_file=config, user=user)[0]
+    record_session(
+        bundle, credentials["username"], credentials["password"], date, cookies, driver, show, system, max_audio
+    )
+
+
+@cli.command()
+@click.argument("bundle", type=str)
+@click.option("--window-size", type=int, help="extract the recordings this many at a time.", required=False)
+@click.option("-o", "--output", type=str, help="download the recordings to this folder.", required=False)
+@click.option("--driver", type=str, help="specify the location of the driver", required=False)
+@click.option("--show", is_flag=True, help="show the driver.")
+@click.option("--system", type=str, help="the operating system", required=False, default="linux")
+def replay(
+    bundle: str, window_size: Optional[int], output: Optional[str], driver: Optional[str], show: bool, system: str
+) -> None:
+    """
+    Runs the extraction and the downloads offline against BUNDLE, and checks them against the recorded session.
+    """
+    if not replay_session(bundle, driver, show, system, window_size, output):
+        raise SystemExit(1)
+
+
+@cli.command()
+@click.argument("bundle", type=str)
+@click.option("--port", type=int, default=8766, help="port to serve on.")
+def serve(bundle: str, port: int) -> None:
+    """
+    Serves BUNDLE on localhost until the process is stopped.
+    """
+    server = serve_bundle(bundle, port)
+    print_log(f"Serving {bundle} on http://localhost:{server.server_address[1]}/activity.")
+    while True:
+        time.sleep(60)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,244 @@
+#!venv/bin/python
+
+import json
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, Any, List, Optional, Callable
+
+import click
+import requests
+
+from utils import print_log, get_old_metadata, format_cookies_for_request, write_json_atomically
+
+UID_PARAMETER = "uidArray[]"
+UID_REQUEST_TIMEOUT_SECONDS = 60
+# Field names under which a record of the endpoint's response can hold the record key and the audio id.
+RECORD_KEY_FIELDS = ["recordKey", "key", "id"]
+AUDIO_ID_FIELDS = ["audioId", "audio_id", "uid"]
+
+
+def get_endpoint_from_url(url: str) -> str:
+    """
+    Gets the endpoint of a uidArray[] request (as seen in the performance log), without its uidArray[]
+    parameters.
+
+    :param url: The url of a uidArray[] request.
+
+    :return: The endpoint, with every other query parameter kept.
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = [(name, value) for name, value in urllib.parse.parse_qsl(parts.query) if name != UID_PARAMETER]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+def build_batch_url(endpoint: str, record_keys: List[str]) -> str:
+    """
+    :param endpoint: The endpoint of the uidArray[] requests.
+    :param record_keys: The record keys to resolve in one request.
+
+    :return: The url that asks the endpoint for every record key at once.
+    """
+    separator = "&" if urllib.parse.urlsplit(endpoint).query else "?"
+    if endpoint.endswith("?") or endpoint.endswith("&"):
+        separator = ""
+    return endpoint + separator + urllib.parse.urlencode([(UID_PARAMETER, key) for key in record_keys])
+
+
+def parse_uid_response(data: Any, record_keys: List[str]) -> Dict[str, str]:
+    """
+    Finds the audio ids of the requested records in the endpoint's response. The response can either map the
+    record keys to the audio ids directly, or hold records (at any depth) with a record key field and an audio
+    id field (see RECORD_KEY_FIELDS and AUDIO_ID_FIELDS).
+
+    :param data: The json response of the endpoint.
+    :param record_keys: The record keys that were requested.
+
+    :return: The audio id of every requested record that was in the response, by record key.
+    """
+    wanted = set(record_keys)
+    if isinstance(data, dict) and len(data) > 0 and all(isinstance(value, str) for value in data.values()):
+        return {key: value for key, value in data.items() if key in wanted}
+
+    resolved = {}
+    stack = [data]
+    while len(stack) > 0:
+        item = stack.pop()
+        if isinstance(item, list):
+            stack.extend(item)
+        elif isinstance(item, dict):
+            key = next((item[field] for field in RECORD_KEY_FIELDS if item.get(field) in wanted), None)
+            audio_id = next((item[field] for field in AUDIO_ID_FIELDS if isinstance(item.get(field), str)), None)
+            if key is not None and audio_id is not None:
+                resolved[key] = audio_id
+            else:
+                stack.extend(item.values())
+    return resolved
+
+
+class UidResolver:
+    """
+    Resolves the audio ids of many recordings per request, by asking the uidArray[] endpoint for a whole
+    batch of record keys (the div ids of the recording boxes) at once. This replaces the one request per
+    recording that the page sends when a recording box is expanded.
+    """
+
+    def __init__(
+        self,
+        http: requests.Session,
+        endpoint: str,
+        batch_size: int = 50,
+        refresh_session: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        :param http: An authenticated session (with the cookies of the logged in driver).
+        :param endpoint: The endpoint of the uidArray[] requests.
+        :param batch_size: Number of record keys per request.
+        :param refresh_session: Called to refresh the session's cookies when a request is not authorized. The
+            requests are sent while recordings are extracted from the page, so it must not navigate the driver
+            (see AudioSession.refresh_cookies).
+        """
+        self.http = http
+        self.endpoint = endpoint
+        self.batch_size = max(1, batch_size)
+        self.refresh_session = refresh_session
+        self.num_requests = 0
+
+    def _get(self, url: str) -> requests.Response:
+        response = self.http.get(url, timeout=UID_REQUEST_TIMEOUT_SECONDS)
+        self.num_requests += 1
+        if response.status_code in (401, 403) and self.refresh_session is not None:
+            print_log("WARNING: The uid request was not authorized. Refreshing the session and trying again.")
+            self.refresh_session()
+            response = self.http.get(url, timeout=UID_REQUEST_TIMEOUT_SECONDS)
+            self.num_requests += 1
+        response.raise_for_status()
+        return response
+
+    def resolve(self, record_keys: List[str]) -> Dict[str, str]:
+        """
+        :param record_keys: The record keys of the recordings.
+
+        :return: The audio id of every recording that the endpoint knows, by record key.
+        """
+        resolved = {}
+        for start in range(0, len(record_keys), self.batch_size):
+            batch = record_keys[start:start + self.batch_size]
+            response = self._get(build_batch_url(self.endpoint, batch))
+            resolved.update(parse_uid_response(response.json(), batch))
+        num_missing = len(set(record_keys)) - len(resolved)
+        if num_missing > 0:
+            print_log(f"WARNING: The audio ids of {num_missing} recordings could not be resolved.")
+        return resolved
+
+    def attach_audio_ids(self, metadata: List[Dict[str, Any]], indices_to_download: List[int]) -> None:
+        """
+        Adds the "audio_id" key to the metadata of each recording to download (like extract_uid_from_recordings
+        in download_recordings.py).
+
+        :param metadata: The metadata information for the recordings.
+        :param indices_to_download: Which recordings in the metadata need an audio id.
+
+        :return: None; modifies the metadata dictionaries.
+        """
+        print_log(f"Resolving the audio IDs of {len(indices_to_download)} recordings in batches of {self.batch_size}.")
+        audio_ids = self.resolve([metadata[i]["div_id"] for i in indices_to_download])
+        for i in indices_to_download:
+            audio_id = audio_ids.get(metadata[i]["div_id"])
+            if audio_id is not None:
+                metadata[i]["audio_id"] = audio_id
+
+
+def serve_stand_in(audio_ids: Dict[str, str], port: int) -> None:
+    """
+    Serves a local stand-in of the uidArray[] endpoint, which answers every request with the records of the
+    requested keys, so that the resolver can be checked without amazon.com.
+
+    :param audio_ids: The audio id of every record key that the stand-in knows.
+    :param port: The port to listen on (on localhost).
+
+    :return: None; serves until the process is stopped.
+    """
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            records = [
+                {"recordKey": key, "audioId": audio_ids[key]}
+                for key in query.get(UID_PARAMETER, [])
+                if key in audio_ids
+            ]
+            body = json.dumps({"records": records}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            return
+
+    print_log(f"Serving the stand-in uid endpoint for {len(audio_ids)} records on http://localhost:{port}/.")
+    HTTPServer(("localhost", port), StandInHandler).serve_forever()
+
+
+@click.group()
+def cli() -> None:
+    """
+    Resolves audio ids in batches with the uidArray[] endpoint, and serves a local stand-in of the endpoint.
+    """
+
+
+@cli.command()
+@click.argument("metadata_file", type=str)
+@click.option("--endpoint", type=str, required=True, help="the uidArray[] endpoint to ask.")
+@click.option(
+    "-C",
+    "--cookies",
+    type=str,
+    help="specify a file for the stored cookies",
+    required=False,
+    default="cookies.json",
+)
+@click.option("--batch-size", type=int, default=50, help="number of recordings per request.")
+@click.option("--write", is_flag=True, help="write the resolved audio ids into the metadata file.")
+def resolve(metadata_file: str, endpoint: str, cookies: str, batch_size: int, write: bool) -> None:
+    """
+    Resolves the audio ids of the recordings in METADATA_FILE that do not have one yet.
+    """
+    http = requests.Session()
+    try:
+        with open(cookies, "r") as f:
+            for name, value in format_cookies_for_request(json.load(f)).items():
+                http.cookies.set(name, value)
+    except FileNotFoundError:
+        print_log(f"WARNING: {cookies} does not exist. The requests will not be authenticated.")
+
+    metadata = get_old_metadata(metadata_file)
+    indices = [
+        i for i, recording in enumerate(metadata) if recording.get("audio_id") is None and recording.get("div_id")
+    ]
+    resolver = UidResolver(http, endpoint, batch_size)
+    resolver.attach_audio_ids(metadata, indices)
+    num_resolved = sum(1 for i in indices if metadata[i].get("audio_id") is not None)
+    print_log(f"Resolved {num_resolved} of {len(indices)} audio ids with {resolver.num_requests} requests.")
+    if write:
+        write_json_atomically(metadata_file, metadata)
+
+
+@cli.command()
+@click.argument("mapping_file", type=str)
+@click.option("--port", type=int, default=8765, help="port to serve on.")
+def stand_in(mapping_file: str, port: int) -> None:
+    """
+    Serves a stand-in uidArray[] endpoint for the record key -> audio id mapping in MAPPING_FILE (a json object,
+    or a recording info file with "div_id" and "audio_id" keys).
+    """
+    with open(mapping_file, "r") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {recording["div_id"]: recording["audio_id"] for recording in data if recording.get("audio_id")}
+    serve_stand_in(data, port)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,13 +1,15 @@
 import datetime
+import hashlib
 import json
 import os
 import re
+import socket
 import sys
 import time
 import traceback
 import urllib.parse
-from pathlib import Path
-from typing import List, Dict, Any, Tuple, Optional
+import uuid
+from typing import List, Dict, Any, Tuple, Optional, Iterator
 
 from fake_useragent import UserAgent
 from selenium.webdriver.chrome.webdriver import WebDriver
@@ -110,11 +112,7 @@ def get_old_metadata(metadata_info_filepath: Optional[str]) -> List[Dict[str, An
 
     :return: List of metadata for all recordings that were previously downloaded.
     """
-    if (
-        not os.path.exists(metadata_info_filepath)
-        or metadata_info_filepath
-        not in Path(os.path.dirname(metadata_info_filepath)).iterdir()
-    ):
+    if metadata_info_filepath is None or not os.path.isfile(metadata_info_filepath):
         print_log("Previous metadata file not found.")
         return json.loads("[\n\n]")
     else:
@@ -221,38 +219,6 @@ def get_full_stack() -> str:
     return stackstr
 
 
-def find_last_recording_folder(current_recording_directory: str) -> Optional[str]:
-    """
-    Locates the previous recording folder (prior to this run).
-
-    :param current_recording_directory: The recording directory where all of the recordings are saved.
-
-    :return: A string representing the directory of the past run.
-    """
-    current_recording_directory = (
-        current_recording_directory[:-1]
-        if current_recording_directory.endswith("/")
-        else current_recording_directory
-    )
-
-    date_folder, iteration = current_recording_directory.rsplit("/", 1)
-
-    iteration_num = int(iteration)
-
-    if iteration_num > 0:
-        previous_iteration = iteration_num - 1
-        return os.path.join(date_folder, str(previous_iteration))
-    else:
-        user_folder, date = date_folder.rsplit("/", 1)
-        user_path = Path(user_folder)
-        sorted_dates = sorted([d for d in user_path.iterdir() if str(d) < date])
-        if len(sorted_dates) <= 0:
-            return None
-        else:
-            previous_date = str(sorted_dates[-1])
-            return os.path.join(user_folder, previous_date)
-
-
 def verify_input_date(date: Any) -> bool:
     """
     Verifies that the input date is of the correct format:
@@ -273,3 +239,291 @@ def verify_input_date(date: Any) -> bool:
         "[0-9]{4}/[0-9]{2}/[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}", date
     )
     return True if verify_date else False
+
+
+def write_json_atomically(file_path: str, data: Any) -> None:
+    """
+    Writes the data as json to a temporary file next to file_path and then renames it into place, so that
+    readers never see a partially written file.
+
+    :param file_path: Path of the json file to write.
+    :param data: Data to write.
+
+    :return: None.
+    """
+    # The file can be on a filesystem that is shared between machines (see work_queue.py), so the temporary name
+    # has to be unique across hosts, processes and threads.
+    temporary_path = f"{file_path}.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    with open(temporary_path, "w+") as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, file_path)
+
+
+def get_recording_files(metadata: List[Dict[str, Any]], recording_path: str) -> Dict[str, str]:
+    """
+    Maps each audio ID in the metadata to the wav file it was downloaded to. The recordings are saved as
+    {recording_path}/{i}.wav, where i is the position of the audio ID in get_audio_ids(metadata).
+
+    :param metadata: All metadata information for the recordings of one run.
+    :param recording_path: Directory path where the recordings of that run are saved.
+
+    :return: A dictionary from audio ID to the path of its wav file.
+    """
+    return {
+        audio_id: os.path.join(recording_path, f"{i}.wav")
+        for i, audio_id in enumerate(get_audio_ids(metadata))
+    }
+
+
+def get_date_from_audio_id(audio_id: Optional[str]) -> Optional[str]:
+    """
+    Gets the (UTC) date on which a recording was made from its audio ID. Audio IDs look like
+    "A1RABVCI4QCIKC:1.0/2020/02/04/20/G0911M06928407TH/00:42::...".
+
+    :param audio_id: The audio ID of the recording.
+
+    :return: The date as "YYYY-MM-DD", or None if the audio ID does not contain a date.
+    """
+    if audio_id is None:
+        return None
+    match = re.search(r"/([0-9]{4})/([0-9]{2})/([0-9]{2})/[0-9]{2}/", audio_id)
+    if match is None:
+        return None
+    return "-".join(match.groups())
+
+
+def iter_run_folders(output_folder: str) -> Iterator[Tuple[str, str, str]]:
+    """
+    Goes through every run folder (output_folder/username/year-month-day/trial) in the recordings tree.
+
+    :param output_folder: The folder where all of the recordings are saved.
+
+    :return: A generator of (username, run date, run folder path) tuples.
+    """
+    if not os.path.isdir(output_folder):
+        return
+    for user_entry in os.scandir(output_folder):
+        if not user_entry.is_dir():
+            continue
+        for date_entry in os.scandir(user_entry.path):
+            if not date_entry.is_dir():
+                continue
+            for trial_entry in os.scandir(date_entry.path):
+                if trial_entry.is_dir() and trial_entry.name.isdigit():
+                    yield user_entry.name, date_entry.name, trial_entry.path
+
+
+def iter_json_array(file_path: str, chunk_size: int = 1 << 16) -> Iterator[Any]:
+    """
+    Reads the items of a json file that holds a single top-level list one by one, so that the whole file
+    never has to be held in memory.
+
+    :param file_path: Path of the json file.
+    :param chunk_size: Number of characters to read from the file at a time.
+
+    :return: A generator of the items in the list.
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, "r") as f:
+        buffer = ""
+        position = 0
+        end_of_file = False
+        started = False
+
+        while True:
+            # Skip the whitespace, the opening bracket and the commas between items.
+            while position < len(buffer) and (
+                buffer[position].isspace() or buffer[position] == "," or (not started and buffer[position] == "[")
+            ):
+                started = started or buffer[position] == "["
+                position += 1
+
+            if position < len(buffer) and buffer[position] == "]":
+                return
+
+            if position < len(buffer):
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                    # A number at the end of the buffer might continue in the next chunk.
+                    if end < len(buffer) or end_of_file:
+                        yield item
+                        position = end
+                        continue
+                except json.JSONDecodeError:
+                    if end_of_file:
+                        raise
+
+            if end_of_file:
+                if not started:
+                    raise ValueError(f"{file_path} does not hold a json list.")
+                return
+
+            chunk = f.read(chunk_size)
+            end_of_file = len(chunk) == 0
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def resolve_relative_date(day: str, reference_date: datetime.date) -> Optional[datetime.date]:
+    """
+    Resolves the day that the Alexa website shows for a recording ("Today", "Yesterday", a weekday such as
+    "Monday", or a full date such as "On February 3, 2020") to an actual date.
+
+    :param day: The day as shown on the website.
+    :param reference_date: The date on which the website was crawled.
+
+    :return: The resolved date, or None if the day cannot be understood.
+    """
+    day = day.strip()
+    if day.lower().startswith("on "):
+        day = day[3:].strip()
+    lowered = day.lower()
+    if lowered == "today":
+        return reference_date
+    if lowered == "yesterday":
+        return reference_date - datetime.timedelta(days=1)
+
+    weekdays = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+    if lowered in weekdays:
+        days_ago = (reference_date.weekday() - weekdays.index(lowered)) % 7
+        # The website shows "Today" and "Yesterday" for the last two days, so a weekday is at least 2 days ago.
+        return reference_date - datetime.timedelta(days=days_ago if days_ago >= 2 else days_ago + 7)
+
+    for date_format in ["%B %d, %Y", "%b %d, %Y", "%A, %B %d, %Y", "%m/%d/%Y", "%Y/%m/%d", "%Y-%m-%d"]:
+        try:
+            return datetime.datetime.strptime(day, date_format).date()
+        except ValueError:
+            continue
+
+    for date_format in ["%B %d", "%b %d", "%A, %B %d"]:
+        try:
+            parsed = datetime.datetime.strptime(day, date_format).date()
+        except ValueError:
+            continue
+        resolved = parsed.replace(year=reference_date.year)
+        return resolved if resolved <= reference_date else resolved.replace(year=reference_date.year - 1)
+
+    return None
+
+
+def parse_input_date(date: str) -> datetime.date:
+    """
+    :param date: A date in the input format "YYYY/MM/DD HH:MM:SS" (see verify_input_date).
+
+    :return: The day of the date.
+    """
+    return datetime.datetime.strptime(date.split(" ")[0], "%Y/%m/%d").date()
+
+
+def recording_matches_filters(
+    recording: Dict[str, Any],
+    reference_date: datetime.date,
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    devices: Optional[List[str]] = None,
+) -> bool:
+    """
+    Checks a recording against the date range and devices that were searched for. The day of the recording is
+    taken both from the day shown on the website (relative to the day of the crawl) and from its audio ID (in
+    UTC), and the recording is kept if either day is in the range, so that recordings near midnight or carried
+    over from an earlier crawl are not dropped. Recordings whose day cannot be understood are kept.
+
+    :param recording: The metadata of the recording.
+    :param reference_date: The date on which the website was crawled.
+    :param start_date: The earliest day to keep, if any.
+    :param end_date: The latest day to keep, if any.
+    :param devices: The names of the devices to keep (case-insensitive), if any.
+
+    :return: Whether the recording should be kept.
+    """
+    if devices and recording.get("device", "").strip().lower() not in [device.lower() for device in devices]:
+        return False
+
+    days = []
+    shown_day = resolve_relative_date(recording.get("date", ""), reference_date)
+    if shown_day is not None:
+        days.append(shown_day)
+    audio_id_date = get_date_from_audio_id(recording.get("audio_id"))
+    if audio_id_date is not None:
+        days.append(datetime.datetime.strptime(audio_id_date, "%Y-%m-%d").date())
+    if len(days) == 0:
+        return True
+    return any((start_date is None or day >= start_date) and (end_date is None or day <= end_date) for day in days)
+
+
+def parse_wav_header(data: bytes, file_size: Optional[int] = None) -> Optional[Dict[str, int]]:
+    """
+    Parses the RIFF/WAVE header of a wav file and checks that the chunk sizes agree with the file size.
+
+    :param data: The start of the file. It needs to contain the "fmt " chunk and the "data" chunk header.
+    :param file_size: The full size of the file. If None, then len(data) is used.
+
+    :return: None if this is not a valid wav file. Else, a dict with the "audio_format", "channels",
+        "sample_rate", "bits_per_sample", "block_align", "data_offset" and "data_size" of the file.
+    """
+    file_size = len(data) if file_size is None else file_size
+    if len(data) < 12 or data[0:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    riff_size = int.from_bytes(data[4:8], "little")
+    if riff_size + 8 > file_size or riff_size < 4:
+        return None
+
+    header: Dict[str, int] = {}
+    position = 12
+    while position + 8 <= len(data):
+        chunk_id = data[position:position + 4]
+        chunk_size = int.from_bytes(data[position + 4:position + 8], "little")
+        chunk_start = position + 8
+        if chunk_id == b"fmt ":
+            if chunk_size < 16 or chunk_start + 16 > len(data):
+                return None
+            fmt = data[chunk_start:chunk_start + 16]
+            header.update(
+                {
+                    "audio_format": int.from_bytes(fmt[0:2], "little"),
+                    "channels": int.from_bytes(fmt[2:4], "little"),
+                    "sample_rate": int.from_bytes(fmt[4:8], "little"),
+                    "block_align": int.from_bytes(fmt[12:14], "little"),
+                    "bits_per_sample": int.from_bytes(fmt[14:16], "little"),
+                }
+            )
+        elif chunk_id == b"data":
+            if "sample_rate" not in header or chunk_start + chunk_size > file_size:
+                return None
+            if header["channels"] == 0 or header["sample_rate"] == 0 or header["block_align"] == 0:
+                return None
+            header.update({"data_offset": chunk_start, "data_size": chunk_size})
+            return header
+        # Chunks are padded to an even number of bytes.
+        position = chunk_start + chunk_size + (chunk_size % 2)
+    return None
+
+
+def is_valid_wav_file(file_path: str) -> bool:
+    """
+    :param file_path: Path of the file.
+
+    :return: Whether the file exists and is a wav file whose header agrees with its size (and not, for
+        example, an error page that was saved instead of the recording).
+    """
+    if not os.path.isfile(file_path):
+        return False
+    with open(file_path, "rb") as f:
+        start = f.read(1 << 16)
+    return parse_wav_header(start, os.path.getsize(file_path)) is not None
+
+
+def get_file_checksum(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    :param file_path: Path of the file.
+    :param chunk_size: Number of bytes to read at a time.
+
+    :return: The sha256 checksum of the file, as a hex string.
+    """
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
@@ -0,0 +1,375 @@
+#!venv/bin/python
+
+import json
+import os
+from lzma import LZMAError
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+from typing import Dict, Any, List, Optional, Tuple
+
+import click
+
+from archive_recordings import PACK_FILE_NAME
+from audio_compression import get_compressed_path, decompress_wav_bytes, COMPRESSED_EXTENSION
+from download_recordings import create_driver, log_in, AudioSession
+from mirror_recordings import journal_run_files
+from utils import (
+    print_log,
+    ensure_file_existence,
+    parse_wav_header,
+    get_file_checksum,
+    get_old_metadata,
+    get_recording_files,
+    iter_run_folders,
+    write_json_atomically,
+    load_credentials,
+    create_user_agent,
+    get_full_stack,
+)
+
+CHECKSUMS_FILE_NAME = "checksums.json"
+HEADER_READ_SIZE = 1 << 16
+
+FILE_OK = "ok"
+FILE_MISSING = "missing"
+FILE_INVALID = "invalid"
+
+
+def get_stored_file(wav_path: str) -> str:
+    """
+    :param wav_path: Path of the wav file of a recording.
+
+    :return: The path of the compressed recording if only that exists; else the path of the wav file.
+    """
+    compressed_path = get_compressed_path(wav_path)
+    if not os.path.exists(wav_path) and os.path.exists(compressed_path):
+        return compressed_path
+    return wav_path
+
+
+def verify_wav_file(file_path: str) -> Dict[str, Any]:
+    """
+    Checks that a downloaded file is a real wav file (and not, for example, a login or error page) and
+    computes its checksum. Compressed recordings are decompressed in memory and checked against the checksum
+    of their original.
+
+    :param file_path: Path of the wav file (or of the compressed recording).
+
+    :return: The verification record of the file: its "size", "mtime", "sha256" and "status", and the
+        "reason" why it is invalid (if it is).
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return {"status": FILE_MISSING, "reason": "the file does not exist"}
+
+    if file_path.endswith(COMPRESSED_EXTENSION):
+        with open(file_path, "rb") as f:
+            try:
+                original = decompress_wav_bytes(f.read())
+                header = parse_wav_header(original[:HEADER_READ_SIZE], len(original))
+            except (ValueError, EOFError, LZMAError):
+                header = None
+    else:
+        with open(file_path, "rb") as f:
+            start = f.read(HEADER_READ_SIZE)
+        header = parse_wav_header(start, stat.st_size)
+
+    record = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": get_file_checksum(file_path),
+        "status": FILE_OK if header is not None else FILE_INVALID,
+    }
+    if header is None:
+        record["reason"] = "not a RIFF/WAVE file, or its chunk sizes do not match the file size"
+    return record
+
+
+def load_checksums(run_path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    :param run_path: The run folder path.
+
+    :return: The verification records of the run's files from the last scan, keyed by filename.
+    """
+    checksums_path = os.path.join(run_path, CHECKSUMS_FILE_NAME)
+    if not os.path.isfile(checksums_path):
+        return {}
+    with open(checksums_path, "r") as f:
+        return json.load(f)
+
+
+def is_unchanged(file_path: str, record: Optional[Dict[str, Any]]) -> bool:
+    """
+    :param file_path: Path of the wav file.
+    :param record: The verification record of the file from the last scan.
+
+    :return: Whether the file has the same size and modification time as when it was last verified.
+    """
+    if record is None or record.get("status") == FILE_MISSING:
+        return False
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return False
+    return stat.st_size == record.get("size") and stat.st_mtime == record.get("mtime")
+
+
+def verify_recordings(
+    output_folder: str,
+    info_file: str,
+    queue_file: str,
+    workers: int,
+    full: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Verifies every recording in the recordings tree with a pool of worker processes. Files whose size and
+    modification time have not changed since the last scan are not read again. The verification records of
+    each run are saved in its checksums file, and every missing or invalid recording is written to the repair
+    queue.
+
+    :param output_folder: The folder where all of the recordings are saved.
+    :param info_file: The filename of the metadata file in each run folder.
+    :param queue_file: Path of the repair queue.
+    :param workers: Number of worker processes.
+    :param full: Whether every file should be read again, even unchanged ones.
+
+    :return: The repair queue.
+    """
+    started = time.time()
+    repair_queue = []
+    num_files = 0
+    num_verified = 0
+
+    with Pool(processes=workers) as pool:
+        for username, _, run_path in iter_run_folders(output_folder):
+            metadata_path = os.path.join(run_path, info_file)
+            # Packed runs were checked against their checksums when they were packed.
+            if not os.path.isfile(metadata_path) or os.path.exists(os.path.join(run_path, PACK_FILE_NAME)):
+                continue
+            recording_files = get_recording_files(get_old_metadata(metadata_path), run_path)
+            old_checksums = load_checksums(run_path)
+
+            checksums = {}
+            to_verify = []
+            for audio_id, file_path in recording_files.items():
+                file_name = os.path.basename(file_path)
+                stored_file = get_stored_file(file_path)
+                old_record = old_checksums.get(file_name)
+                # A recording that was compressed since the last scan has to be read again.
+                same_file = old_record is not None and old_record.get("file", file_name) == os.path.basename(
+                    stored_file
+                )
+                if not full and same_file and is_unchanged(stored_file, old_record):
+                    checksums[file_name] = old_record
+                else:
+                    to_verify.append(file_path)
+
+            stored_files = [get_stored_file(file_path) for file_path in to_verify]
+            for file_path, stored_file, record in zip(
+                to_verify, stored_files, pool.imap(verify_wav_file, stored_files, chunksize=16)
+            ):
+                record["file"] = os.path.basename(stored_file)
+                checksums[os.path.basename(file_path)] = record
+            num_files += len(recording_files)
+            num_verified += len(to_verify)
+
+            for audio_id, file_path in recording_files.items():
+                record = checksums[os.path.basename(file_path)]
+                record["audio_id"] = audio_id
+                if record["status"] != FILE_OK:
+                    repair_queue.append(
+                        {
+                            "username": username,
+                            "run_path": os.path.abspath(run_path),
+                            "audio_id": audio_id,
+                            "file": os.path.abspath(file_path),
+                            "status": record["status"],
+                            "reason": record.get("reason"),
+                        }
+                    )
+
+            if len(to_verify) > 0 or len(checksums) != len(old_checksums):
+                write_json_atomically(os.path.join(run_path, CHECKSUMS_FILE_NAME), checksums)
+                journal_run_files(run_path, [CHECKSUMS_FILE_NAME])
+
+    write_json_atomically(queue_file, repair_queue)
+    print_log(
+        f"Checked {num_files} recordings ({num_verified} read, {num_files - num_verified} unchanged) in "
+        f"{time.time() - started:.1f} seconds. {len(repair_queue)} recordings need to be repaired; "
+        f"see {queue_file}."
+    )
+    return repair_queue
+
+
+def repair_recordings(
+    queue_file: str,
+    config_file: str,
+    cookies_file: str,
+    driver_location: Optional[str],
+    show_driver: bool,
+    system: str,
+) -> None:
+    """
+    Downloads every recording in the repair queue again. Each user in the queue logs in once, and only the
+    recordings in the queue are downloaded. Recordings that are valid after the download are taken off the
+    queue.
+
+    :param queue_file: Path of the repair queue.
+    :param config_file: The credentials file which stores the usernames and passwords for users.
+    :param cookies_file: The file location where the session's cookies will be saved.
+    :param driver_location: Location of the WebDriver.
+    :param show_driver: Whether to show the driver or run it in the background.
+    :param system: The OS where the script is running.
+
+    :return: None.
+    """
+    with open(queue_file, "r") as f:
+        repair_queue = json.load(f)
+    passwords = {
+        credentials["username"]: credentials["password"]
+        for credentials in load_credentials(credentials_file=config_file)
+    }
+
+    queue_by_user: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for item in repair_queue:
+        queue_by_user[item["username"]].append(item)
+
+    user_agent = create_user_agent()
+    remaining = []
+    for username, items in queue_by_user.items():
+        if username not in passwords:
+            print_log(f"WARNING: {username} is not in {config_file}. Its recordings cannot be repaired.")
+            remaining.extend(items)
+            continue
+
+        print_log(f"Repairing {len(items)} recordings for user {username}.")
+        driver = create_driver(
+            user_agent=user_agent, show=show_driver, system=system, driver_location=driver_location
+        )
+        repaired_runs: Dict[str, List[Tuple[str, Dict[str, Any]]]] = defaultdict(list)
+        try:
+            log_in(driver, username, passwords[username], cookies_file)
+            audio_session = AudioSession(
+                driver,
+                user_agent,
+                log_in_again=lambda: log_in(driver, username, passwords[username], cookies_file),
+            )
+            for item in items:
+                audio_session.download(item["audio_id"], item["file"])
+                record = verify_wav_file(item["file"])
+                record["audio_id"] = item["audio_id"]
+                repaired_runs[item["run_path"]].append((os.path.basename(item["file"]), record))
+        except Exception as e:
+            print_log(f"ERROR: Repairing the recordings of {username} has errored out: {e}\n{get_full_stack()}")
+        finally:
+            driver.quit()
+
+        repaired_files = set()
+        for run_path, records in repaired_runs.items():
+            checksums = load_checksums(run_path)
+            checksums.update(dict(records))
+            write_json_atomically(os.path.join(run_path, CHECKSUMS_FILE_NAME), checksums)
+            journal_run_files(run_path, [file_name for file_name, _ in records] + [CHECKSUMS_FILE_NAME])
+            repaired_files.update(
+                os.path.join(run_path, file_name) for file_name, record in records if record["status"] == FILE_OK
+            )
+        remaining.extend(item for item in items if item["file"] not in repaired_files)
+
+    write_json_atomically(queue_file, remaining)
+    print_log(f"Repaired {len(repair_queue) - len(remaining)} recordings; {len(remaining)} are still queued.")
+
+
+@click.group()
+def cli() -> None:
+    """
+    Verifies the downloaded recordings and downloads the missing or invalid ones again.
+    """
+
+
+@cli.command()
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    help="specify the directory where the recordings are saved",
+    required=False,
+    default="recordings",
+)
+@click.option(
+    "-i",
+    "--info",
+    type=str,
+    help="specify the filename of the recording info",
+    required=False,
+    default="recordinginfo.json",
+)
+@click.option(
+    "--queue",
+    type=str,
+    help="specify the file that the recordings to repair are written to",
+    required=False,
+    default="repair_queue.json",
+)
+@click.option(
+    "--workers",
+    type=int,
+    help="number of worker processes",
+    required=False,
+    default=os.cpu_count() or 1,
+)
+@click.option("--full", is_flag=True, help="read every file again, even unchanged ones.")
+def verify(output: str, info: str, queue: str, workers: int, full: bool) -> None:
+    """
+    Checks the RIFF/WAVE header, length and checksum of every recording, and queues the bad or missing ones.
+    """
+    verify_recordings(output, info.split("/")[-1], queue, max(1, workers), full)
+
+
+@cli.command()
+@click.option(
+    "-c",
+    "--config",
+    type=str,
+    help="specify a file for credential information",
+    required=False,
+    default="credentials.json",
+)
+@click.option(
+    "-C",
+    "--cookies",
+    type=str,
+    help="specify a file for the stored cookies",
+    required=False,
+    default="cookies.json",
+)
+@click.option(
+    "--queue",
+    type=str,
+    help="specify the file with the recordings to repair",
+    required=False,
+    default="repair_queue.json",
+)
+@click.option(
+    "--system",
+    type=click.Choice(["linux", "mac"], case_sensitive=False),
+    required=False,
+    default="linux",
+    help="Specify the OS you are working on (linux or mac)",
+)
+@click.option(
+    "--show", is_flag=True, help="show the chrome window while logging in."
+)
+@click.option("--driver", type=str, help="Specify file location of driver.")
+def repair(config: str, cookies: str, queue: str, system: str, show: bool, driver: Optional[str]) -> None:
+    """
+    Downloads the recordings in the repair queue again.
+    """
+    ensure_file_existence(config)
+    ensure_file_existence(queue)
+    repair_recordings(queue, config, cookies, driver, False if show is None else show, system)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,317 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Dict, Any, List, Optional
+
+from utils import print_log, write_json_atomically
+
+LEASES_FOLDER = "leases"
+DONE_FOLDER = "done"
+FAILED_FOLDER = "failed"
+# A lease is only renewed while more than this fraction of the lease time is left, so that a renewal can never
+# overwrite the lease of a worker that took it over after it expired.
+RENEW_MARGIN = 0.1
+DEFAULT_MAX_STALL_SECONDS = 60 * 60
+
+
+class LeaseLost(Exception):
+    """
+    Raised when the work on an account reports progress after this worker lost its lease on the account, so
+    that the work stops instead of racing the worker that took the account over.
+    """
+
+
+def get_worker_id() -> str:
+    """
+    :return: An id for this worker process that is unique across the machines sharing a queue.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def get_account_key(username: str) -> str:
+    """
+    :param username: The username of the account.
+
+    :return: A filename-safe key for the account.
+    """
+    return hashlib.sha1(username.encode("utf-8")).hexdigest()
+
+
+class Lease:
+    """
+    A worker's exclusive claim on one account in the work queue. While the lease is held, a background thread
+    renews it every third of the lease time, as long as the work on the account reports progress (see
+    heartbeat) or is parked on a challenge (see park). The lease only expires (and the account is handed to
+    another worker) if this worker dies, or hangs for longer than the queue's max_stall_seconds.
+    """
+
+    def __init__(self, queue: "WorkQueue", username: str, attempts: int) -> None:
+        self.queue = queue
+        self.username = username
+        self.attempts = attempts
+        self.lost = False
+        self.parked = False
+        self.last_progress = time.time()
+        self._stop = threading.Event()
+        self._renewer = threading.Thread(target=self._renew_until_stopped, daemon=True)
+        self._renewer.start()
+
+    def heartbeat(self) -> None:
+        """
+        Reports that the work on the account has made progress, so that the lease keeps being renewed. Raises
+        LeaseLost if the lease was lost in the meantime.
+        """
+        if self.lost:
+            raise LeaseLost(f"The lease on {self.username} was lost, so another worker may be working on it.")
+        self.last_progress = time.time()
+
+    def park(self) -> None:
+        """
+        Keeps renewing the lease without progress while the account waits on a challenge, since the worker
+        still holds the account's driver on the challenge page.
+        """
+        self.parked = True
+
+    def unpark(self) -> None:
+        """
+        Goes back to renewing the lease only while the work on the account makes progress.
+        """
+        self.last_progress = time.time()
+        self.parked = False
+
+    def _renew_until_stopped(self) -> None:
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            stalled_seconds = time.time() - self.last_progress
+            stalled = self.queue.max_stall_seconds is not None and stalled_seconds > self.queue.max_stall_seconds
+            if stalled and not self.parked:
+                print_log(
+                    f"WARNING: The work on {self.username} has made no progress for {stalled_seconds:.0f} seconds. "
+                    "Letting its lease expire, so that another worker can take it over."
+                )
+                self.lost = True
+                return
+            if not self.queue.renew(self):
+                print_log(f"WARNING: The lease on {self.username} was taken over by another worker.")
+                self.lost = True
+                return
+
+    def stop_renewing(self) -> None:
+        """
+        Stops the background renewal of the lease.
+        """
+        self._stop.set()
+        self._renewer.join()
+
+
+class WorkQueue:
+    """
+    Treats the accounts in the credentials file as jobs in a queue that is shared between worker processes on
+    any number of machines. The queue is a directory (for example on a shared filesystem) holding one lease
+    file per account that is being worked on, plus a marker file per account that is done or has failed.
+
+    Lease files are created with O_CREAT | O_EXCL, so only one worker can hold an account at a time. An expired
+    lease is taken over by atomically renaming it out of the way first (only one worker's rename can succeed),
+    and a worker that finds its lease was taken over stops renewing it. A lease is only renewed well before it
+    expires, so a renewal never races with a takeover.
+    """
+
+    def __init__(
+        self,
+        queue_dir: str,
+        batch: str,
+        lease_seconds: float = 300.0,
+        max_attempts: int = 3,
+        worker_id: Optional[str] = None,
+        max_stall_seconds: Optional[float] = DEFAULT_MAX_STALL_SECONDS,
+    ) -> None:
+        """
+        :param queue_dir: The directory of the queue.
+        :param batch: The name of the batch of accounts (for example the date of the runs).
+        :param lease_seconds: Number of seconds after which a lease expires if it is not renewed.
+        :param max_attempts: Number of times an account is tried before it is marked as failed.
+        :param worker_id: The id of this worker. If None, then a unique one is made (see get_worker_id).
+        :param max_stall_seconds: Number of seconds without progress (see Lease.heartbeat) after which a lease
+            is no longer renewed. If None, then a lease is renewed until it is released.
+        """
+        self.batch_dir = os.path.join(queue_dir, batch)
+        self.lease_seconds = lease_seconds
+        self.max_stall_seconds = max_stall_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id if worker_id is not None else get_worker_id()
+        for folder in [LEASES_FOLDER, DONE_FOLDER, FAILED_FOLDER]:
+            os.makedirs(os.path.join(self.batch_dir, folder), exist_ok=True)
+
+    def _path(self, folder: str, username: str) -> str:
+        return os.path.join(self.batch_dir, folder, get_account_key(username) + ".json")
+
+    def _read_lease(self, username: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(LEASES_FOLDER, username), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _lease_record(self, username: str, attempts: int) -> Dict[str, Any]:
+        return {
+            "username": username,
+            "worker": self.worker_id,
+            "expires": time.time() + self.lease_seconds,
+            "attempts": attempts,
+        }
+
+    def is_finished(self, username: str) -> bool:
+        """
+        :param username: The username of the account.
+
+        :return: Whether the account is done or has failed too many times.
+        """
+        return os.path.exists(self._path(DONE_FOLDER, username)) or os.path.exists(
+            self._path(FAILED_FOLDER, username)
+        )
+
+    def try_lease(self, username: str) -> Optional[Lease]:
+        """
+        Tries to take the lease on an account. This succeeds if the account is not finished and either nobody
+        holds its lease or the lease has expired.
+
+        :param username: The username of the account.
+
+        :return: The lease, or None if another worker holds the account or the account is finished.
+        """
+        if self.is_finished(username):
+            return None
+        lease_path = self._path(LEASES_FOLDER, username)
+        attempts = 0
+
+        current = self._read_lease(username)
+        if current is not None:
+            if current["expires"] > time.time():
+                return None
+            # Move the expired lease out of the way; only one worker's rename can succeed.
+            stale_path = f"{lease_path}.stale.{uuid.uuid4().hex}"
+            try:
+                os.rename(lease_path, stale_path)
+            except FileNotFoundError:
+                return None
+            try:
+                with open(stale_path, "r") as f:
+                    moved = json.load(f)
+            except json.JSONDecodeError:
+                moved = {"worker": None, "expires": float("inf")}
+            if moved["worker"] != current["worker"] or moved["expires"] > time.time():
+                # Another worker took over (or renewed) the lease in the meantime; put its lease back.
+                try:
+                    os.link(stale_path, lease_path)
+                except FileExistsError:
+                    pass
+                os.remove(stale_path)
+                return None
+            os.remove(stale_path)
+            attempts = current.get("attempts", 0)
+            print_log(f"Taking over the expired lease of {current['worker']} on {username}.")
+
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._lease_record(username, attempts), f)
+
+        # The account may have been finished between the check above and the creation of the lease.
+        if self.is_finished(username):
+            os.remove(lease_path)
+            return None
+        return Lease(self, username, attempts)
+
+    def renew(self, lease: Lease) -> bool:
+        """
+        Extends a lease by lease_seconds from now.
+
+        :param lease: The lease to renew.
+
+        :return: False if the lease no longer belongs to this worker.
+        """
+        current = self._read_lease(lease.username)
+        if current is None or current["worker"] != self.worker_id:
+            return False
+        # Other workers only take over expired leases, so a lease that is not close to expiring cannot be taken
+        # over between the check above and the write below. A lease that is close to expiring is given up.
+        if current["expires"] - time.time() < self.lease_seconds * RENEW_MARGIN:
+            return False
+        write_json_atomically(
+            self._path(LEASES_FOLDER, lease.username), self._lease_record(lease.username, lease.attempts)
+        )
+        return self._owns(lease)
+
+    def complete(self, lease: Lease) -> bool:
+        """
+        Marks the account as done and releases its lease, unless the lease was lost (then another worker may be
+        working on the account, and it is left to that worker).
+
+        :param lease: The lease on the account.
+
+        :return: Whether the account was marked as done.
+        """
+        lease.stop_renewing()
+        if lease.lost or not self._owns(lease):
+            print_log(f"WARNING: The lease on {lease.username} was lost. Not marking it as done.")
+            return False
+        write_json_atomically(
+            self._path(DONE_FOLDER, lease.username),
+            {"username": lease.username, "worker": self.worker_id, "finished": time.time()},
+        )
+        self._release(lease)
+        return True
+
+    def fail(self, lease: Lease, error: str) -> None:
+        """
+        Releases the lease on an account that errored out, so that another worker can retry it. After
+        max_attempts failures, the account is marked as failed instead.
+
+        :param lease: The lease on the account.
+        :param error: The error message.
+
+        :return: None.
+        """
+        lease.stop_renewing()
+        attempts = lease.attempts + 1
+        if attempts >= self.max_attempts:
+            write_json_atomically(
+                self._path(FAILED_FOLDER, lease.username),
+                {"username": lease.username, "worker": self.worker_id, "attempts": attempts, "error": error},
+            )
+            self._release(lease)
+        elif not lease.lost and self._owns(lease):
+            # Keep the attempt count for the next worker, but let the lease expire right away.
+            record = self._lease_record(lease.username, attempts)
+            record["expires"] = 0
+            write_json_atomically(self._path(LEASES_FOLDER, lease.username), record)
+
+    def _owns(self, lease: Lease) -> bool:
+        current = self._read_lease(lease.username)
+        return current is not None and current["worker"] == self.worker_id
+
+    def _release(self, lease: Lease) -> None:
+        if self._owns(lease):
+            os.remove(self._path(LEASES_FOLDER, lease.username))
+
+    def status(self, usernames: List[str]) -> Dict[str, int]:
+        """
+        :param usernames: The usernames of all of the accounts in the queue.
+
+        :return: The number of accounts that are done, failed, leased and waiting.
+        """
+        counts = {"done": 0, "failed": 0, "leased": 0, "waiting": 0}
+        for username in usernames:
+            if os.path.exists(self._path(DONE_FOLDER, username)):
+                counts["done"] += 1
+            elif os.path.exists(self._path(FAILED_FOLDER, username)):
+                counts["failed"] += 1
+            else:
+                lease = self._read_lease(username)
+                counts["leased" if lease is not None and lease["expires"] > time.time() else "waiting"] += 1
+        return counts